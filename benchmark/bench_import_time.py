@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# benchmark the startup time of the package and its scripts, each measured in
+# fresh interpreters; also lists the heavy dependencies each one imports, so
+# that a module importing them eagerly shows up as a regression
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+TARGETS = [
+	("package", "import opu_analysis_lib"),
+	("opu_dataset_manip", "from opu_analysis_lib import SpecDatasetManip"),
+	("opu_assign", "from opu_analysis_lib import OPUModel"),
+	("opu_analysis", "from opu_analysis_lib import OPUAnalysis"),
+]
+
+HEAVY_DEPS = ["matplotlib", "mpllayout", "scipy", "sklearn", "skfeature"]
+
+PROBE = """
+import json, sys, time
+t = time.perf_counter()
+%s
+elapsed = time.perf_counter() - t
+print(json.dumps([elapsed, sorted({i.split(".")[0] for i in sys.modules}
+	& set(%r))]))
+"""
+
+
+def get_args():
+	ap = argparse.ArgumentParser()
+	ap.add_argument("--repeats", type=int, default=5, metavar="int",
+		help="number of fresh interpreters per target, the median time is "
+			"reported [5]")
+	ap.add_argument("--max-time", type=float, default=None, metavar="float",
+		help="exit with an error if the median time of any target except "
+			"opu_analysis exceeds this many seconds [off]")
+	return ap.parse_args()
+
+
+def bench(statement, repeats) -> tuple:
+	times = list()
+	for i in range(repeats):
+		out = subprocess.run([sys.executable, "-c",
+			PROBE % (statement, HEAVY_DEPS)], check=True, capture_output=True,
+			text=True).stdout
+		elapsed, deps = json.loads(out.splitlines()[-1])
+		times.append(elapsed)
+	return statistics.median(times), deps
+
+
+def main():
+	args = get_args()
+	print("\t".join(["target", "median time (s)", "heavy deps imported"]))
+	slow = list()
+	for name, statement in TARGETS:
+		elapsed, deps = bench(statement, args.repeats)
+		print("%s\t%.3f\t%s" % (name, elapsed, ",".join(deps) or "-"))
+		if (args.max_time is not None) and (name != "opu_analysis") \
+				and (elapsed > args.max_time):
+			slow.append(name)
+	if slow:
+		sys.exit("startup slower than %.3f s: %s"
+			% (args.max_time, ", ".join(slow)))
+	return
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# benchmark runtime and peak memory of HCA with the dense distance matrix vs.
+# with the knn connectivity graph (run_hca(n_neighbors=...))
+
+import argparse
+import time
+import tracemalloc
+import warnings
+
+import numpy
+
+import opu_analysis_lib
+
+
+def get_args():
+	ap = argparse.ArgumentParser()
+	ap.add_argument("--n-spectra", type=int, nargs="+",
+		default=[1000, 2000, 4000], metavar="int",
+		help="dataset sizes to benchmark [1000 2000 4000]")
+	ap.add_argument("--n-wavenum", type=int, default=300, metavar="int",
+		help="number of wavenumbers in each spectrum [300]")
+	ap.add_argument("--n-neighbors", type=int, default=15, metavar="int",
+		help="k in knn connectivity [15]")
+	ap.add_argument("--metric", type=str, default="cosine",
+		help="distance metric [cosine]")
+	ap.add_argument("--cutoff", type=float, default=0.3, metavar="float",
+		help="cutoff threshold [0.3]")
+	ap.add_argument("--seed", type=int, default=0, metavar="int",
+		help="random seed of mock data [0]")
+	return ap.parse_args()
+
+
+def mock_dataset(n_spectra, n_wavenum, *, n_types=8, seed=0
+		) -> opu_analysis_lib.SpectraDataset:
+	# spectra of a few types, each type a random sum of lorentzian peaks
+	rng = numpy.random.default_rng(seed)
+	wavenum = numpy.linspace(400, 1800, n_wavenum)
+	centers = rng.uniform(400, 1800, size=(n_types, 6, 1))
+	types = (10 / ((wavenum - centers) ** 2 + 100)).sum(axis=1)
+	intens = types[rng.integers(n_types, size=n_spectra)] \
+		+ rng.normal(0, 0.02, size=(n_spectra, n_wavenum))
+	intens /= numpy.linalg.norm(intens, axis=1, keepdims=True)
+	return opu_analysis_lib.SpectraDataset(wavenum, intens)
+
+
+def bench(dataset, **kw) -> tuple:
+	anal = opu_analysis_lib.OPUAnalysis(dataset)
+	tracemalloc.start()
+	t = time.perf_counter()
+	anal.run_hca(**kw)
+	elapsed = time.perf_counter() - t
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	return elapsed, peak / 2 ** 20, anal.n_clusters
+
+
+def main():
+	args = get_args()
+	warnings.simplefilter("ignore")
+	print("\t".join(["n_spectra", "mode", "time (s)", "peak mem (MiB)",
+		"n_clusters"]))
+	for n in args.n_spectra:
+		dataset = mock_dataset(n, args.n_wavenum, seed=args.seed)
+		for mode, n_neighbors in [("dense", 0), ("knn", args.n_neighbors)]:
+			elapsed, peak, n_clusters = bench(dataset, metric=args.metric,
+				cutoff=args.cutoff, n_neighbors=n_neighbors)
+			print("%u\t%s\t%.2f\t%.1f\t%u" % (n, mode, elapsed, peak,
+				n_clusters))
+	return
+
+
+if __name__ == "__main__":
+	main()
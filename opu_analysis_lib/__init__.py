@@ -1,28 +1,54 @@
 #!/usr/bin/env python3
+# submodules and classes are imported on first attribute access, so that
+# e.g. scripts only using SpectraDataset do not import sklearn or matplotlib
+
+import importlib
 
 __version__ = "1.2.7a1"
 
-# utility
-from . import util
-from . import future
-
-# method
-from . import registry
-from . import cluster_metric
-from . import hca_cutoff_optimizer
-from . import normalize
-from . import dim_red_visualize
-from . import feature_score
-
-# i/o class
-from .spectra_dataset import SpectraDataset
-
-# analysis routine/mixin
-from .analysis_dataset_routine import AnalysisDatasetRoutine
-from .analysis_hca_routine import AnalysisHCARoutine
-from .analysis_abundance_routine import AnalysisAbundanceRoutine
-from .analysis_feature_score_routine import AnalysisFeatureScoreRoutine
-
-# wrapper class
-from .opu_analysis import OPUAnalysis
-from .spectra_dataset_manip import SpecDatasetManip
+_LAZY_ATTRS = {
+	# utility
+	"util": ".util",
+	"future": ".future",
+
+	# method
+	"registry": ".registry",
+	"cluster_metric": ".cluster_metric",
+	"clustering_engine": ".clustering_engine",
+	"hca_cutoff_optimizer": ".hca_cutoff_optimizer",
+	"normalize": ".normalize",
+	"dim_red_visualize": ".dim_red_visualize",
+	"feature_score": ".feature_score",
+
+	# i/o class
+	"SpectraDataset": ".spectra_dataset",
+
+	# analysis routine/mixin
+	"AnalysisDatasetRoutine": ".analysis_dataset_routine",
+	"AnalysisHCARoutine": ".analysis_hca_routine",
+	"AnalysisAbundanceRoutine": ".analysis_abundance_routine",
+	"AnalysisFeatureScoreRoutine": ".analysis_feature_score_routine",
+
+	# wrapper class
+	"OPUAnalysis": ".opu_analysis",
+	"SpecDatasetManip": ".spectra_dataset_manip",
+	"OPUModel": ".opu_model",
+}
+
+__all__ = list(_LAZY_ATTRS)
+
+
+def __getattr__(name):
+	if name not in _LAZY_ATTRS:
+		raise AttributeError("module '%s' has no attribute '%s'"
+			% (__name__, name))
+	module = importlib.import_module(_LAZY_ATTRS[name], __name__)
+	# submodules are returned as is, classes are taken from their module
+	ret = module if module.__name__.endswith("." + name) \
+		else getattr(module, name)
+	globals()[name] = ret
+	return ret
+
+
+def __dir__():
+	return sorted(set(globals()) | set(_LAZY_ATTRS))
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import typing
+
 import matplotlib
 import matplotlib.pyplot
 import numpy
@@ -7,7 +9,7 @@ import numpy
 # custom lib
 import mpllayout
 
-from . import future
+from . import rarefaction
 from . import registry
 from . import util
 from .analysis_hca_routine import AnalysisHCARoutine
@@ -25,9 +27,9 @@ class AnalysisAbundanceRoutine(AnalysisHCARoutine):
 	def save_opu_abundance_table(self, f, *, delimiter: str = "\t"):
 		if not f:
 			return
-		# calculating biosample opu stats
-		biosample_stats = self.__get_biosample_opu_stats()
-		hca_label_unique = [i for i in self.remapped_hca_label if i is not None]
+		# columns follow self.remapped_hca_label_unique
+		counts = self.biosample_opu_counts
+		abunds = self.__get_biosample_opu_abunds()
 
 		with util.get_fp(f, "w") as fp:
 			# header line
@@ -36,10 +38,10 @@ class AnalysisAbundanceRoutine(AnalysisHCARoutine):
 			line = delimiter.join([""] + labels)
 			print(line, file=fp)
 			# for each sample, write a line
-			for s in biosample_stats:
-				abunds = [str(s["opu_abunds"].get(l, 0))
-					for l in self.remapped_hca_label_unique]
-				line = delimiter.join([s["name"]] + abunds)
+			for s, c, a in zip(self.biosample_unique, counts.tolist(),
+					abunds.tolist()):
+				line = delimiter.join([s] + [str(j if i else 0)
+					for i, j in zip(c, a)])
 				print(line, file=fp)
 		return
 
@@ -56,30 +58,129 @@ class AnalysisAbundanceRoutine(AnalysisHCARoutine):
 		return si
 
 	@util.with_check_data_avail(check_data_attr="hca", dep_method="run_hca")
-	def save_opu_alpha_diversity(self, f, *, delimiter="\t"):
+	def save_opu_alpha_diversity(self, f, *, delimiter="\t",
+			n_replicates=0, depth=None, resampling="hypergeometric",
+			confidence=0.95, random_state=None):
+		"""
+		save the shannon index of each biosample, with and without minor
+		clusters; if n_replicates is positive, also the rarefied shannon index
+		and richness of opus, i.e. their mean over <n_replicates> replicates
+		of <depth> spectra resampled from each biosample, with the percentile
+		interval at <confidence>
+
+		depth: number of spectra in opus of each replicate; None means the
+			smallest number among biosamples; biosamples having fewer spectra
+			in opus are reported as nan
+		resampling: 'hypergeometric' draws without replacement (rarefaction),
+			the interval reflecting the variability of rarefaction only;
+			'multinomial' draws with replacement (bootstrap), the interval
+			being a bootstrap confidence interval; the columns are named
+			'rarefied' or 'bootstrap' accordingly
+		random_state: seed used in resampling
+		"""
 		if not f:
 			return
 
 		# calculate alpha diversity
 		si_n_minor = self.__calculate_shannon_index(with_minor=False)
 		si_w_minor = self.__calculate_shannon_index(with_minor=True)
+		header = ["", "shannon (OPUs)", "shannon (with minor)"]
+		columns = [si_n_minor, si_w_minor]
+		if n_replicates:
+			counts = self.__get_biosample_opu_only_counts()
+			if depth is None:
+				depth = self.__get_default_rarefy_depth(counts)
+		if n_replicates and (depth is None):
+			util.log("rarefied alpha diversity skipped for no biosample has "
+				"spectra in OPUs")
+		elif n_replicates:
+			div = rarefaction.resampled_diversity(counts, depth, n_replicates,
+				resampling=resampling, random_state=random_state)
+			alpha = (1 - confidence) / 2
+			prefix = "rarefied" if resampling == "hypergeometric" \
+				else "bootstrap"
+			for k in ["shannon", "richness"]:
+				name = "%s %s (OPUs, depth %u)" % (prefix, k, depth)
+				header.extend([name, "%s %g%%" % (name, alpha * 100),
+					"%s %g%%" % (name, (1 - alpha) * 100)])
+				columns.extend(i.tolist() for i in
+					rarefaction.summarize_replicates(div[k], confidence))
 		# save file
 		with util.get_fp(f, "w") as fp:
 			# header line
-			print(delimiter.join(["", "shannon (OPUs)", "shannon (with minor)"]
-				), file=fp)
+			print(delimiter.join(header), file=fp)
 			# each line for a biosample
-			for s, i, j in zip(self.biosample_unique, si_n_minor, si_w_minor):
-				print(delimiter.join([s, str(i), str(j)]), file=fp)
+			for s, *values in zip(self.biosample_unique, *columns):
+				print(delimiter.join([s] + [str(i) for i in values]), file=fp)
 		return
 
+	@util.with_check_data_avail(check_data_attr="hca", dep_method="run_hca")
+	def plot_opu_rarefaction_curves(self, *, plot_to="show", dpi=300,
+			n_replicates=200, n_depths=20, resampling="hypergeometric",
+			confidence=0.95, random_state=None):
+		"""
+		plot the rarefied richness and shannon index of opus in each
+		biosample against the number of spectra resampled (depth), up to the
+		number of spectra in opus of that biosample; the band shows the
+		percentile interval at <confidence>; see save_opu_alpha_diversity()
+		for resampling
+
+		n_depths: number of depths evenly spaced from 1 to the largest
+			biosample
+		"""
+		if plot_to is None:
+			return
+		counts = self.__get_biosample_opu_only_counts()
+		depths = numpy.unique(numpy.linspace(1, max(counts.sum(axis=1).max(),
+			1), n_depths).round().astype(int))
+		curves = rarefaction.rarefaction_curves(counts, depths, n_replicates,
+			resampling=resampling, confidence=confidence,
+			random_state=random_state)
+
+		# create layout
+		layout = self.__rarefaction_create_layout()
+		figure = layout["figure"]
+		figure.set_dpi(dpi)
+
+		# plot curves
+		for key, ylabel in [("richness", "OPU richness"),
+				("shannon", "Shannon index (OPUs)")]:
+			ax = layout[key]
+			mean, low, high = curves[key]
+			for i, s in enumerate(self.biosample_unique):
+				color = self.biosample_color_dict[s]
+				ax.fill_between(depths, low[:, i], high[:, i], edgecolor="none",
+					facecolor=color, alpha=0.2, zorder=2)
+				ax.plot(depths, mean[:, i], linewidth=1.0, color=color,
+					label=s, zorder=3)
+			ax.set_xlim(0, depths[-1])
+			ax.set_ylim(0, None)
+			ax.set_xlabel("Spectra resampled", fontsize=12)
+			ax.set_ylabel(ylabel, fontsize=12)
+
+		# legend
+		layout["shannon"].legend(loc=2, bbox_to_anchor=(1.02, 1.02),
+			fontsize=10, handlelength=0.8, frameon=False)
+
+		# save fig and clean up
+		if plot_to == "show":
+			matplotlib.pyplot.show()
+			ret = None
+		elif plot_to == "jupyter":
+			ret = None
+		else:
+			figure.savefig(plot_to, dpi=dpi)
+			matplotlib.pyplot.close()
+			ret = None
+		return ret
+
 	@util.with_check_data_avail(check_data_attr="hca", dep_method="run_hca")
 	def plot_opu_abundance_stackbar(self, *, plot_to="show", dpi=300):
 	  if plot_to is None:
 		  return
-	  # calculating biosample opu stats
-	  biosample_stats = self.__get_biosample_opu_stats()
-	  n_biosample = len(biosample_stats)
+	  # columns follow self.remapped_hca_label_unique
+	  abunds = self.__get_biosample_opu_abunds()
+	  n_biosample = len(abunds)
 
 	  # create layout
 	  layout = self.__stackbar_create_layout(n_biosample)
@@ -93,8 +194,7 @@ class AnalysisAbundanceRoutine(AnalysisHCARoutine):
 	  x = numpy.arange(n_biosample) + 0.5  # center of each bar
 	  # plot major opus
 	  ax = layout["axes"]
-	  for l in self.remapped_hca_label_unique:
-		  h = [i["opu_abunds"].get(l, 0) for i in biosample_stats]
+	  for l, h in zip(self.remapped_hca_label_unique, abunds.T):
 		  edgecolor = "#404040" if l is None else "none"
 		  facecolor = "#ffffff" if l is None else color_list[l]
 		  label = "other minor" if l is None else "OPU_%02u" % l
@@ -115,7 +215,7 @@ class AnalysisAbundanceRoutine(AnalysisHCARoutine):
 	  ax.set_ylim(0.0, 1.0)
 	  ax.set_ylabel("OPU abundance", fontsize=12)
 	  ax.set_xticks(x)
-	  ax.set_xticklabels([i["name"] for i in biosample_stats], fontsize=10,
+	  ax.set_xticklabels(self.biosample_unique, fontsize=10,
 		  rotation=90
 	  )
 
@@ -141,18 +241,12 @@ class AnalysisAbundanceRoutine(AnalysisHCARoutine):
 			util.log("biplot skipped for not enough biosamples (requires 2 or more)")
 			return
 
-		# calculating biosample opu stats
-		biosample_stats = self.__get_biosample_opu_stats()
-		n_biosample = len(biosample_stats)
 		hca_labels = [i for i in self.remapped_hca_label_unique
 			if i is not None]
 		n_label = len(hca_labels)
 
-		# abund_mat, n_biosample * n_label
-		abund_mat = numpy.empty((n_biosample, n_label), dtype=float)
-		for i in range(n_biosample):
-			for j, l in enumerate(hca_labels):
-				abund_mat[i, j] = biosample_stats[i]["opu_abunds"].get(l, 0)
+		# abund_mat, n_biosample * n_label; opus are the leading columns
+		abund_mat = self.__get_biosample_opu_abunds()[:, :n_label]
 
 		# run dimensionality reduction
 		if method_params is None:
@@ -219,65 +313,34 @@ class AnalysisAbundanceRoutine(AnalysisHCARoutine):
 			ret = None
 		return ret
 
-	def __calculate_shannon_index(self, with_minor: bool):
-		count_stats = self.count_biosample_hca_labels()
-		ret = list()
-		for s in self.biosample_unique:
-			if with_minor:
-				# if with_minor, use all counts
-				counts = list(count_stats[s].values())
-			else:
-				# if not with_minor, ignore minor cluster counts
-				counts = [c for l, c in count_stats[s].items()
-					if l in self.hca_label_remap
-				]
-			ret.append(self.shannon_index(counts))
-		return ret
+	def __calculate_shannon_index(self, with_minor: bool) -> list:
+		if with_minor:
+			# if with_minor, use all counts, each minor cluster separately
+			counts = self.biosample_cluster_counts
+		else:
+			# if not with_minor, ignore minor cluster counts
+			counts = self.__get_biosample_opu_only_counts()
+		return [self.shannon_index(i) for i in counts]
+
+	def __get_biosample_opu_only_counts(self) -> numpy.ndarray:
+		# biosample_opu_counts without the minor clusters column
+		return self.biosample_opu_counts[:, :len(self.hca_label_remap)]
+
+	@staticmethod
+	def __get_default_rarefy_depth(counts) -> typing.Optional[int]:
+		# the smallest non-empty biosample; None if all are empty
+		totals = counts.sum(axis=1)
+		totals = totals[totals > 0]
+		return int(totals.min()) if len(totals) else None
 
-	def __get_biosample_opu_stats(self, minor_policy="grouped") -> list:
+	def __get_biosample_opu_abunds(self) -> numpy.ndarray:
 		"""
-		biosample stats based on self.biosample, self.biosample_color, and
-		self.remapped_hca_label;
-		returns a list of dict elements each represents stats of a biosample, in
-		the same order follows the encounting order in self.biosample
-
-		stats include:
-		name: biosample name
-		n_spectra: number of spectra in that biosample
-		color: color of that biosample
-		opu_counts: spectra counts in each opu, as in remapped opu labels
-
-		the argument minor_policy determins how to report minor clusters (those
-		below the min_opu_size threshold), accepted values are:
-		grouped: grouped into a same label 'None' (default)
-		hidden: removed from stats
+		opu abundances in each biosample, i.e. rows of biosample_opu_counts
+		divided by the number of spectra in each biosample; minor clusters are
+		grouped in the last column, if any
 		"""
-		if minor_policy not in {"grouped", "hidden"}:
-			raise ValueError("argument minor_policy will only accept value "
-				"'grouped' or 'hidden', got '%s'" % minor_policy)
-
-		ret = list()
-		count_stats = self.count_biosample_hca_labels()
-		for s in self.biosample_unique:
-			# remap the labels
-			opu_counts = future.Counter()
-			for label, count in count_stats[s].items():
-				remapped_label = self.hca_label_remap.get(label, None)
-				if (remapped_label is not None) or (minor_policy != "hidden"):
-					opu_counts[remapped_label] += count
-			n_spectra = opu_counts.total()
-			opu_abunds = {l: c / n_spectra for l, c in opu_counts.items()}
-			#
-			st = dict(
-				name=s,
-				color=self.biosample_color_dict[s],
-				n_spectra=n_spectra,
-				opu_counts=opu_counts,
-				opu_abunds=opu_abunds,
-			)
-			#
-			ret.append(st)
-		return ret
+		counts = self.biosample_opu_counts
+		return counts / counts.sum(axis=1, keepdims=True)
 
 	def __stackbar_create_layout(self, n_biosample):
 		lc = mpllayout.LayoutCreator(
@@ -308,6 +371,41 @@ class AnalysisAbundanceRoutine(AnalysisHCARoutine):
 
 		return layout
 
+	def __rarefaction_create_layout(self):
+		lc = mpllayout.LayoutCreator(
+			left_margin=0.7,
+			right_margin=1.5,
+			top_margin=0.2,
+			bottom_margin=0.6,
+		)
+
+		richness = lc.add_frame("richness")
+		richness.set_anchor("bottomleft")
+		richness.set_size(3.0, 3.0)
+
+		shannon = lc.add_frame("shannon")
+		shannon.set_anchor("bottomleft", ref_frame=richness,
+			ref_anchor="bottomright", offsets=(0.8, 0))
+		shannon.set_size(3.0, 3.0)
+
+		# create layout
+		layout = lc.create_figure_layout()
+
+		# apply axes style
+		for n in ["richness", "shannon"]:
+			axes = layout[n]
+			for sp in axes.spines.values():
+				sp.set_visible(False)
+			axes.set_facecolor("#f0f0f8")
+			axes.tick_params(
+				left=True, labelleft=True,
+				right=False, labelright=False,
+				bottom=True, labelbottom=True,
+				top=False, labeltop=False
+			)
+
+		return layout
+
 	def __biplot_create_layout(self, figsize):
 		lc = mpllayout.LayoutCreator(
 			left_margin=1.0,
@@ -14,9 +14,11 @@ class AnalysisDatasetRoutine(object):
 	"""
 
 	def __init__(self, dataset: SpectraDataset, *ka,
-			biosample=None, biosample_color=None, **kw):
+			biosample=None, biosample_color=None, reconcile_param=None, **kw):
 		super().__init__(*ka, **kw)
 		self.dataset = dataset
+		# preprocessing parameters used to load dataset, None if unknown
+		self.reconcile_param = reconcile_param
 		# assure biosample and biosample_color are assigned after dataset in
 		# __init__, otherwise attribute error will occur
 		self.biosample = biosample
@@ -52,14 +54,28 @@ class AnalysisDatasetRoutine(object):
 				"length of dataset.n_spectra")
 		self._biosample = value
 		# also update the unique biosample name to ensure that all subclasses
-		# have the same biosample_unique order
-		self._biosample_unique = util.drop_replicate(self._biosample)
+		# have the same biosample_unique order, i.e. the order of first
+		# appearance; each spectrum's biosample is coded as the index of its
+		# name in biosample_unique
+		unique, first, codes = numpy.unique(numpy.asarray(value, dtype=str),
+			return_index=True, return_inverse=True)
+		order = numpy.argsort(first)
+		self._biosample_unique = [value[i] for i in first[order]]
+		self._biosample_codes = numpy.argsort(order)[codes.ravel()]
 		return
 
 	@property
 	def biosample_unique(self):
 		return self._biosample_unique
 
+	@property
+	def biosample_codes(self) -> numpy.ndarray:
+		"""
+		biosample of each spectrum as an int array of indices into
+		biosample_unique
+		"""
+		return self._biosample_codes
+
 	@property
 	def n_biosample(self) -> int:
 		return len(self._biosample_unique)
@@ -94,7 +110,9 @@ class AnalysisDatasetRoutine(object):
 	@property
 	def biosample_size(self) -> future.Counter:
 		# return the sizes of each biosample as a counter
-		return future.Counter(self.biosample)
+		return future.Counter(dict(zip(self.biosample_unique,
+			numpy.bincount(self.biosample_codes,
+				minlength=self.n_biosample).tolist())))
 
 	@classmethod
 	def from_config(cls, cfg: list, *, reconcile_param=None, **kw):
@@ -132,7 +150,7 @@ class AnalysisDatasetRoutine(object):
 		biosample_color = [biosample_color_map[k] for k in biosample]
 
 		new = cls(dataset, biosample=biosample, biosample_color=biosample_color,
-			**kw)
+			reconcile_param=reconcile_param, **kw)
 		return new
 
 	@classmethod
@@ -20,7 +20,9 @@ class AnalysisFeatureScoreRoutine(AnalysisHCARoutine):
 	score_meth = registry.get("feature_score")
 
 	@util.with_check_data_avail(check_data_attr="hca", dep_method="run_hca")
-	def rank_features(self, method=score_meth.default_key) -> dict:
+	def rank_features(self, method=score_meth.default_key, *,
+			n_jobs=None, n_subsamples=0, subsample_size=200,
+			random_state=None) -> dict:
 		"""
 		rank features with label info acquired from HCA clustering
 
@@ -30,30 +32,65 @@ class AnalysisFeatureScoreRoutine(AnalysisHCARoutine):
 		feature indicies are ranked in descending order; i.e. the first element
 		is the index of the most important feature, etc.
 
+		n_jobs: number of worker processes scoring opus in parallel, for
+			methods scoring one opu at a time; None means using all cpus; in
+			subsample mode, the number of worker processes ranking subsamples
+			in parallel instead
+		n_subsamples: if positive, rank features on this many stratified
+			subsamples, each having up to <subsample_size> spectra of each opu
+			and of the rest, instead of on all spectra; the returned ranking
+			is the consensus (by mean rank) of all subsamples, and the rank
+			stability of each feature is saved in self.feature_rank_stability
+		subsample_size: spectra drawn from each opu per subsample; the cost of
+			ranking each subsample is bounded by this number
+		random_state: seed used in drawing subsamples
+
 		results are saved in self.feature_rank_index
 		"""
 		score_meth = self.score_meth.get(method)
 		self.feature_score_meth = score_meth  # save into object for later use
-		# calculate in ovr
-		ret = dict()
-		for label in self.remapped_hca_label_unique:
-			if label is None:  # do not calculate None
-				continue
-			y = numpy.equal(self.remapped_hca_label, label).astype(int)
-			ret[label] = score_meth(self.dataset.intens, y)
+		# calculate in ovr, do not calculate None
+		labels = self.remapped_hca_label_array
+		classes = [i for i in self.remapped_hca_label_unique if i is not None]
+		if n_subsamples:
+			ret, stability = score_meth.feature_rank_subsample(
+				self.dataset.intens, labels, classes, n_subsamples=n_subsamples,
+				subsample_size=subsample_size, metric=self.metric,
+				random_state=random_state, n_jobs=n_jobs)
+		else:
+			# reuse the distance matrix of hca if it is between all spectra,
+			# not between micro-clusters
+			dist = self.dist_mat
+			if (self.micro_cluster_labels is not None) or ((dist is not None)
+					and (len(dist) != self.dataset.n_spectra)):
+				dist = None
+			ret = score_meth.feature_score_ovr(self.dataset.intens, labels,
+				classes, metric=self.metric, dist=dist, n_jobs=n_jobs)
+			stability = None
 		self.feature_rank_index = ret
+		self.feature_rank_stability = stability
+		self.feature_rank_n_subsamples = n_subsamples
 		return ret
 
 	@util.with_check_data_avail(check_data_attr="feature_rank_index",
 		dep_method="rank_features")
 	def save_opu_feature_rank_table(self, f, *, delimiter="\t"):
+		"""
+		write the ranked wavenumbers of each opu in a row; if ranked on
+		subsamples, each row is followed by an OPU_xx_stability row, listing
+		the rank stability of the wavenumbers in the same order
+		"""
 		if not f:
 			return
+		stability = getattr(self, "feature_rank_stability", None)
 		with util.get_fp(f, "w") as fp:
 			for l in sorted(self.feature_rank_index.keys()):
-				rank_index = [str(self.dataset.wavenum[i])
-					for i in self.feature_rank_index[l]]
+				index = self.feature_rank_index[l]
+				rank_index = [str(self.dataset.wavenum[i]) for i in index]
 				print(delimiter.join(["OPU_%02u" % l] + rank_index), file=fp)
+				if stability is not None:
+					print(delimiter.join(["OPU_%02u_stability" % l]
+						+ ["%.4f" % i for i in stability[l][index]]), file=fp)
 		return
 
 	@util.with_check_data_avail(check_data_attr="feature_rank_index",
@@ -91,6 +128,17 @@ class AnalysisFeatureScoreRoutine(AnalysisHCARoutine):
 			ax.fill_between(X, interp_mask_y + i, 1 + i,
 				edgecolor="none", facecolor="#f0f0f8", zorder=3
 			)
+		# plot rank stability in each row, if ranked on subsamples
+		stability = getattr(self, "feature_rank_stability", None)
+		if stability is not None:
+			for i, label in enumerate(plot_opu_labels):
+				ax.plot(self.dataset.wavenum, stability[label] * 0.9 + i,
+					linewidth=0.5, color="#e41a1c", zorder=4,
+					label=("rank stability\n(%u subsamples)"
+						% self.feature_rank_n_subsamples if i == 0 else None)
+				)
+			ax.legend(loc="lower left", bbox_to_anchor=(1.0, 1.0), fontsize=6,
+				frameon=False, handlelength=1.5)
 
 		# add opu label text on the right
 		text_x = wavenum_low + (wavenum_high - wavenum_low) * 1.02
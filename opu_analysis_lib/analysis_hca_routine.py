@@ -1,21 +1,26 @@
 #!/usr/bin/env python3
 
-import sys
 import typing
 
 import matplotlib
 import matplotlib.cm
+import matplotlib.collections
 import matplotlib.colors
-import matplotlib.patches
 import matplotlib.pyplot
 import numpy
 import os
 import scipy.cluster
+import scipy.sparse
+import scipy.spatial
+import sklearn.cluster
 
 # custom lib
 import mpllayout
 
 from . import future  # import sklearn.cluster.AgglomerativeClustering here
+from . import hca_linkage
+from . import heatmap_pyramid
+from . import opu_model
 from . import registry, util
 from .analysis_dataset_routine import AnalysisDatasetRoutine
 
@@ -27,6 +32,7 @@ class AnalysisHCARoutine(AnalysisDatasetRoutine):
 	"""
 	metric_reg = registry.get("cluster_metric")
 	cutoff_opt_reg = registry.get("hca_cutoff_optimizer")
+	clustering_engine_reg = registry.get("clustering_engine")
 
 	def __init__(self, *ka, opu_colors: typing.Optional[list] = None, **kw):
 		super().__init__(*ka, **kw)
@@ -39,12 +45,15 @@ class AnalysisHCARoutine(AnalysisDatasetRoutine):
 	@property
 	@util.with_check_data_avail(check_data_attr="hca", dep_method="run_hca")
 	def cutoff(self):
+		# None if clustered by an engine other than 'hca'
+		if self.cutoff_opt is None:
+			return None
 		return self.cutoff_opt.cutoff_final
 
 	@property
 	@util.with_check_data_avail(check_data_attr="hca", dep_method="run_hca")
-	def hca_labels(self) -> int:
-		return self.hca.labels_
+	def hca_labels(self) -> numpy.ndarray:
+		return self._hca_labels
 
 	@property
 	@util.with_check_data_avail(check_data_attr="hca", dep_method="run_hca")
@@ -56,6 +65,17 @@ class AnalysisHCARoutine(AnalysisDatasetRoutine):
 	def hca_label_remap(self) -> dict:
 		return self._label_remap
 
+	@property
+	@util.with_check_data_avail(check_data_attr="hca", dep_method="run_hca")
+	def remapped_hca_label_array(self) -> numpy.ndarray:
+		"""
+		remapped opu label of each spectrum as an int array, -1 for spectra in
+		minor clusters; calculated once after clustering, see
+		remapped_hca_label
+		"""
+		return self.__get_label_cache("remapped_hca_label_array",
+			self.__remap_hca_labels)
+
 	@property
 	@util.with_check_data_avail(check_data_attr="hca", dep_method="run_hca")
 	def remapped_hca_label(self) -> list:
@@ -63,56 +83,244 @@ class AnalysisHCARoutine(AnalysisDatasetRoutine):
 		remapped_hca_label will only report clusters which have spectra
 		count more than <opu_min_size> used when calling run_hca() in addition,
 		the remapped label is also sorted in descending order by count, meaning
-		that the lower the label value, larger the cluster
+		that the lower the label value, larger the cluster; spectra in minor
+		clusters are labeled None
 		"""
-		return [self.hca_label_remap.get(i, None) for i in self.hca_labels]
+		return self.__get_label_cache("remapped_hca_label",
+			lambda: [None if i < 0 else i
+				for i in self.remapped_hca_label_array.tolist()])
 
 	@property
 	@util.with_check_data_avail(check_data_attr="hca", dep_method="run_hca")
 	def remapped_hca_label_unique(self) -> list:
-		# this sort lambda ensures that None will not raise an error and
-		# is always at the end of this array
-		# None represents the opu "label" of small clusters
-		return sorted(set(self.remapped_hca_label),
-			key=lambda x: sys.maxsize if x is None else x)
+		# None represents the opu "label" of small clusters, and is always at
+		# the end of this list
+		return list(self.opu_spectra_index.keys())
+
+	@property
+	@util.with_check_data_avail(check_data_attr="hca", dep_method="run_hca")
+	def opu_spectra_index(self) -> dict:
+		"""
+		indices of spectra in each opu, as a dict of remapped label -> sorted
+		int array, in the order of remapped_hca_label_unique; spectra in minor
+		clusters are under None if there are any; all index arrays are split
+		from a single argsort of the labels
+		"""
+		return self.__get_label_cache("opu_spectra_index",
+			self.__split_opu_spectra_index)
+
+	@property
+	@util.with_check_data_avail(check_data_attr="hca", dep_method="run_hca")
+	def linkage_matrix(self) -> typing.Optional[numpy.ndarray]:
+		# scipy-format linkage matrix, created on first access; None if
+		# clustered by an engine other than 'hca'
+		if (self._linkage_matrix is None) and (self._hca_tree is not None):
+			self._linkage_matrix = self.__calc_linkage_matrix(*self._hca_tree)
+		return self._linkage_matrix
+
+	@linkage_matrix.setter
+	def linkage_matrix(self, value):
+		self._linkage_matrix = value
+		self._leaves = None
+		return
+
+	@property
+	@util.with_check_data_avail(check_data_attr="hca", dep_method="run_hca")
+	def dendrogram(self) -> typing.Optional[dict]:
+		# scipy's dendrogram data, created on first access; building the
+		# coordinates of all links is slow for large datasets, use
+		# dendrogram_leaves if only the leaf order is needed
+		if (self._dendrogram is None) and (self.linkage_matrix is not None):
+			self._dendrogram = scipy.cluster.hierarchy.dendrogram(
+				self.linkage_matrix, orientation="right",
+				no_plot=True
+			)
+		return self._dendrogram
+
+	@dendrogram.setter
+	def dendrogram(self, value):
+		self._dendrogram = value
+		return
+
+	@property
+	@util.with_check_data_avail(check_data_attr="hca", dep_method="run_hca")
+	def dendrogram_leaves(self) -> typing.Optional[numpy.ndarray]:
+		# the leaf order of the dendrogram, without creating the dendrogram
+		if self._dendrogram is not None:
+			return numpy.asarray(self._dendrogram["leaves"])
+		if (self._leaves is None) and (self.linkage_matrix is not None):
+			self._leaves = scipy.cluster.hierarchy.leaves_list(
+				self.linkage_matrix)
+		return self._leaves
 
 	def run_hca(self, *, metric=metric_reg.default_key, cutoff=0.7,
 			linkage="average", max_n_opus=0,
-			opu_min_size: typing.Union[str, int, float, None] = None):
+			opu_min_size: typing.Union[str, int, float, None] = None,
+			cutoff_opt_params: typing.Optional[dict] = None,
+			n_micro_clusters: int = 0, random_state=None, n_neighbors: int = 0):
+		"""
+		run the hca and find the opus
+
+		n_micro_clusters: if non-zero, first compress the spectra into up to
+			this many micro-clusters by mini-batch k-means, then run the hca on
+			micro-cluster centroids, each weighted by its number of spectra;
+			the labels are propagated back to every spectrum; this avoids the
+			all-pairs distance matrix of spectra, and only supports 'average'
+			linkage
+		linkage: 'average', 'complete', 'single' or 'ward'; 'ward' requires
+			'euclidean' metric, and is calculated on the fly from spectra
+			without the all-pairs distance matrix
+		random_state: seed used by micro-clustering
+		n_neighbors: if non-zero, only allow merging clusters connected in the
+			k-nearest-neighbor graph of spectra with k=n_neighbors; the graph
+			is built blockwise and only distances along its edges are kept,
+			memory use is linear in the number of spectra; only supports
+			'average' linkage
+		"""
 		# create the hca object
+		# cutoff_opt_params are passed to the cutoff optimizer, e.g. the
+		# sample_size of 'silhouette' or the n_refs of 'gap'
+		if cutoff_opt_params is None:
+			cutoff_opt_params = dict()
+		self.metric_key = metric
 		self.metric = self.metric_reg.get(metric)
-		self.cutoff_opt = self.cutoff_opt_reg.get(cutoff)
+		self.cutoff_opt = self.cutoff_opt_reg.get(cutoff, **cutoff_opt_params)
 		self.cutoff_pend = cutoff
 		self.linkage = linkage
 		self.max_n_opus = max_n_opus
 		self.__parse_and_store_opu_min_size(opu_min_size)
-		self.hca = future.sklearn_cluster_AgglomerativeClustering(
-			linkage=self.linkage, metric="precomputed",
-			# metric="precomputed" as we manually compute the distance matrix
-			# note that old scikit-learn library (pre 23.0.0) uses 'affinity'
-			# using 'metric' keyword here will raise an error
-			distance_threshold=0, n_clusters=None
-			# distance_threshold=0 is a placeholer, it will be replaced by
-			# cutoff_opt.cutoff_final when optimization is finished
-		)
-		# calculate distance matrix
-		self.dist_mat = self.metric(self.dataset.intens)
+		if n_micro_clusters and n_neighbors:
+			raise ValueError("n_micro_clusters and n_neighbors cannot be used "
+				"together")
+		self.micro_cluster_labels = None
+		if (n_micro_clusters or n_neighbors) and (self.linkage != "average"):
+			raise ValueError("n_micro_clusters and n_neighbors only support "
+				"'average' linkage, got '%s'" % self.linkage)
+		if n_micro_clusters:
+			self.micro_cluster_labels, fit_data, sample_weight = \
+				self.__run_micro_clustering(n_micro_clusters, random_state)
+			self.hca = hca_linkage.WeightedAverageAgglomerative(
+				sample_weight=sample_weight, distance_threshold=0)
+		elif n_neighbors:
+			fit_data, sample_weight = self.dataset.intens, None
+			connectivity = hca_linkage.KNNConnectivity(n_neighbors,
+				self.metric)
+			self.hca = hca_linkage.KNNAverageAgglomerative(
+				connectivity=connectivity, distance_threshold=0)
+		elif self.linkage == "ward":
+			if metric != "euclidean":
+				raise ValueError("'ward' linkage requires 'euclidean' metric, "
+					"got '%s'" % metric)
+			fit_data, sample_weight = self.dataset.intens, None
+			self.hca = hca_linkage.WardAgglomerative(
+				tree_cache=hca_linkage.TreeCache(), distance_threshold=0)
+		else:
+			fit_data, sample_weight = self.dataset.intens, None
+			self.hca = future.sklearn_cluster_AgglomerativeClustering(
+				linkage=self.linkage, metric="precomputed",
+				# metric="precomputed" as we manually compute the distance matrix
+				# note that old scikit-learn library (pre 23.0.0) uses 'affinity'
+				# using 'metric' keyword here will raise an error
+				distance_threshold=0, n_clusters=None
+				# distance_threshold=0 is a placeholer, it will be replaced by
+				# cutoff_opt.cutoff_final when optimization is finished
+			)
+		if n_neighbors:
+			# distances are only calculated along the knn graph edges
+			self.dist_mat = None
+			fit_input = fit_data
+			connectivity(fit_input)  # build and cache the graph
+			dist_range = (connectivity.dist_min_, connectivity.dist_max_)
+		elif self.linkage == "ward":
+			# the model calculates distances from spectra on the fly; the
+			# full tree is built and cached here to find the range of cutoffs
+			self.dist_mat = None
+			fit_input = fit_data
+			self.hca.fit(fit_input)
+			dist_range = (0, self.hca.distances_.max())
+		else:
+			# calculate distance matrix
+			# in micro-clustering mode, this is between micro-cluster centroids
+			self.dist_mat = self.metric(fit_data)
+			fit_input = self.dist_mat
+			dist_range = (self.dist_mat.min(), self.dist_mat.max())
 		# find the cutoff
-		cutoff_final = self.__optimize_cutoff(n_step=100)
+		cutoff_final = self.__optimize_cutoff(fit_data, fit_input,
+			dist_range=dist_range, sample_weight=sample_weight, n_step=100)
 		# calculate clusters, using sklearn's backend
 		self.hca.set_params(distance_threshold=cutoff_final)
-		self.hca.fit(self.dist_mat)
-		# calculate linkage matrix
-		self.linkage_matrix = self.__calc_linkage_matrix(self.hca)
-		# make dendrogram using scipy's backend
-		self.dendrogram = scipy.cluster.hierarchy.dendrogram(
-			self.linkage_matrix, orientation="right",
-			no_plot=True
-		)
+		self.hca.fit(fit_input)
+		if self.micro_cluster_labels is None:
+			self._hca_labels = self.hca.labels_
+		else:
+			self._hca_labels = self.hca.labels_[self.micro_cluster_labels]
+		# the linkage matrix and dendrogram are created on demand
+		self._hca_tree = (self.hca.children_, self.hca.distances_)
+		self.linkage_matrix = None
+		self.dendrogram = None
 		# sort opu labels
-		self.__sort_and_filter_cluster_labels(self.hca.labels_)
+		self.__sort_and_filter_cluster_labels(self.hca_labels)
 		return self
 
+	def run_clustering(self, *, engine="hca", metric=metric_reg.default_key,
+			max_n_opus=0,
+			opu_min_size: typing.Union[str, int, float, None] = None,
+			engine_params: typing.Optional[dict] = None, **kw):
+		"""
+		find the opus using a clustering engine; 'hca' calls run_hca() with
+		all other keyword arguments; other engines are from
+		clustering_engine_reg, initialized with <engine_params>; they label
+		spectra without the all-pairs distance matrix, and do not create the
+		dendrogram, hence plot_opu_hca() is not available
+		"""
+		if engine == "hca":
+			return self.run_hca(metric=metric, max_n_opus=max_n_opus,
+				opu_min_size=opu_min_size, **kw)
+		if kw:
+			raise TypeError("unexpected arguments for clustering engine '%s': "
+				"%s" % (engine, ", ".join(kw)))
+		if engine_params is None:
+			engine_params = dict()
+		self.metric_key = metric
+		self.metric = self.metric_reg.get(metric)
+		self.hca = self.clustering_engine_reg.get(engine, **engine_params)
+		self.max_n_opus = max_n_opus
+		self.__parse_and_store_opu_min_size(opu_min_size)
+		# hca-only results
+		self.cutoff_opt = None
+		self.linkage = None
+		self.micro_cluster_labels = None
+		self.dist_mat = None
+		self._hca_tree = None
+		self.linkage_matrix = None
+		self.dendrogram = None
+		self._hca_labels = self.hca.cluster(self.dataset.intens, self.metric)
+		self.__sort_and_filter_cluster_labels(self.hca_labels)
+		return self
+
+	@property
+	@util.with_check_data_avail(check_data_attr="hca", dep_method="run_hca")
+	def biosample_cluster_counts(self) -> numpy.ndarray:
+		"""
+		number of spectra in each raw hca cluster (columns) of each biosample
+		(rows, in the order of biosample_unique), n_biosample * n_clusters;
+		counted once after clustering
+		"""
+		return self.__get_label_cache("biosample_cluster_counts",
+			self.__count_biosample_clusters)
+
+	@property
+	@util.with_check_data_avail(check_data_attr="hca", dep_method="run_hca")
+	def biosample_opu_counts(self) -> numpy.ndarray:
+		"""
+		number of spectra in each opu of each biosample, derived from
+		biosample_cluster_counts; columns follow remapped_hca_label_unique,
+		i.e. opus in order, then all minor clusters grouped in the last column
+		if there is any spectrum in minor clusters
+		"""
+		return self.__get_label_cache("biosample_opu_counts",
+			self.__count_biosample_opus)
+
 	@util.with_check_data_avail(check_data_attr="hca", dep_method="run_hca")
 	def count_biosample_hca_labels(self) -> dict:
 		"""
@@ -120,9 +328,11 @@ class AnalysisHCARoutine(AnalysisDatasetRoutine):
 		of counters; the keys are biosample names
 		"""
 		ret = dict()
-		biosample = numpy.asarray(self.biosample, dtype=object)
-		for s in self.biosample_unique:
-			ret[s] = future.Counter(self.hca_labels[biosample == s])
+		for s, row in zip(self.biosample_unique,
+				self.biosample_cluster_counts):
+			label = numpy.flatnonzero(row)
+			ret[s] = future.Counter(dict(zip(label.tolist(),
+				row[label].tolist())))
 		return ret
 
 	@util.with_check_data_avail(check_data_attr="hca", dep_method="run_hca")
@@ -149,19 +359,146 @@ class AnalysisHCARoutine(AnalysisDatasetRoutine):
 		else:
 			fn_pattern = ".OPU_%02u.txt"
 		# create one file for each opu
-		for label in self.remapped_hca_label_unique:
+		for label, index in self.opu_spectra_index.items():
 			if label is not None:
-				mask = numpy.equal(self.remapped_hca_label, label)
 				file_name = prefix + (fn_pattern % label)
-				self.dataset.get_sub_dataset(mask).save_file(file_name,
+				self.dataset.get_sub_dataset(index).save_file(file_name,
 					delimiter=delimiter, with_spectra_names=with_spectra_names
 				)
 		return
 
 	@util.with_check_data_avail(check_data_attr="hca", dep_method="run_hca")
-	def plot_opu_hca(self, *, plot_to="show", dpi=300):
+	def save_opu_model(self, f, *, reference="both", n_representatives=5):
+		"""
+		export the opus as an OPUModel file, which can assign new spectra to
+		these opus without rerunning the clustering; see
+		OPUModel.from_analysis() for the arguments
+		"""
+		if not f:
+			return
+		opu_model.OPUModel.from_analysis(self, reference=reference,
+			n_representatives=n_representatives).save(f)
+		return
+
+	# format of saved hca states
+	hca_state_format_version = 1
+
+	@util.with_check_data_avail(check_data_attr="hca", dep_method="run_hca")
+	def save_hca_state(self, f, *, with_dist=False):
+		"""
+		save the products of run_hca() or run_clustering() into a compressed
+		numpy .npz file, including the raw labels, label remap, cutoff,
+		linkage matrix and dendrogram (if created); if with_dist is True, also
+		save the condensed distance matrix (if available) so that
+		plot_opu_hca() does not recompute it; the fitted model itself is not
+		saved
+
+		see load_hca_state()
+		"""
+		if not f:
+			return
+		state = dict(
+			format="hca_state",
+			format_version=self.hca_state_format_version,
+			spectra_names=numpy.asarray(self.dataset.spectra_names, dtype=str),
+			metric=self.metric_key,
+			linkage="" if self.linkage is None else self.linkage,
+			max_n_opus=self.max_n_opus,
+			opu_min_size=self.opu_min_size,
+			hca_labels=self.hca_labels,
+			label_remap=numpy.asarray(list(self.hca_label_remap.items()),
+				dtype=int).reshape(-1, 2),
+		)
+		if self.cutoff_opt is not None:
+			# a float cutoff is saved as a number, otherwise the optimizer key
+			state["cutoff_pend"] = self.cutoff_pend
+			state["cutoff_final"] = self.cutoff_opt.cutoff_final
+		if self.micro_cluster_labels is not None:
+			state["micro_cluster_labels"] = self.micro_cluster_labels
+		if self.linkage_matrix is not None:
+			state["linkage_matrix"] = self.linkage_matrix
+		if self._dendrogram is not None:
+			# only saved if already created, e.g. by plot_opu_hca(); otherwise
+			# it is recreated from the linkage matrix after loading
+			for k, v in self._dendrogram.items():
+				state["dendrogram_" + k] = numpy.asarray(v)
+		if with_dist and (self.dist_mat is not None):
+			state["dist_condensed"] = scipy.spatial.distance.squareform(
+				self.dist_mat, checks=False)
+		with util.get_fp(f, "wb") as fp:
+			numpy.savez_compressed(fp, **state)
+		return
+
+	def load_hca_state(self, f):
+		"""
+		load the products of run_hca() or run_clustering() saved by
+		save_hca_state(), in replace of calling them; the dataset must be the
+		same as the one used when saving
+		"""
+		with numpy.load(f, allow_pickle=False) as npz:
+			state = {k: npz[k] for k in npz.files}
+		if (state.get("format") != "hca_state") or (state["format_version"]
+				!= self.hca_state_format_version):
+			raise ValueError("not a supported hca state file")
+		if (len(state["spectra_names"]) != self.dataset.n_spectra) or \
+				(state["spectra_names"] != numpy.asarray(
+					self.dataset.spectra_names, dtype=str)).any():
+			raise ValueError("spectra in the hca state file do not match the "
+				"dataset")
+		self.metric_key = str(state["metric"])
+		self.metric = self.metric_reg.get(self.metric_key)
+		self.linkage = str(state["linkage"]) or None
+		self.max_n_opus = int(state["max_n_opus"])
+		self.opu_min_size = int(state["opu_min_size"])
+		if "cutoff_pend" in state:
+			cutoff_pend = state["cutoff_pend"].item()
+			self.cutoff_pend = cutoff_pend
+			self.cutoff_opt = self.cutoff_opt_reg.get(cutoff_pend)
+			self.cutoff_opt.cutoff_final = state["cutoff_final"].item()
+		else:
+			self.cutoff_pend = None
+			self.cutoff_opt = None
+		self.micro_cluster_labels = state.get("micro_cluster_labels")
+		self._hca_tree = None
+		self.linkage_matrix = state.get("linkage_matrix")
+		if "dendrogram_leaves" in state:
+			self.dendrogram = {k[len("dendrogram_"):]: v.tolist()
+				for k, v in state.items() if k.startswith("dendrogram_")}
+		else:
+			self.dendrogram = None
+		if "dist_condensed" in state:
+			self.dist_mat = scipy.spatial.distance.squareform(
+				state["dist_condensed"])
+		else:
+			self.dist_mat = None
+		self._hca_labels = state["hca_labels"]
+		self._label_remap = {int(k): int(v) for k, v in state["label_remap"]}
+		self._label_cache = dict()
+		# the fitted model is not saved
+		self.hca = None
+		return self
+
+	@util.with_check_data_avail(check_data_attr="hca", dep_method="run_hca")
+	def plot_opu_hca(self, *, plot_to="show", dpi=300, heatmap_reduce="mean",
+			tile_size=256, n_jobs=None):
+		"""
+		plot the heatmap, dendrogram and opu/biosample bars; the heatmap is
+		downsampled to the figure resolution by the mean or max of each block
+		of spectra pairs, as set by <heatmap_reduce>
+
+		if <plot_to> ends with '.dzi', export the full-resolution heatmap with
+		the opu/biosample bars as a deep zoom tile pyramid instead, see
+		heatmap_pyramid.DeepZoomPyramid for <tile_size> and <n_jobs>
+		"""
 		if plot_to is None:
 			return
+		if self.linkage_matrix is None:
+			raise ValueError("plot_opu_hca() requires the 'hca' clustering "
+				"engine")
+		if isinstance(plot_to, str) and plot_to.endswith(".dzi"):
+			self.__save_heatmap_tiles(plot_to, tile_size=tile_size,
+				n_jobs=n_jobs)
+			return
 		# create figure layout
 		layout = self.__create_layout()
 		figure = layout["figure"]
@@ -169,7 +506,7 @@ class AnalysisHCARoutine(AnalysisDatasetRoutine):
 
 		# plot heatmap
 		ax = layout["heatmap"]
-		self.__plot_heatmap(ax, layout["colorbar"])
+		self.__plot_heatmap(ax, layout["colorbar"], reduce=heatmap_reduce)
 
 		# plot dendrogram
 		ax = layout["dendro"]
@@ -247,43 +584,98 @@ class AnalysisHCARoutine(AnalysisDatasetRoutine):
 		self.opu_min_size = ret
 		return ret
 
+	def __run_micro_clustering(self, n_micro_clusters, random_state) -> tuple:
+		# compress spectra into micro-clusters by mini-batch k-means; empty
+		# clusters are dropped and centroids are recalculated as the mean of
+		# member spectra; returns (labels, centroids, sizes)
+		intens = self.dataset.intens
+		km = sklearn.cluster.MiniBatchKMeans(n_init=1,
+			n_clusters=min(n_micro_clusters, self.dataset.n_spectra),
+			random_state=random_state)
+		labels = numpy.unique(km.fit_predict(intens), return_inverse=True)[1]
+		sizes = numpy.bincount(labels)
+		membership = scipy.sparse.csr_matrix((numpy.ones(len(labels)),
+			(labels, numpy.arange(len(labels)))))
+		centroids = (membership @ intens) / sizes.reshape(-1, 1)
+		return labels, centroids, sizes
+
 	@staticmethod
-	def __calc_linkage_matrix(hca):
-		# this function is adapted from:
+	def __calc_linkage_matrix(children, distances):
+		# same as the linkage matrix in:
 		# 'https://scikit-learn.org/stable/auto_examples/cluster/plot_agglomerative_dendrogram.html' as of version 1.1.1
-		# create the counts of samples under each node
-		counts = numpy.zeros(hca.children_.shape[0])
-		n_samples = len(hca.labels_)
-		for i, merge in enumerate(hca.children_):
-			current_count = 0
-			for child_idx in merge:
-				if child_idx < n_samples:
-					current_count += 1  # leaf node
-				else:
-					current_count += counts[child_idx - n_samples]
-			counts[i] = current_count
-
+		# but the counts of samples under each node are accumulated at once
+		counts = hca_linkage.subtree_sizes(children, len(children) + 1)
 		linkage_matrix = numpy.column_stack(
-			[hca.children_, hca.distances_, counts]
+			[children, distances, counts]
 		).astype(float)
 		return linkage_matrix
 
-	def __optimize_cutoff(self, n_step=100) -> float:
+	def __optimize_cutoff(self, data, fit_input, *, dist_range,
+			sample_weight=None, n_step=100) -> float:
 		# in usual cases, this should only be called by self.run_hca()
-		cutoff_list = numpy.linspace(
-			self.dist_mat.min(),
-			self.dist_mat.max(),
-			n_step
-		)
+		# fit_input is what self.hca.fit() takes, i.e. the distance matrix or
+		# the data itself when distances are computed by the model
+		cutoff_list = numpy.linspace(*dist_range, n_step)
 		self.cutoff_opt.optimize(
 			model=self.hca,
-			data=self.dataset.intens,
-			dist=self.dist_mat,
+			data=data,
+			dist=fit_input,
 			cutoff_list=cutoff_list,
-			cutoff_pend=self.cutoff_pend
+			cutoff_pend=self.cutoff_pend,
+			metric=self.metric,
+			sample_weight=sample_weight,
 		)
 		return self.cutoff_opt.cutoff_final
 
+	def __get_label_cache(self, key, calc):
+		# values derived from cluster labels, calculated on first access and
+		# cleared whenever the labels change
+		if key not in self._label_cache:
+			self._label_cache[key] = calc()
+		return self._label_cache[key]
+
+	def __get_cluster_opu_lut(self) -> numpy.ndarray:
+		# remapped opu label of each raw cluster, -1 for minor clusters
+		ret = numpy.full(self.n_clusters, -1)
+		ret[list(self.hca_label_remap.keys())] = \
+			list(self.hca_label_remap.values())
+		return ret
+
+	def __remap_hca_labels(self) -> numpy.ndarray:
+		return self.__get_cluster_opu_lut()[self.hca_labels]
+
+	def __split_opu_spectra_index(self) -> dict:
+		labels = self.remapped_hca_label_array
+		order = numpy.argsort(labels, kind="stable")
+		# labels in order are -1 (minor), 0, 1, ...; split at the first
+		# occurrence of each
+		bounds = numpy.searchsorted(labels[order],
+			numpy.arange(-1, len(self.hca_label_remap) + 1))
+		ret = {l: order[bounds[l + 1]:bounds[l + 2]]
+			for l in range(len(self.hca_label_remap))}
+		if bounds[1] > 0:
+			ret[None] = order[:bounds[1]]
+		return ret
+
+	def __count_biosample_clusters(self) -> numpy.ndarray:
+		# count (biosample, cluster) pairs in one bincount over flat indices
+		n_clusters = self.n_clusters
+		counts = numpy.bincount(self.biosample_codes * n_clusters
+			+ self.hca_labels, minlength=self.n_biosample * n_clusters)
+		return counts.reshape(self.n_biosample, n_clusters)
+
+	def __count_biosample_opus(self) -> numpy.ndarray:
+		cluster_counts = self.biosample_cluster_counts
+		n_opus = len(self.hca_label_remap)
+		# column of each raw cluster, minor clusters to the last column
+		column = self.__get_cluster_opu_lut()
+		column[column < 0] = n_opus
+		ret = numpy.zeros((len(cluster_counts), n_opus + 1), dtype=int)
+		numpy.add.at(ret, (slice(None), column), cluster_counts)
+		if not ret[:, -1].any():
+			ret = ret[:, :-1]
+		return ret
+
 	def __sort_and_filter_cluster_labels(self, hca_labels) -> None:
 		# two logics implemented here:
 		# (1) sort the opu labels based on their size in descensing order
@@ -308,6 +700,7 @@ class AnalysisHCARoutine(AnalysisDatasetRoutine):
 				"value of min_opu_size")
 
 		self._label_remap = label_remap
+		self._label_cache = dict()
 
 		return
 
@@ -391,79 +784,220 @@ class AnalysisHCARoutine(AnalysisDatasetRoutine):
 
 		return layout
 
-	def __plot_heatmap(self, heatmap_axes, colorbar_axes) -> dict:
+	def __get_spectra_leaves(self) -> numpy.ndarray:
+		# indices of spectra in the dendrogram order; in micro-clustering
+		# mode, spectra are grouped by their micro-clusters
+		leaves = self.dendrogram_leaves
+		if self.micro_cluster_labels is None:
+			return leaves
+		leaf_rank = numpy.empty(len(leaves), dtype=int)
+		leaf_rank[leaves] = numpy.arange(len(leaves))
+		return numpy.argsort(leaf_rank[self.micro_cluster_labels],
+			kind="stable")
+
+	def __get_leaf_edges(self) -> numpy.ndarray:
+		# the boundaries of each dendrogram leaf along the spectra axis; each
+		# micro-cluster spans the number of its spectra
+		leaves = self.dendrogram_leaves
+		if self.micro_cluster_labels is None:
+			sizes = numpy.ones(len(leaves), dtype=int)
+		else:
+			sizes = numpy.bincount(self.micro_cluster_labels)[leaves]
+		return numpy.concatenate([[0], numpy.cumsum(sizes)])
+
+	def __calc_heatmap_image(self, n_pixels: int, reduce="mean", *,
+			block_size=2 ** 24) -> tuple:
+		# the heatmap of spectra in dendrogram order, downsampled to at most
+		# n_pixels * n_pixels by the block mean or max; rows are calculated in
+		# chunks of about <block_size> values, so that the reordered n * n
+		# matrix is never created; returns the image and the min/max of the
+		# full-resolution data
+		if reduce not in ("mean", "max"):
+			raise ValueError("reduce must be 'mean' or 'max', got '%s'"
+				% reduce)
+		n = self.dataset.n_spectra
+		spectra_leaves = self.__get_spectra_leaves()
+		if self.dist_mat is None:
+			# the distance matrix is not kept in knn-connectivity or ward mode,
+			# or after load_hca_state(); calculate it from spectra
+			rows = spectra_leaves
+		elif self.micro_cluster_labels is None:
+			rows = spectra_leaves
+		else:
+			# the distance matrix is between micro-clusters
+			rows = self.micro_cluster_labels[spectra_leaves]
+		n_blocks = min(n, n_pixels)
+		bins = numpy.linspace(0, n, n_blocks + 1).round().astype(int)
+		# split the spectra axis into segments of consecutive spectra sharing
+		# the same row in the data and the same block; a micro-cluster is one
+		# segment unless it spans multiple blocks
+		bounds = numpy.union1d(bins, numpy.flatnonzero(numpy.diff(rows)) + 1)
+		seg_rows = rows[bounds[:-1]]
+		seg_sizes = numpy.diff(bounds)
+		block_starts = numpy.searchsorted(bounds, bins)
+		if self.dist_mat is None:
+			intens = self.dataset.intens[seg_rows]
+
+			def get_rows(start, stop):
+				return self.metric(intens[start:stop], intens)
+		else:
+			def get_rows(start, stop):
+				return self.dist_mat[numpy.ix_(seg_rows[start:stop], seg_rows)]
+
+		ufunc = numpy.add if reduce == "mean" else numpy.maximum
+		image = numpy.empty((n_blocks, n_blocks), dtype=float)
+		data_min, data_max = numpy.inf, -numpy.inf
+		rows_per_chunk = max(1, block_size // len(seg_rows))
+		b_start = 0
+		while b_start < n_blocks:
+			b_stop = numpy.searchsorted(block_starts,
+				block_starts[b_start] + rows_per_chunk, side="right") - 1
+			b_stop = min(max(b_stop, b_start + 1), n_blocks)
+			s_start, s_stop = block_starts[b_start], block_starts[b_stop]
+			data = self.metric.to_plot_data(get_rows(s_start, s_stop))
+			data_min = min(data_min, data.min())
+			data_max = max(data_max, data.max())
+			if reduce == "mean":
+				data = data * seg_sizes[s_start:s_stop, None]
+				data *= seg_sizes
+			data = ufunc.reduceat(data, block_starts[b_start:b_stop] - s_start,
+				axis=0)
+			image[b_start:b_stop] = ufunc.reduceat(data, block_starts[:-1],
+				axis=1)
+			b_start = b_stop
+		if reduce == "mean":
+			sizes = numpy.diff(bins)
+			image /= numpy.outer(sizes, sizes)
+		return image, data_min, data_max
+
+	def __plot_heatmap(self, heatmap_axes, colorbar_axes, *,
+			reduce="mean") -> dict:
 		# heatmap
 		ax = heatmap_axes
-		heatmap_data = self.metric.to_plot_data(self.dist_mat)
-		pcolor = ax.pcolor(heatmap_data[numpy.ix_(self.dendrogram["leaves"],
-			self.dendrogram["leaves"])], cmap=self.metric.cmap,
-			vmin=self.metric.vmin, vmax=self.metric.vmax)
+		# rendered as an image no larger than the axes in pixels
+		bbox = ax.get_window_extent()
+		n_pixels = int(numpy.ceil(max(bbox.width, bbox.height)))
+		image, data_min, data_max = self.__calc_heatmap_image(n_pixels,
+			reduce=reduce)
+		vmin = data_min if self.metric.vmin is None else self.metric.vmin
+		vmax = data_max if self.metric.vmax is None else self.metric.vmax
+		n = self.dataset.n_spectra
+		heatmap = ax.imshow(image, cmap=self.metric.cmap, vmin=vmin,
+			vmax=vmax, extent=(0, n, 0, n), origin="lower", aspect="auto",
+			interpolation="nearest")
 		#
-		ax.set_xlim(0, self.dataset.n_spectra)
-		ax.set_ylim(0, self.dataset.n_spectra)
+		ax.set_xlim(0, n)
+		ax.set_ylim(0, n)
 
 		# colorbar
 		ax = colorbar_axes
-		cbar = colorbar_axes.figure.colorbar(pcolor, cax=ax,
+		cbar = colorbar_axes.figure.colorbar(heatmap, cax=ax,
 			ticklocation="bottom", orientation="horizontal")
 		# misc
 		cbar.outline.set_visible(False)
 		cbar.set_label(self.metric.name_str, fontsize=14)
 
-		ret = dict(heatmap=pcolor, colorbar=cbar)
+		ret = dict(heatmap=heatmap, colorbar=cbar)
 		return ret
 
+	def __save_heatmap_tiles(self, f, *, tile_size=256, n_jobs=None,
+			n_sample_rows=256):
+		# full-resolution heatmap as a deep zoom tile pyramid; the color scale
+		# of metrics without fixed vmin/vmax is taken from the distance matrix,
+		# or estimated from <n_sample_rows> evenly spaced spectra if it is not
+		# kept
+		spectra_leaves = self.__get_spectra_leaves()
+		if self.dist_mat is None:
+			data, rows = self.dataset.intens, spectra_leaves
+			sample = numpy.linspace(0, self.dataset.n_spectra - 1,
+				min(n_sample_rows, self.dataset.n_spectra)).round().astype(int)
+			dist_sample = self.metric(data[sample], data)
+		else:
+			data = self.dist_mat
+			rows = spectra_leaves if self.micro_cluster_labels is None \
+				else self.micro_cluster_labels[spectra_leaves]
+			dist_sample = self.dist_mat
+		vmin, vmax = self.metric.vmin, self.metric.vmax
+		if (vmin is None) or (vmax is None):
+			plot_data = self.metric.to_plot_data(dist_sample)
+			vmin = plot_data.min() if vmin is None else vmin
+			vmax = plot_data.max() if vmax is None else vmax
+		source = heatmap_pyramid.HeatmapTileSource(data=data, rows=rows,
+			metric=self.metric, precomputed=self.dist_mat is not None,
+			bar_colors=[self.__colors_to_rgba(self.__get_cluster_bar_colors()),
+				self.__colors_to_rgba(self.__get_biosample_bar_colors())],
+			bar_width=max(4, round(self.dataset.n_spectra * 0.02)),
+			vmin=vmin, vmax=vmax)
+		heatmap_pyramid.DeepZoomPyramid(tile_size=tile_size, n_jobs=n_jobs) \
+			.save(f, source)
+		return
+
 	def __dendro_get_adjusted_dmax(self, dmax, i2d_ratio) -> float:
 		return dmax / (1 - 1 / (2 * self.dataset.n_spectra * i2d_ratio))
 
-	def __plot_dendrogram(self, ax, *, i2d_ratio: float) -> list:
-		lines = list()  # the return list containing all lines drawn
-		for xys in zip(self.dendrogram["dcoord"], self.dendrogram["icoord"]):
-			line = matplotlib.lines.Line2D(*xys, linestyle="-",
-				linewidth=1.0, color="#4040ff", zorder=3)
-			ax.add_line(line)
-			lines.append(line)
+	def __plot_dendrogram(self, ax, *, i2d_ratio: float) \
+			-> matplotlib.collections.LineCollection:
+		# scipy places the i-th leaf at 10 * i + 5; move leaves to the center
+		# of their edges, which only differs in micro-clustering mode
+		edges = self.__get_leaf_edges() * 10
+		icoord = numpy.interp(self.dendrogram["icoord"],
+			numpy.arange(len(edges) - 1) * 10 + 5, (edges[:-1] + edges[1:]) / 2)
+		dcoord = numpy.asarray(self.dendrogram["dcoord"])
+		# all links are drawn as a single artist
+		lines = matplotlib.collections.LineCollection(
+			numpy.stack([dcoord, icoord], axis=-1), linestyle="-",
+			linewidth=1.0, color="#4040ff", zorder=3)
+		ax.add_collection(lines)
 		# misc
 		ax.grid(axis="x", linestyle="-", linewidth=1.0, color="#ffffff",
 			zorder=2)
 		ax.set_xlim(0, self.__dendro_get_adjusted_dmax(
-			dmax=numpy.max(self.dendrogram["dcoord"]),
-			i2d_ratio=i2d_ratio)
+			dmax=dcoord.max(), i2d_ratio=i2d_ratio)
 		)
 		ax.set_ylim(0, 10 * self.dataset.n_spectra)
 
 		return lines
 
-	def __plot_hca_cluster_bar(self, ax):
-		remapped_hca_label = self.remapped_hca_label
+	@staticmethod
+	def __colors_to_rgba(colors: list) -> numpy.ndarray:
+		# converting each distinct color only once
+		color_index = {c: i for i, c in enumerate(dict.fromkeys(colors))}
+		return matplotlib.colors.to_rgba_array(list(color_index))[
+			[color_index[c] for c in colors]]
+
+	def __get_cluster_bar_colors(self) -> list:
+		# opu colors of spectra in dendrogram order
 		color_list = self.cluster_colors
-		for i, leaf in enumerate(self.dendrogram["leaves"]):
-			label = remapped_hca_label[leaf]
-			facecolor = "#ffffff" if label is None else color_list[label]
-			patch = matplotlib.patches.Rectangle((0, i), 1, 1,
-				edgecolor="none", facecolor=facecolor
-			)
-			ax.add_patch(patch)
+		return ["#ffffff" if label < 0 else color_list[label] for label in
+			self.remapped_hca_label_array[self.__get_spectra_leaves()].tolist()]
+
+	def __get_biosample_bar_colors(self) -> list:
+		return [self.biosample_color[leaf]
+			for leaf in self.__get_spectra_leaves()]
+
+	def __plot_color_strip(self, ax, colors: list):
+		# draw a vertical strip, the i-th spectrum in dendrogram order spans
+		# [i, i + 1) and has colors[i]; drawn as a single image
+		rgba = self.__colors_to_rgba(colors)
+		n = self.dataset.n_spectra
+		ax.imshow(rgba.reshape(n, 1, 4), extent=(0, 1, 0, n), origin="lower",
+			aspect="auto", interpolation="nearest")
+		ax.set_xlim(0, 1)
+		ax.set_ylim(0, n)
+		return
+
+	def __plot_hca_cluster_bar(self, ax):
+		self.__plot_color_strip(ax, self.__get_cluster_bar_colors())
 		# add label
 		ax.text(0.5, 0.0, "OPU ", fontsize=12, rotation=90,
 			horizontalalignment="center", verticalalignment="top"
 		)
-
-		ax.set_xlim(0, 1)
-		ax.set_ylim(0, self.dataset.n_spectra)
 		return
 
 	def __plot_hca_biosample_bar(self, ax):
-		for i, leaf in enumerate(self.dendrogram["leaves"]):
-			patch = matplotlib.patches.Rectangle((0, i), 1, 1,
-				edgecolor="none", facecolor=self.biosample_color[leaf]
-			)
-			ax.add_patch(patch)
-			# add label
-			ax.text(0.5, 0.0, "biosample ", fontsize=12, rotation=90,
-				horizontalalignment="center", verticalalignment="top"
-			)
-
-		ax.set_xlim(0, 1)
-		ax.set_ylim(0, self.dataset.n_spectra)
+		self.__plot_color_strip(ax, self.__get_biosample_bar_colors())
+		# add label
+		ax.text(0.5, 0.0, "biosample ", fontsize=12, rotation=90,
+			horizontalalignment="center", verticalalignment="top"
+		)
 		return
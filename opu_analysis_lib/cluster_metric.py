@@ -1,20 +1,55 @@
 #!/usr/bin/env python3
 
 import abc
-import functools
+import typing
 
 import numpy
-import sklearn.metrics
 
 # custom lib
 from . import registry
 
 
+def _gram_and_sq_norm(X) -> tuple:
+	# gram matrix X @ X.T and squared norms of spectra X, from which metrics
+	# derive their distance matrices by elementwise transforms
+	data = numpy.asarray(X, dtype=float)
+	gram = data @ data.T
+	return gram, gram.diagonal().copy()
+
+
+def _cosine_from_gram(gram, sq_norm, *, out) -> numpy.ndarray:
+	# same as sklearn.metrics.pairwise.cosine_distances(X), zero vectors have
+	# 0 similarity to all others
+	norm = numpy.sqrt(sq_norm)
+	inv_norm = numpy.divide(1, norm, out=numpy.zeros_like(norm),
+		where=norm > 0)
+	numpy.multiply(gram, inv_norm[:, None], out=out)
+	out *= inv_norm[None, :]
+	numpy.subtract(1, out, out=out)
+	numpy.clip(out, 0, 2, out=out)
+	numpy.fill_diagonal(out, 0)
+	return out
+
+
 class ClusterMetric(abc.ABC):
 	@abc.abstractmethod
 	def __call__(self, X, Y=None, *ka, **kw) -> numpy.ndarray:
 		pass
 
+	def gram_to_dist(self, gram, sq_norm, *, out) -> numpy.ndarray:
+		"""
+		derive the distance matrix from the gram matrix and squared norms of
+		spectra by elementwise transforms written to <out>, which can be the
+		gram matrix itself; metrics not supporting this raise
+		NotImplementedError
+		"""
+		raise NotImplementedError
+
+	def _dist_from_gram(self, X) -> numpy.ndarray:
+		# the fresh gram matrix is transformed in place
+		gram, sq_norm = _gram_and_sq_norm(X)
+		return self.gram_to_dist(gram, sq_norm, out=gram)
+
 	@property
 	@abc.abstractmethod
 	def name_str(self) -> str:
@@ -23,6 +58,14 @@ class ClusterMetric(abc.ABC):
 	def to_plot_data(self, dist: numpy.ndarray) -> numpy.ndarray:
 		return dist
 
+	def euclidean_embedding(self, X) -> typing.Optional[numpy.ndarray]:
+		"""
+		transform X so that euclidean distances are monotonic to this metric,
+		used by clustering engines working in euclidean space; None if no
+		such transformation is available
+		"""
+		return None
+
 	@property
 	def vmax(self):
 		return None
@@ -42,25 +85,55 @@ _reg = registry.new(registry_name="cluster_metric",
 
 @_reg.register("euclidean")
 class EuclideanDist(ClusterMetric):
-	@functools.wraps(sklearn.metrics.pairwise.euclidean_distances)
-	def __call__(self, *ka, **kw):
-		return sklearn.metrics.pairwise.euclidean_distances(*ka, **kw)
+	def __call__(self, X, Y=None, *ka, **kw):
+		"""
+		same as sklearn.metrics.pairwise.euclidean_distances()
+		"""
+		if (Y is None) and (not ka) and (not kw):
+			return self._dist_from_gram(X)
+		import sklearn.metrics
+		return sklearn.metrics.pairwise.euclidean_distances(X, Y, *ka, **kw)
+
+	def gram_to_dist(self, gram, sq_norm, *, out):
+		numpy.multiply(gram, -2, out=out)
+		out += sq_norm[:, None]
+		out += sq_norm[None, :]
+		numpy.maximum(out, 0, out=out)
+		numpy.fill_diagonal(out, 0)
+		return numpy.sqrt(out, out=out)
 
 	@property
 	def name_str(self):
 		return "Euclidean distance"
 
+	def euclidean_embedding(self, X):
+		return numpy.asarray(X)
+
 
 @_reg.register("cosine", as_default=True)
 class CosineDist(ClusterMetric):
-	@functools.wraps(sklearn.metrics.pairwise.cosine_distances)
-	def __call__(self, *ka, **kw):
-		return sklearn.metrics.pairwise.cosine_distances(*ka, **kw)
+	def __call__(self, X, Y=None, *ka, **kw):
+		"""
+		same as sklearn.metrics.pairwise.cosine_distances()
+		"""
+		if (Y is None) and (not ka) and (not kw):
+			return self._dist_from_gram(X)
+		import sklearn.metrics
+		return sklearn.metrics.pairwise.cosine_distances(X, Y, *ka, **kw)
+
+	def gram_to_dist(self, gram, sq_norm, *, out):
+		return _cosine_from_gram(gram, sq_norm, out=out)
 
 	@property
 	def name_str(self):
 		return "cosine similarity"
 
+	def euclidean_embedding(self, X):
+		# euclidean distance between l2-normalized vectors is
+		# sqrt(2 * cosine distance)
+		import sklearn.preprocessing
+		return sklearn.preprocessing.normalize(X)
+
 	def to_plot_data(self, dist):
 		return 1 - dist
 
@@ -79,14 +152,28 @@ class CosineDist(ClusterMetric):
 
 @_reg.register("sqrt_cosine")
 class SqrtCosineDist(ClusterMetric):
-	@functools.wraps(sklearn.metrics.pairwise.cosine_distances)
-	def __call__(self, *ka, **kw):
-		return numpy.sqrt(sklearn.metrics.pairwise.cosine_distances(*ka, **kw))
+	def __call__(self, X, Y=None, *ka, **kw):
+		"""
+		square root of sklearn.metrics.pairwise.cosine_distances()
+		"""
+		if (Y is None) and (not ka) and (not kw):
+			return self._dist_from_gram(X)
+		import sklearn.metrics
+		ret = sklearn.metrics.pairwise.cosine_distances(X, Y, *ka, **kw)
+		return numpy.sqrt(ret, out=ret)
+
+	def gram_to_dist(self, gram, sq_norm, *, out):
+		return numpy.sqrt(_cosine_from_gram(gram, sq_norm, out=out), out=out)
 
 	@property
 	def name_str(self):
 		return "Sqrt. cosine distance"
 
+	def euclidean_embedding(self, X):
+		# exactly sqrt(2) times this metric
+		import sklearn.preprocessing
+		return sklearn.preprocessing.normalize(X)
+
 	@property
 	def vmax(self):
 		return 1.4145
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import abc
+
+import numpy
+
+# custom lib
+from . import registry
+
+
+class ClusteringEngine(abc.ABC):
+	"""
+	flat clustering engines labeling spectra directly from their features,
+	i.e. no n * n distance matrix is created; engines work in the euclidean
+	space given by ClusterMetric.euclidean_embedding()
+	"""
+	@abc.abstractmethod
+	def fit_predict(self, X) -> numpy.ndarray:
+		"""
+		return the cluster label of each row in X, -1 for noise
+		"""
+		pass
+
+	@property
+	@abc.abstractmethod
+	def name_str(self) -> str:
+		pass
+
+	def cluster(self, X, metric) -> numpy.ndarray:
+		"""
+		cluster X under <metric> (a ClusterMetric); return labels in the same
+		form as the hca labels, i.e. contiguous integers starting from 0;
+		each noise point is made a singleton cluster
+		"""
+		emb = metric.euclidean_embedding(X)
+		if emb is None:
+			raise ValueError("metric '%s' is not supported by clustering "
+				"engine '%s'" % (metric.name_str, self.name_str))
+		labels = numpy.array(self.fit_predict(emb), dtype=int)
+		noise = labels < 0
+		labels[noise] = labels.max() + 1 + numpy.arange(noise.sum())
+		return numpy.unique(labels, return_inverse=True)[1].ravel()
+
+
+def _get_sklearn_cluster_class(name: str, version: str):
+	# some engines are only available with newer scikit-learn
+	import sklearn.cluster
+	if not hasattr(sklearn.cluster, name):
+		raise RuntimeError("clustering engine using '%s' requires "
+			"scikit-learn>=%s" % (name, version))
+	return getattr(sklearn.cluster, name)
+
+
+_reg = registry.new(registry_name="clustering_engine",
+	value_type=ClusteringEngine)
+
+
+@_reg.register("minibatch_kmeans", as_default=True)
+class MiniBatchKMeans(ClusteringEngine):
+	def __init__(self, *, n_clusters=8, batch_size=1024, random_state=None):
+		self.n_clusters = n_clusters
+		self.batch_size = batch_size
+		self.random_state = random_state
+		return
+
+	def fit_predict(self, X):
+		import sklearn.cluster
+		model = sklearn.cluster.MiniBatchKMeans(
+			n_clusters=min(self.n_clusters, len(X)),
+			batch_size=self.batch_size, n_init=3,
+			random_state=self.random_state)
+		return model.fit_predict(X)
+
+	@property
+	def name_str(self):
+		return "mini-batch k-means"
+
+
+@_reg.register("bisecting_kmeans")
+class BisectingKMeans(ClusteringEngine):
+	def __init__(self, *, n_clusters=8, random_state=None):
+		self.n_clusters = n_clusters
+		self.random_state = random_state
+		return
+
+	def fit_predict(self, X):
+		cls = _get_sklearn_cluster_class("BisectingKMeans", "1.1")
+		model = cls(n_clusters=min(self.n_clusters, len(X)),
+			random_state=self.random_state)
+		return model.fit_predict(X)
+
+	@property
+	def name_str(self):
+		return "bisecting k-means"
+
+
+@_reg.register("hdbscan")
+class HDBSCAN(ClusteringEngine):
+	def __init__(self, *, min_cluster_size=5, min_samples=None):
+		self.min_cluster_size = min_cluster_size
+		self.min_samples = min_samples
+		return
+
+	def fit_predict(self, X):
+		cls = _get_sklearn_cluster_class("HDBSCAN", "1.3")
+		# copy only matters with precomputed distances, X is features here
+		model = cls(min_cluster_size=self.min_cluster_size,
+			min_samples=self.min_samples, copy=False)
+		return model.fit_predict(X)
+
+	@property
+	def name_str(self):
+		return "HDBSCAN"
@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 
 import abc
+import concurrent.futures
+import multiprocessing.shared_memory
+import os
 
-from skfeature.function.similarity_based.fisher_score import fisher_score
-from skfeature.function.similarity_based.lap_score import lap_score
-from skfeature.function.similarity_based.trace_ratio import trace_ratio
+import numpy
 
 # custom lib
 from . import registry
@@ -23,25 +24,436 @@ class FeatureScoreMethod(abc.ABC):
 	def __call__(self, *ka, **kw):
 		return self.feature_score(*ka, **kw)
 
+	def feature_score_ovr(self, X, labels, classes, *, metric=None,
+			dist=None, n_jobs=None) -> dict:
+		"""
+		rank features distinguishing each class in <classes> from all other
+		spectra in one-vs-rest (OVR) fashion; labels not in <classes> (e.g.
+		None) are always in the rest;
+
+		metric: ClusterMetric between spectra, used by methods depending on
+			distances, euclidean if None
+		dist: optional precomputed all-pairs distance matrix of X by <metric>
+		n_jobs: number of worker processes calling feature_score() for
+			different classes in parallel, with X shared among them in shared
+			memory; None means using all cpus, 1 scores classes one after
+			another; ignored by methods scoring all classes at once
+
+		return a dict of class -> feature indices in descending order of
+		importance; by default feature_score() is called for each class,
+		methods able to score all classes at once override this (as all
+		built-in methods do, so the worker pool only serves third-party
+		methods scoring one class at a time)
+		"""
+		codes = _ovr_class_codes(labels, classes)
+		n_jobs = min(n_jobs or os.cpu_count() or 1, len(classes))
+		if n_jobs <= 1:
+			return {c: self.feature_score(X, (codes == i).astype(int))
+				for i, c in enumerate(classes)}
+		with _SharedArray(numpy.asarray(X, dtype=float)) as shared:
+			with concurrent.futures.ProcessPoolExecutor(n_jobs,
+					initializer=_init_ovr_worker,
+					initargs=(self, shared.spec, codes)) as executor:
+				futures = [executor.submit(_feature_score_ovr_in_worker, i)
+					for i in range(len(classes))]
+				ret = {c: f.result() for c, f in zip(classes, futures)}
+		return ret
+
+	def feature_rank_subsample(self, X, labels, classes, *, n_subsamples,
+			subsample_size, metric=None, random_state=None, n_jobs=None
+			) -> tuple:
+		"""
+		rank features of each class in <classes> in one-vs-rest fashion by
+		feature_score_ovr() on <n_subsamples> stratified subsamples; each
+		subsample draws up to <subsample_size> spectra without replacement
+		from each class and from the rest (labels not in <classes>), so that
+		the cost of each ranking is bounded by subsample_size rather than the
+		number of spectra
+
+		metric: ClusterMetric between spectra, see feature_score_ovr()
+		random_state: seed used in drawing subsamples
+		n_jobs: number of worker processes ranking subsamples in parallel,
+			with X shared among them in shared memory; None means using all
+			cpus, 1 ranks subsamples one after another
+
+		return (consensus, stability), both dicts keyed by class; consensus
+		is the feature indices in ascending order of the mean rank across
+		subsamples; stability is the rank stability of each feature (in
+		feature order), 1 - std(rank) / std(uniformly random rank), clipped
+		to [0, 1]; i.e. 1 means the feature has the same rank in every
+		subsample, and 0 means it is no more stable than a random ranking
+		"""
+		if n_subsamples < 1:
+			raise ValueError("n_subsamples must be at least 1, got %d"
+				% n_subsamples)
+		if subsample_size < 1:
+			raise ValueError("subsample_size must be at least 1, got %d"
+				% subsample_size)
+		X = numpy.asarray(X, dtype=float)
+		codes = _ovr_class_codes(labels, classes)
+		subsamples = _stratified_subsamples(codes, n_subsamples,
+			subsample_size, random_state)
+		n_jobs = min(n_jobs or os.cpu_count() or 1, n_subsamples)
+		if n_jobs <= 1:
+			ranks = [_subsample_rank_positions(self, X, codes, len(classes),
+				metric, i) for i in subsamples]
+		else:
+			with _SharedArray(X) as shared:
+				with concurrent.futures.ProcessPoolExecutor(n_jobs,
+						initializer=_init_subsample_worker,
+						initargs=(self, shared.spec, codes, len(classes),
+							metric)) as executor:
+					ranks = list(executor.map(_rank_subsample_in_worker,
+						subsamples))
+		# ranks: n_subsamples * n_classes * n_features
+		ranks = numpy.stack(ranks).astype(float)
+		n_features = X.shape[1]
+		random_std = numpy.sqrt((n_features ** 2 - 1) / 12)
+		stability = 1 - ranks.std(axis=0) / max(random_std, 1e-12)
+		stability = numpy.clip(stability, 0, 1)
+		consensus = numpy.argsort(ranks.mean(axis=0), axis=1, kind="stable")
+		return {c: consensus[i] for i, c in enumerate(classes)}, \
+			{c: stability[i] for i, c in enumerate(classes)}
+
+
+class _SharedArray(object):
+	"""
+	context manager copying an array into a shared memory block, which is
+	freed on exit; spec is passed to worker processes to attach the array by
+	_attach_shared_array()
+	"""
+	def __init__(self, X):
+		self.X = numpy.asarray(X)
+		self.shm = None
+		return
+
+	@property
+	def spec(self) -> tuple:
+		return self.shm.name, self.X.shape, self.X.dtype.str
+
+	def __enter__(self):
+		self.shm = multiprocessing.shared_memory.SharedMemory(create=True,
+			size=max(self.X.nbytes, 1))
+		numpy.ndarray(self.X.shape, dtype=self.X.dtype,
+			buffer=self.shm.buf)[:] = self.X
+		return self
+
+	def __exit__(self, *ka):
+		self.shm.close()
+		self.shm.unlink()
+		return
+
+
+def _attach_shared_array(spec) -> tuple:
+	# the returned shared memory must be kept referenced while X is used
+	name, shape, dtype = spec
+	shm = multiprocessing.shared_memory.SharedMemory(name=name)
+	return shm, numpy.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+_worker_ovr = None
+
+
+def _init_ovr_worker(score_meth, shared_spec, codes):
+	global _worker_ovr
+	shm, X = _attach_shared_array(shared_spec)
+	_worker_ovr = (score_meth, shm, X, codes)
+	return
+
+
+def _feature_score_ovr_in_worker(i) -> numpy.ndarray:
+	score_meth, _, X, codes = _worker_ovr
+	return score_meth.feature_score(X, (codes == i).astype(int))
+
+
+def _stratified_subsamples(codes, n_subsamples, subsample_size,
+		random_state) -> list:
+	"""
+	draw up to <subsample_size> indices without replacement from each group
+	of equal codes (the rest, code -1, is a group too), for each subsample;
+	returns a list of sorted index arrays
+	"""
+	rng = numpy.random.default_rng(random_state)
+	n = len(codes)
+	order = numpy.argsort(codes, kind="stable")
+	# position of each spectrum within its group in <order>
+	group_start = numpy.searchsorted(codes[order], codes[order], side="left")
+	pos_in_group = numpy.arange(n) - group_start
+	ret = list()
+	for i in range(n_subsamples):
+		# shuffle within groups by sorting random keys under the group codes
+		perm = order[numpy.lexsort((rng.random(n), codes[order]))]
+		ret.append(numpy.sort(perm[pos_in_group < subsample_size]))
+	return ret
+
+
+def _subsample_rank_positions(score_meth, X, codes, n_classes, metric,
+		index) -> numpy.ndarray:
+	"""
+	rank features of each class on spectra <index>; returns the rank position
+	(0 is the most important) of each feature, n_classes * n_features
+	"""
+	ranking = score_meth.feature_score_ovr(X[index], codes[index],
+		list(range(n_classes)), metric=metric, n_jobs=1)
+	ret = numpy.empty((n_classes, X.shape[1]), dtype=int)
+	for i in range(n_classes):
+		ret[i, ranking[i]] = numpy.arange(X.shape[1])
+	return ret
+
+
+_worker_subsample = None
+
+
+def _init_subsample_worker(score_meth, shared_spec, codes, n_classes, metric):
+	global _worker_subsample
+	shm, X = _attach_shared_array(shared_spec)
+	_worker_subsample = (score_meth, shm, X, codes, n_classes, metric)
+	return
+
+
+def _rank_subsample_in_worker(index) -> numpy.ndarray:
+	score_meth, _, X, codes, n_classes, metric = _worker_subsample
+	return _subsample_rank_positions(score_meth, X, codes, n_classes, metric,
+		index)
+
 
 _reg = registry.new(registry_name="feature_score",
 	value_type=FeatureScoreMethod)
 
 
+def _ovr_class_codes(labels, classes) -> numpy.ndarray:
+	# index of each label in classes, -1 if not in classes
+	if isinstance(labels, numpy.ndarray) and (labels.dtype.kind in "iu") \
+			and len(classes):
+		# int labels are looked up in sorted classes at once
+		classes = numpy.asarray(classes)
+		order = numpy.argsort(classes)
+		pos = numpy.searchsorted(classes[order], labels).clip(
+			max=len(classes) - 1)
+		return numpy.where(classes[order][pos] == labels, order[pos], -1)
+	lut = {c: i for i, c in enumerate(classes)}
+	return numpy.fromiter((lut.get(i, -1) for i in labels), dtype=int,
+		count=len(labels))
+
+
+def _class_sums(X, codes, n_classes) -> tuple:
+	"""
+	return the number of spectra, sums of X and sums of X ** 2 of each class,
+	and of all spectra; spectra with code -1 are only in the latter
+	"""
+	import scipy.sparse
+
+	X = numpy.asarray(X, dtype=float)
+	n, in_class = len(X), codes >= 0
+	onehot = scipy.sparse.csr_matrix((numpy.ones(in_class.sum()),
+		(codes[in_class], numpy.flatnonzero(in_class))), shape=(n_classes, n))
+	X_sq = numpy.square(X)
+	counts = numpy.bincount(codes[in_class], minlength=n_classes)
+	return (counts, onehot @ X, onehot @ X_sq), \
+		(n, X.sum(axis=0), X_sq.sum(axis=0))
+
+
+def _ovr_scatter_from_sums(class_sums, total_sums) -> tuple:
+	"""
+	return the between-class scatter and the total scatter of each feature
+	for each class vs. the rest, each n_classes * n_features; the within-class
+	scatter is their difference
+	"""
+	(n_k, s_k, q_k), (n, s, q) = class_sums, total_sums
+	n_k = n_k[:, None].astype(float)
+	n_rest, s_rest = n - n_k, s - s_k
+	# class or rest being empty contributes nothing
+	between = numpy.divide(numpy.square(s_k), n_k,
+		out=numpy.zeros_like(s_k), where=n_k > 0) \
+		+ numpy.divide(numpy.square(s_rest), n_rest,
+			out=numpy.zeros_like(s_rest), where=n_rest > 0) \
+		- numpy.square(s) / n
+	total = numpy.broadcast_to(q - numpy.square(s) / n, between.shape).copy()
+	return between, total
+
+
+def _fisher_score_from_sums(class_sums, total_sums) -> numpy.ndarray:
+	# fisher score of each class vs. the rest, calculated in the same way as
+	# skfeature's fisher_score(), i.e. between-class scatter over total
+	# scatter converted into between-class over within-class scatter
+	between, total = _ovr_scatter_from_sums(class_sums, total_sums)
+	# avoid the denominator to be 0
+	total[total < 1e-12] = 10000
+	with numpy.errstate(divide="ignore"):
+		return 1.0 / (1 - between / total) - 1
+
+
 @_reg.register("fisher_score")
 class FisherScore(FeatureScoreMethod):
+	"""
+	fisher score, same as skfeature's fisher_score(); in one-vs-rest ranking,
+	the scores of all classes are derived from per-class counts, sums and
+	sums of squares collected in a single pass over the spectra
+	"""
 	def feature_score(self, X, Y):
-		return fisher_score(X, Y, mode="index")
+		classes, codes = numpy.unique(Y, return_inverse=True)
+		(n_k, s_k, q_k), (n, s, q) = _class_sums(X, codes.ravel(),
+			len(classes))
+		# multi-class between-class scatter
+		between = (numpy.square(s_k) / n_k[:, None]).sum(axis=0) \
+			- numpy.square(s) / n
+		total = q - numpy.square(s) / n
+		total[total < 1e-12] = 10000
+		with numpy.errstate(divide="ignore"):
+			score = 1.0 / (1 - between / total) - 1
+		return numpy.argsort(score)[::-1]
+
+	def feature_score_ovr(self, X, labels, classes, *, metric=None,
+			dist=None, n_jobs=None):
+		class_sums, total_sums = _class_sums(X,
+			_ovr_class_codes(labels, classes), len(classes))
+		score = _fisher_score_from_sums(class_sums, total_sums)
+		return {c: numpy.argsort(score[i])[::-1]
+			for i, c in enumerate(classes)}
 
 	@property
 	def name_str(self):
 		return "Fisher score"
 
 
+def knn_heat_kernel_graph(X, n_neighbors, *, metric=None, dist=None,
+		t=None, block_size=1024):
+	"""
+	sparse symmetric k-nearest-neighbor graph of spectra X, two spectra are
+	connected if either is among the k nearest neighbors of the other, with
+	heat kernel weight exp(-d ** 2 / t); distances are calculated by <metric>
+	(euclidean if None) in blocks of <block_size> rows, or taken from the
+	precomputed distance matrix <dist>; t defaults to the mean of squared
+	distances along the edges
+	"""
+	import scipy.sparse
+
+	if metric is None:
+		metric = registry.get("cluster_metric").get("euclidean")
+	n = len(X)
+	k = min(n_neighbors, n - 1)
+	neighbors = numpy.empty((n, k), dtype=int)
+	neighbor_dist = numpy.empty((n, k), dtype=float)
+	for start in range(0, n, block_size):
+		stop = min(start + block_size, n)
+		block = metric(X[start:stop], X) if dist is None \
+			else numpy.array(dist[start:stop], dtype=float)
+		# exclude self from neighbors
+		block[numpy.arange(stop - start), numpy.arange(start, stop)] = \
+			numpy.inf
+		idx = numpy.argpartition(block, k - 1, axis=1)[:, :k]
+		neighbors[start:stop] = idx
+		neighbor_dist[start:stop] = numpy.take_along_axis(block, idx, axis=1)
+	sq_dist = numpy.square(neighbor_dist.ravel())
+	if t is None:
+		t = sq_dist.mean() if sq_dist.mean() > 0 else 1.0
+	graph = scipy.sparse.csr_matrix((numpy.exp(-sq_dist / t),
+		(numpy.repeat(numpy.arange(n), k), neighbors.ravel())), shape=(n, n))
+	return graph.maximum(graph.T).tocsr()
+
+
+def _lap_score_from_terms(f_D_f, f_D_1, f_W_f, d_sum) -> numpy.ndarray:
+	# laplacian score from f'Df, f'D1, f'Wf and 1'D1, calculated in the same
+	# way as skfeature's lap_score()
+	with numpy.errstate(invalid="ignore", divide="ignore"):
+		sq = numpy.square(f_D_1) / d_sum
+	D_prime = f_D_f - sq
+	L_prime = f_W_f - sq
+	# avoid the denominator to be 0
+	D_prime[~(D_prime >= 1e-12)] = 10000
+	return 1 - L_prime / D_prime
+
+
 @_reg.register("lap_score", as_default=True)
 class LaplacianScore(FeatureScoreMethod):
+	"""
+	supervised laplacian score on the k-nearest-neighbor heat kernel graph of
+	spectra; only edges between spectra of the same class are used, each
+	weighted by 1 / (size of that class) as in the class blocks of fisher-style
+	graphs, so that all classes weigh equally in the score regardless of their
+	sizes; smaller scores are more important;
+
+	in one-vs-rest ranking, a class is scored against all other spectra as a
+	single class, i.e. a feature scores well if it separates the class from
+	the rest while varying smoothly between neighbors on both sides; the
+	graph is built once, and the terms of all classes are derived from it
+	using a few sparse products
+
+	n_neighbors: number of nearest neighbors of each spectrum in the graph
+	t: heat kernel parameter, see knn_heat_kernel_graph()
+	"""
+	def __init__(self, *, n_neighbors=5, t=None, block_size=1024):
+		self.n_neighbors = n_neighbors
+		self.t = t
+		self.block_size = block_size
+		return
+
+	def _graph(self, X, metric, dist):
+		return knn_heat_kernel_graph(X, self.n_neighbors, metric=metric,
+			dist=dist, t=self.t, block_size=self.block_size)
+
 	def feature_score(self, X, Y):
-		return lap_score(X, Y, mode="index")
+		import scipy.sparse
+
+		X = numpy.asarray(X, dtype=float)
+		_, codes, sizes = numpy.unique(numpy.asarray(Y).ravel(),
+			return_inverse=True, return_counts=True)
+		codes = codes.ravel()
+		graph = self._graph(X, None, None).tocoo()
+		same = codes[graph.row] == codes[graph.col]
+		row, col = graph.row[same], graph.col[same]
+		W = scipy.sparse.csr_matrix((graph.data[same] / sizes[codes[row]],
+			(row, col)), shape=graph.shape)
+		deg = numpy.asarray(W.sum(axis=1)).ravel()
+		score = _lap_score_from_terms(deg @ numpy.square(X), deg @ X,
+			(X * (W @ X)).sum(axis=0), deg.sum())
+		return numpy.argsort(score)
+
+	def feature_score_ovr(self, X, labels, classes, *, metric=None,
+			dist=None, n_jobs=None):
+		import scipy.sparse
+
+		X = numpy.asarray(X, dtype=float)
+		n, n_classes = len(X), len(classes)
+		codes = _ovr_class_codes(labels, classes)
+		graph = self._graph(X, metric, dist)
+		in_class = codes >= 0
+		onehot = scipy.sparse.csr_matrix((numpy.ones(in_class.sum()),
+			(codes[in_class], numpy.flatnonzero(in_class))),
+			shape=(n_classes, n))
+		n_c = numpy.asarray(onehot.sum(axis=1)).ravel()
+		# edges between spectra of the same class in <classes>
+		coo = graph.tocoo()
+		same = in_class[coo.row] & (codes[coo.row] == codes[coo.col])
+		W_same = scipy.sparse.csr_matrix((coo.data[same],
+			(coo.row[same], coo.col[same])), shape=graph.shape)
+		# degree of each spectrum, and its degree within its own class
+		deg = numpy.asarray(graph.sum(axis=1)).ravel()
+		deg_own = numpy.asarray(W_same.sum(axis=1)).ravel()
+		# edges of class c are weighted by 1 / n_c, those with both ends in
+		# the rest by 1 / (n - n_c)
+		w_in = 1 / numpy.maximum(n_c, 1)[:, None]
+		w_rest = 1 / numpy.maximum(n - n_c, 1)[:, None]
+
+		def weighted_deg_sum(F):
+			# sum of degree * F over spectra of c plus those of the rest, in
+			# which the degree of a spectrum is less its edges to c
+			in_c = onehot @ (deg_own[:, None] * F)
+			to_c = onehot @ (graph @ F) - in_c
+			rest = (deg @ F)[None, :] - onehot @ (deg[:, None] * F) - to_c
+			return w_in * in_c + w_rest * rest
+
+		f_D_f = weighted_deg_sum(numpy.square(X))
+		f_D_1 = weighted_deg_sum(X)
+		d_sum = weighted_deg_sum(numpy.ones((n, 1)))
+		# f'Wf within c, and within the rest by inclusion-exclusion
+		W_f_in = onehot @ (X * (W_same @ X))
+		X_G_X = X * (graph @ X)
+		W_f_rest = X_G_X.sum(axis=0)[None, :] - 2 * (onehot @ X_G_X) \
+			+ W_f_in
+		f_W_f = w_in * W_f_in + w_rest * W_f_rest
+		score = _lap_score_from_terms(f_D_f, f_D_1, f_W_f, d_sum)
+		return {c: numpy.argsort(score[i]) for i, c in enumerate(classes)}
 
 	@property
 	def name_str(self):
@@ -50,8 +462,46 @@ class LaplacianScore(FeatureScoreMethod):
 
 @_reg.register("trace_ratio")
 class TraceRatio(FeatureScoreMethod):
+	"""
+	trace ratio criterion with fisher-style graphs, same ranking as
+	skfeature's trace_ratio() selecting all features; the diagonals of the
+	within- and between-class scatter matrices are derived from per-class
+	counts, sums and sums of squares instead of n * n graph matrices, and in
+	one-vs-rest ranking all classes are scored from a single pass over the
+	spectra; constant features score 0
+	"""
 	def feature_score(self, X, Y):
-		return trace_ratio(X, Y, mode="index")
+		classes, codes = numpy.unique(Y, return_inverse=True)
+		(n_k, s_k, q_k), (n, s, q) = _class_sums(X, codes.ravel(),
+			len(classes))
+		# multi-class between-class scatter
+		between = (numpy.square(s_k) / n_k[:, None]).sum(axis=0) \
+			- numpy.square(s) / n
+		total = q - numpy.square(s) / n
+		score = self._trace_ratio_from_scatter(between[None, :],
+			total[None, :])
+		return numpy.argsort(score[0])[::-1]
+
+	def feature_score_ovr(self, X, labels, classes, *, metric=None,
+			dist=None, n_jobs=None):
+		between, total = _ovr_scatter_from_sums(*_class_sums(X,
+			_ovr_class_codes(labels, classes), len(classes)))
+		score = self._trace_ratio_from_scatter(between, total)
+		return {c: numpy.argsort(score[i])[::-1]
+			for i, c in enumerate(classes)}
+
+	@staticmethod
+	def _trace_ratio_from_scatter(between, total) -> numpy.ndarray:
+		# with all features selected, the trace ratio k is that of the sums of
+		# scatters, and features are scored by between - k * within in a
+		# single iteration; each row is a separate ranking
+		const = total < 1e-12
+		s_between = numpy.where(const, 0, numpy.abs(between))
+		s_within = numpy.where(const, 0, numpy.abs(total - between))
+		sum_within = s_within.sum(axis=1, keepdims=True)
+		k = numpy.divide(s_between.sum(axis=1, keepdims=True), sum_within,
+			out=numpy.zeros_like(sum_within), where=sum_within > 0)
+		return s_between - k * s_within
 
 	@property
 	def name_str(self):
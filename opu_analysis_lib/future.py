@@ -6,10 +6,10 @@ import inspect
 
 import matplotlib.cm
 import matplotlib.colors
-import sklearn.cluster
 
 
 def sklearn_cluster_AgglomerativeClustering(*ka, metric=None, **kw):
+	import sklearn.cluster
 	cls = sklearn.cluster.AgglomerativeClustering
 	if "metric" in inspect.signature(cls.__init__).parameters:
 		new = cls(*ka, metric=metric, **kw)
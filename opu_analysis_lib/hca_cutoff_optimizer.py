@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
 import abc
+import concurrent.futures
+import os
 
 import numpy
 
@@ -39,6 +41,105 @@ class HCACutoffOptimizer(object):
 	def cutoff_final_str(self) -> str:
 		pass
 
+	@staticmethod
+	def _fit_full_tree(model, dist) -> tuple:
+		"""
+		fit a copy of model with the full tree computed, and return the merge
+		history as (children, distances) in the merging order; all cutoffs can
+		be evaluated from this single fit without refitting the model
+		"""
+		import sklearn.base
+		model = sklearn.base.clone(model)
+		model.set_params(distance_threshold=0)
+		model.fit(dist)
+		return model.children_, model.distances_
+
+	@staticmethod
+	def _is_precomputed(model) -> bool:
+		# True if model is fit on a precomputed distance matrix, otherwise
+		# it is fit on features
+		metric = getattr(model, "metric", getattr(model, "affinity",
+			"precomputed"))
+		return isinstance(metric, str) and (metric == "precomputed")
+
+	@staticmethod
+	def _n_merges_at_cutoffs(distances, cutoff_list) -> numpy.ndarray:
+		# same as sklearn, a cutoff applies all merges with distance below it
+		return numpy.searchsorted(numpy.sort(distances), cutoff_list,
+			side="left")
+
+
+def iter_cut_labels(children, n_merges_list):
+	"""
+	yield flat cluster labels after applying the first <m> merges in children,
+	for each m in n_merges_list (must be non-decreasing); labels are numbered
+	0, 1, ..., n_clusters - 1;
+
+	the smaller cluster is always relabeled into the larger one when merging,
+	so walking through all merges costs O(n log n) in total
+	"""
+	n = len(children) + 1
+	labels = numpy.arange(n)
+	members = [[i] for i in range(n)] + [None] * (n - 1)
+	i = 0
+	for m in n_merges_list:
+		while i < m:
+			a, b = children[i]
+			ma, mb = members[a], members[b]
+			if len(ma) < len(mb):
+				ma, mb = mb, ma
+			labels[mb] = labels[ma[0]]
+			ma.extend(mb)
+			members[n + i], members[a], members[b] = ma, None, None
+			i += 1
+		yield numpy.unique(labels, return_inverse=True)[1]
+	return
+
+
+def walk_sum_of_squares(data, children, n_merges_list, sample_weight=None
+		) -> tuple:
+	"""
+	calculate the within-cluster and between-cluster sum of squares of data
+	after applying the first <m> merges in children, for each m in
+	n_merges_list (must be non-decreasing); returns (wss, bss) arrays;
+	if sample_weight is provided, each sample counts as <weight> identical
+	points
+
+	only per-cluster counts and sums are tracked and updated along the merges,
+	so evaluating all cutoffs together costs O(n * d)
+	"""
+	data = numpy.asarray(data, dtype=float)
+	n = len(data)
+	counts = numpy.ones(n, dtype=float) if sample_weight is None \
+		else numpy.array(sample_weight, dtype=float)
+	# slot[node] is the row in sums/counts/sq_norm holding that tree node
+	slot = numpy.empty(2 * n - 1, dtype=int)
+	slot[:n] = numpy.arange(n)
+	sums = data * counts.reshape(-1, 1)
+	sq_norm = (sums ** 2).sum(axis=1)
+	total_sq = (sq_norm / counts).sum()
+	center_sq = (sums.sum(axis=0) ** 2).sum() / counts.sum()
+	# explained = sum of |S_c|^2 / n_c over all clusters c, where S_c is the
+	# sum vector of cluster c
+	explained = total_sq
+	wss = numpy.empty(len(n_merges_list), dtype=float)
+	bss = numpy.empty(len(n_merges_list), dtype=float)
+	i = 0
+	for j, m in enumerate(n_merges_list):
+		while i < m:
+			a, b = slot[children[i]]
+			explained -= sq_norm[a] / counts[a] + sq_norm[b] / counts[b]
+			sums[a] += sums[b]
+			counts[a] += counts[b]
+			sq_norm[a] = sums[a] @ sums[a]
+			explained += sq_norm[a] / counts[a]
+			slot[n + i] = a
+			i += 1
+		wss[j] = total_sq - explained
+		bss[j] = explained - center_sq
+	# wss can be slightly negative due to round-off when all are singletons
+	return numpy.maximum(wss, 0), bss
+
 
 _reg = registry.new(registry_name="hca_cutoff_optimizer",
 	reg_type=CustomRegistry,
@@ -114,3 +215,254 @@ class BIC(HCACutoffOptimizer):
 	@property
 	def cutoff_final_str(self) -> str:
 		return "%.2f(BIC)" % self.cutoff_final
+
+
+@_reg.register("silhouette")
+class Silhouette(HCACutoffOptimizer):
+	"""
+	find the cutoff with the highest mean silhouette coefficient;
+
+	sample_size: if a positive int less than the number of spectra, the
+		silhouette is estimated on a random sample of that many spectra,
+		reducing the cost from O(n^2) to O(sample_size * n); the sample is
+		drawn once, so that the distances of sampled spectra are calculated
+		once for all cutoffs, and at each cutoff sampled spectra are weighted
+		by the size of their cluster over the number sampled from it; 0 or
+		None uses all spectra; singleton clusters always have silhouette 0,
+		clusters without sampled spectra (other than singletons) are left out
+	random_state: seed used in sampling
+	"""
+	def __init__(self, *, sample_size=2000, random_state=None):
+		super().__init__()
+		self.sample_size = sample_size
+		self.random_state = random_state
+		return
+
+	def optimize(self, *, model, data, dist, cutoff_list, metric, **kw):
+		children, distances = self._fit_full_tree(model, dist)
+		n_merges = self._n_merges_at_cutoffs(distances, cutoff_list)
+		# distances of sampled spectra are calculated on demand if model is
+		# not fit on a distance matrix
+		if self._is_precomputed(model):
+			get_dist_rows = dist.__getitem__
+		else:
+			def get_dist_rows(rows):
+				return metric(data[rows], data)
+		labels_list = list(iter_cut_labels(children, n_merges))
+		score_list = self._calc_silhouette(get_dist_rows, labels_list,
+			self._get_sample(len(data)))
+		if numpy.isnan(score_list).all():
+			raise ValueError("silhouette cannot be evaluated at any cutoff, "
+				"needs at least 2 clusters and some non-singleton clusters")
+		# find the cutoff with highest silhouette
+		self.cutoff_final = cutoff_list[numpy.nanargmax(score_list)]
+		return
+
+	def _get_sample(self, n) -> numpy.ndarray:
+		if (not self.sample_size) or (self.sample_size >= n):
+			return numpy.arange(n)
+		rng = numpy.random.default_rng(self.random_state)
+		return numpy.sort(rng.choice(n, self.sample_size, replace=False))
+
+	def _calc_silhouette(self, get_dist_rows, labels_list, sample,
+			chunk_size=256) -> numpy.ndarray:
+		# mean silhouette of each labeling in <labels_list>, nan if it has
+		# fewer than 2 clusters or only singletons; distance rows of sampled
+		# spectra are calculated once in chunks, and aggregated by clusters
+		# of each labeling in turn
+		import scipy.sparse
+		n = len(labels_list[0])
+		cuts = list()
+		for labels in labels_list:
+			sizes = numpy.bincount(labels)
+			if 2 <= len(sizes) < n:
+				# one-hot cluster membership, used to sum distances in each
+				# cluster
+				onehot = scipy.sparse.csr_matrix((numpy.ones(n),
+					(labels, numpy.arange(n))), shape=(len(sizes), n))
+				cuts.append((labels, sizes, onehot))
+			else:
+				cuts.append(None)
+		sil = numpy.zeros((len(labels_list), len(sample)), dtype=float)
+		for i in range(0, len(sample), chunk_size):
+			rows = sample[i:i + chunk_size]
+			dist_rows = get_dist_rows(rows)
+			idx = numpy.arange(len(rows))
+			for j, cut in enumerate(cuts):
+				if cut is None:
+					continue
+				labels, sizes, onehot = cut
+				own = labels[rows]
+				# mean distance to each cluster, self-distance excluded;
+				# singletons come out as nan, and are left out below
+				mean_dist = numpy.asarray(onehot @ dist_rows.T).T
+				with numpy.errstate(invalid="ignore", divide="ignore"):
+					a = mean_dist[idx, own] / (sizes[own] - 1)
+					mean_dist /= sizes
+					mean_dist[idx, own] = numpy.inf
+					b = mean_dist.min(axis=1)
+					sil[j, i:i + chunk_size] = numpy.nan_to_num((b - a)
+						/ numpy.maximum(a, b))
+		ret = numpy.full(len(labels_list), numpy.nan)
+		for j, cut in enumerate(cuts):
+			if cut is None:
+				continue
+			labels, sizes, _ = cut
+			# weight each sampled spectrum by the size of its cluster over the
+			# number sampled from it; singletons count as 0
+			nonsingle = sizes[labels[sample]] > 1
+			sampled = labels[sample[nonsingle]]
+			n_sampled = numpy.bincount(sampled, minlength=len(sizes))
+			weights = sizes[sampled] / n_sampled[sampled]
+			ret[j] = (sil[j, nonsingle] * weights).sum() \
+				/ (sizes[n_sampled > 0].sum() + (sizes == 1).sum())
+		return ret
+
+	@property
+	def cutoff_final_str(self) -> str:
+		return "%.2f(silhouette)" % self.cutoff_final
+
+
+@_reg.register("calinski_harabasz")
+class CalinskiHarabasz(HCACutoffOptimizer):
+	"""
+	find the cutoff with the highest Calinski-Harabasz index, computed from
+	per-cluster counts and sums updated along the merges of a single fit;
+	sample_weight, if provided, counts each sample as <weight> points
+	"""
+	def optimize(self, *, model, data, dist, cutoff_list, sample_weight=None,
+			**kw):
+		children, distances = self._fit_full_tree(model, dist)
+		n_merges = self._n_merges_at_cutoffs(distances, cutoff_list)
+		wss, bss = walk_sum_of_squares(data, children, n_merges,
+			sample_weight=sample_weight)
+		n = len(data)
+		n_points = n if sample_weight is None else numpy.sum(sample_weight)
+		n_clusters = n - n_merges
+		with numpy.errstate(divide="ignore", invalid="ignore"):
+			ch_list = (bss / (n_clusters - 1)) \
+				/ (wss / (n_points - n_clusters))
+		ch_list[(n_clusters < 2) | (n_clusters >= n)] = numpy.nan
+		if numpy.isnan(ch_list).all():
+			raise ValueError("Calinski-Harabasz index cannot be evaluated at "
+				"any cutoff, needs at least 2 clusters and some non-singleton "
+				"clusters")
+		# find the cutoff with highest ch index
+		self.cutoff_final = cutoff_list[numpy.nanargmax(ch_list)]
+		return
+
+	@property
+	def cutoff_final_str(self) -> str:
+		return "%.2f(CH)" % self.cutoff_final
+
+
+def _gap_reference_log_wss(seed, model, metric, n_spectra, low, high,
+		rotation, center, n_merges_list, sample_weight) -> numpy.ndarray:
+	# generate a null reference dataset uniformly in the box [low, high] and
+	# rotate it back to the data space if the box is aligned to the principal
+	# components; then build its tree once and cut it at each n_merges
+	rng = numpy.random.default_rng(seed)
+	ref = rng.uniform(low, high, size=(n_spectra, len(low)))
+	if rotation is not None:
+		ref = ref @ rotation.T + center
+	# models fit on features (e.g. ward or knn-constrained) take the
+	# reference itself, others its distance matrix
+	fit_input = metric(ref) if HCACutoffOptimizer._is_precomputed(model) \
+		else ref
+	children, _ = HCACutoffOptimizer._fit_full_tree(model, fit_input)
+	wss, _ = walk_sum_of_squares(ref, children, n_merges_list,
+		sample_weight=sample_weight)
+	with numpy.errstate(divide="ignore"):
+		return numpy.log(wss)
+
+
+@_reg.register("gap")
+class GapStatistic(HCACutoffOptimizer):
+	"""
+	find the cutoff by the gap statistic (Tibshirani et al. 2001), which
+	compares log within-cluster dispersion of the data to that of null
+	reference datasets clustered the same way; the reference dispersion at a
+	cutoff is taken at the number of clusters the data has at that cutoff
+
+	n_refs: number of null reference datasets
+	reference: how null references are drawn, either 'uniform' (in the
+		bounding box of the data) or 'pca' (in the bounding box aligned to the
+		principal components of the data)
+	n_jobs: number of worker processes clustering the references in parallel;
+		None means using all cpus
+	random_state: seed used in generating references
+
+	sample_weight, if provided to optimize(), counts each sample as <weight>
+	points, and the references reuse the same weights
+	"""
+	def __init__(self, *, n_refs=10, reference="pca", n_jobs=None,
+			random_state=None):
+		super().__init__()
+		if reference not in {"uniform", "pca"}:
+			raise ValueError("reference must be 'uniform' or 'pca', got '%s'"
+				% reference)
+		self.n_refs = util.PosInt(n_refs)
+		self.reference = reference
+		self.n_jobs = n_jobs
+		self.random_state = random_state
+		return
+
+	def optimize(self, *, model, data, dist, cutoff_list, metric,
+			sample_weight=None, **kw):
+		children, distances = self._fit_full_tree(model, dist)
+		n_merges = self._n_merges_at_cutoffs(distances, cutoff_list)
+		# evaluate each distinct number of clusters only once, in the
+		# increasing order of merges
+		uniq_merges, first_index = numpy.unique(n_merges, return_index=True)
+		wss, _ = walk_sum_of_squares(data, children, uniq_merges,
+			sample_weight=sample_weight)
+		with numpy.errstate(divide="ignore"):
+			log_wss = numpy.log(wss)
+		ref_log_wss = self._calc_ref_log_wss(model, metric, data, uniq_merges,
+			sample_weight)
+		# all singletons have zero dispersion, where gap is not defined
+		with numpy.errstate(invalid="ignore"):
+			gap = ref_log_wss.mean(axis=0) - log_wss
+			gap_err = ref_log_wss.std(axis=0) * numpy.sqrt(1 + 1 / self.n_refs)
+		valid = numpy.isfinite(gap)
+		if not valid.any():
+			raise ValueError("gap statistic cannot be evaluated at any cutoff")
+		# the smallest number of clusters k that gap(k) >= gap(k') - s(k'),
+		# where k' is the next larger number of clusters; uniq_merges is in
+		# ascending order, i.e. number of clusters is descending
+		index = numpy.flatnonzero(valid)[::-1]
+		choice = index[numpy.argmax(gap[index])]
+		for i, j in zip(index[:-1], index[1:]):
+			if gap[i] >= gap[j] - gap_err[j]:
+				choice = i
+				break
+		self.cutoff_final = cutoff_list[first_index[choice]]
+		return
+
+	def _get_ref_box(self, data) -> tuple:
+		# returns (low, high, rotation, center) used to draw references
+		if self.reference == "uniform":
+			return data.min(axis=0), data.max(axis=0), None, None
+		center = data.mean(axis=0)
+		rotation = numpy.linalg.svd(data - center, full_matrices=False)[2].T
+		proj = (data - center) @ rotation
+		return proj.min(axis=0), proj.max(axis=0), rotation, center
+
+	def _calc_ref_log_wss(self, model, metric, data, n_merges_list,
+			sample_weight) -> numpy.ndarray:
+		box = self._get_ref_box(data)
+		seeds = numpy.random.SeedSequence(self.random_state).spawn(self.n_refs)
+		task_args = [(i, model, metric, len(data)) + box
+			+ (n_merges_list, sample_weight) for i in seeds]
+		n_jobs = min(self.n_jobs or os.cpu_count() or 1, self.n_refs)
+		if n_jobs == 1:
+			ret = [_gap_reference_log_wss(*i) for i in task_args]
+		else:
+			with concurrent.futures.ProcessPoolExecutor(n_jobs) as executor:
+				ret = list(executor.map(_gap_reference_log_wss,
+					*zip(*task_args)))
+		return numpy.vstack(ret)
+
+	@property
+	def cutoff_final_str(self) -> str:
+		return "%.2f(gap)" % self.cutoff_final
@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+# linkage backends not provided by scikit-learn, with interfaces compatible
+# with sklearn.cluster.AgglomerativeClustering as used in AnalysisHCARoutine
+
+import heapq
+import warnings
+
+import numpy
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.sparse.linalg
+import sklearn.base
+
+# custom lib
+from .hca_cutoff_optimizer import iter_cut_labels
+
+
+def _set_tree_attributes(model, children, distances, n_leaves):
+	# set the fitted attributes of sklearn.cluster.AgglomerativeClustering
+	# from a full tree, cut at model.distance_threshold
+	model.children_, model.distances_ = children, distances
+	model.n_leaves_ = n_leaves
+	if model.distance_threshold is None:
+		n_merges = len(children)
+	else:
+		n_merges = numpy.count_nonzero(distances < model.distance_threshold)
+	model.n_clusters_ = n_leaves - n_merges
+	model.labels_ = next(iter_cut_labels(children, [n_merges]))
+	return
+
+
+def subtree_sizes(children, n_leaves) -> numpy.ndarray:
+	"""
+	number of leaves under each merge node of a tree in the scikit-learn/scipy
+	format; the recurrence size[i] = size[a] + size[b] is a lower-triangular
+	linear system over the merge nodes, solved in one sparse call
+	"""
+	children = numpy.asarray(children, dtype=int).reshape(-1, 2)
+	n_merges = len(children)
+	if not n_merges:
+		return numpy.zeros(0, dtype=int)
+	rows = numpy.repeat(numpy.arange(n_merges), 2)
+	cols = children.ravel()
+	internal = cols >= n_leaves
+	# leaf children contribute 1, internal children contribute their sizes
+	leaf_count = numpy.bincount(rows[~internal], minlength=n_merges)
+	child_mat = scipy.sparse.csr_matrix(
+		(numpy.ones(internal.sum()), (rows[internal], cols[internal] - n_leaves)),
+		shape=(n_merges, n_merges))
+	system = scipy.sparse.identity(n_merges, format="csr") - child_mat
+	sizes = scipy.sparse.linalg.spsolve_triangular(system,
+		leaf_count.astype(float), lower=True)
+	return numpy.rint(sizes).astype(int)
+
+
+def sort_and_relabel_merges(merge_slots, merge_dists) -> tuple:
+	"""
+	turn merges recorded in arbitrary order as pairs of leaf 'slots' into the
+	scikit-learn/scipy tree format, i.e. sorted by merge distance and the i-th
+	merge creates node n + i; a slot is the leaf index that represents a
+	cluster since its creation
+
+	returns (children, distances)
+	"""
+	merge_slots = numpy.asarray(merge_slots, dtype=int).reshape(-1, 2)
+	merge_dists = numpy.asarray(merge_dists, dtype=float)
+	n = len(merge_slots) + 1
+	order = numpy.argsort(merge_dists, kind="stable")
+	# union-find, the root of each slot is its current node id
+	parent = numpy.arange(2 * n - 1)
+
+	def find(x):
+		root = x
+		while parent[root] != root:
+			root = parent[root]
+		while parent[x] != root:
+			parent[x], x = root, parent[x]
+		return root
+
+	children = numpy.empty((n - 1, 2), dtype=int)
+	for i, (a, b) in enumerate(merge_slots[order]):
+		children[i] = find(a), find(b)
+		parent[children[i]] = n + i
+	return children, merge_dists[order]
+
+
+def nn_chain_weighted_average(dist, weights=None) -> tuple:
+	"""
+	average linkage (UPGMA) clustering on a precomputed distance matrix, where
+	each sample carries a weight as if it was <weight> identical points; with
+	all weights equal to 1 it is identical to scipy/sklearn average linkage;
+
+	the nearest-neighbor chain algorithm is used, which is O(n^2) in time
+	with a single n * n working matrix
+
+	returns (children, distances) in the scikit-learn tree format
+	"""
+	d = numpy.array(dist, dtype=float)  # a copy, updated in-place below
+	n = len(d)
+	if d.shape != (n, n):
+		raise ValueError("dist must be a square matrix")
+	size = numpy.ones(n, dtype=float) if weights is None \
+		else numpy.array(weights, dtype=float)
+	if size.shape != (n,):
+		raise ValueError("weights must be 1-d array of length len(dist)")
+	numpy.fill_diagonal(d, numpy.inf)
+	merge_slots = list()
+	merge_dists = list()
+	active = numpy.ones(n, dtype=bool)
+	chain = list()
+	for _ in range(n - 1):
+		if not chain:
+			chain.append(numpy.argmax(active))
+		while True:
+			a = chain[-1]
+			b = numpy.argmin(d[a])
+			# prefer the previous chain element on ties to ensure termination
+			if (len(chain) > 1) and (d[a, chain[-2]] <= d[a, b]):
+				b = chain[-2]
+				break
+			chain.append(b)
+		chain.pop()
+		chain.pop()
+		merge_slots.append((a, b))
+		merge_dists.append(d[a, b])
+		# merge b into a by the Lance-Williams formula of weighted average
+		new = (size[a] * d[a] + size[b] * d[b]) / (size[a] + size[b])
+		d[a] = new
+		d[:, a] = new
+		d[a, a] = numpy.inf
+		d[b] = numpy.inf
+		d[:, b] = numpy.inf
+		size[a] += size[b]
+		active[b] = False
+	return sort_and_relabel_merges(merge_slots, merge_dists)
+
+
+class WeightedAverageAgglomerative(sklearn.base.ClusterMixin,
+		sklearn.base.BaseEstimator):
+	"""
+	average linkage agglomerative clustering on precomputed distances with
+	per-sample weights; mimics the attributes of
+	sklearn.cluster.AgglomerativeClustering used with distance_threshold
+	"""
+
+	def __init__(self, *, distance_threshold=None, sample_weight=None):
+		self.distance_threshold = distance_threshold
+		self.sample_weight = sample_weight
+		return
+
+	def fit(self, X, y=None):
+		children, distances = nn_chain_weighted_average(X,
+			weights=self.sample_weight)
+		_set_tree_attributes(self, children, distances, len(X))
+		return self
+
+
+def nn_chain_ward(X) -> tuple:
+	"""
+	ward linkage clustering on features (euclidean), where distances between
+	clusters are calculated on the fly from cluster centroids; the
+	nearest-neighbor chain algorithm is used, which is O(n^2 * d) in time and
+	O(n * d) in memory, no distance matrix is created; merge distances are
+	the same as scipy/sklearn ward linkage, i.e.
+	sqrt(2 * n_a * n_b / (n_a + n_b)) * |c_a - c_b|
+
+	returns (children, distances) in the scikit-learn tree format
+	"""
+	centroid = numpy.array(X, dtype=float)  # a copy, updated in-place below
+	if centroid.ndim != 2:
+		raise ValueError("X must be a 2-d array")
+	n = len(centroid)
+	size = numpy.ones(n, dtype=float)
+	sq_norm = numpy.einsum("ij,ij->i", centroid, centroid)
+	active = numpy.ones(n, dtype=bool)
+
+	def sq_dist_from(a):
+		# squared ward distances from cluster a to all clusters
+		ret = sq_norm + sq_norm[a] - 2 * (centroid @ centroid[a])
+		numpy.maximum(ret, 0, out=ret)
+		ret *= 2 * size * size[a] / (size + size[a])
+		ret[~active] = numpy.inf
+		ret[a] = numpy.inf
+		return ret
+
+	merge_slots = list()
+	merge_dists = list()
+	chain = list()
+	in_chain = numpy.zeros(n, dtype=bool)
+	for _ in range(n - 1):
+		if not chain:
+			chain.append(numpy.argmax(active))
+			in_chain[chain[-1]] = True
+		while True:
+			a = chain[-1]
+			sq_dist = sq_dist_from(a)
+			b = numpy.argmin(sq_dist)
+			# prefer the previous chain element on ties to ensure termination
+			if (len(chain) > 1) and (sq_dist[chain[-2]] <= sq_dist[b]):
+				b = chain[-2]
+				break
+			if in_chain[b]:
+				# only by rounding errors in near-ties; rewind the chain to b
+				while chain[-1] != b:
+					in_chain[chain.pop()] = False
+				continue
+			chain.append(b)
+			in_chain[b] = True
+		in_chain[chain.pop()] = False
+		in_chain[chain.pop()] = False
+		merge_slots.append((a, b))
+		merge_dists.append(numpy.sqrt(sq_dist[b]))
+		# merge b into a
+		centroid[a] = (size[a] * centroid[a] + size[b] * centroid[b]) \
+			/ (size[a] + size[b])
+		sq_norm[a] = centroid[a] @ centroid[a]
+		size[a] += size[b]
+		active[b] = False
+	return sort_and_relabel_merges(merge_slots, merge_dists)
+
+
+class TreeCache(object):
+	"""
+	holds the full tree of one input, the first one a model is fit on with
+	this cache, so that refitting on the same input (e.g. by cutoff
+	optimizers) is free; fits on other inputs (e.g. null references of the
+	gap statistic) are not cached and do not evict it; copies of this object
+	(e.g. by sklearn.base.clone) share the cache, and the cache is not sent
+	to other processes
+	"""
+
+	def __init__(self):
+		self._cache = (None, None)
+		return
+
+	def get(self, X):
+		return self._cache[1] if self._cache[0] is X else None
+
+	def set(self, X, tree) -> None:
+		if self._cache[0] is None:
+			self._cache = (X, tree)
+		return
+
+	def __deepcopy__(self, memo):
+		return self
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state["_cache"] = (None, None)
+		return state
+
+
+class WardAgglomerative(sklearn.base.ClusterMixin,
+		sklearn.base.BaseEstimator):
+	"""
+	ward linkage agglomerative clustering on features without a distance
+	matrix, see nn_chain_ward(); if <tree_cache> (a TreeCache) is set, the
+	full tree is only built once; mimics the attributes of
+	sklearn.cluster.AgglomerativeClustering used with distance_threshold
+	"""
+	# ward linkage is only defined with euclidean distances
+	metric = "euclidean"
+
+	def __init__(self, *, tree_cache=None, distance_threshold=None):
+		self.tree_cache = tree_cache
+		self.distance_threshold = distance_threshold
+		return
+
+	def fit(self, X, y=None):
+		tree = None if self.tree_cache is None else self.tree_cache.get(X)
+		if tree is None:
+			tree = nn_chain_ward(X)
+			if self.tree_cache is not None:
+				self.tree_cache.set(X, tree)
+		_set_tree_attributes(self, *tree, len(X))
+		return self
+
+
+def connectivity_average_linkage(graph) -> tuple:
+	"""
+	average linkage clustering where only clusters connected by an edge in
+	<graph> can be merged; graph is a sparse symmetric matrix of distances
+	along its edges, and must be connected; as in scikit-learn, the distance
+	between two connected clusters is the size-weighted average of the
+	distances along the edges between them
+
+	scikit-learn's own connectivity-constrained average linkage is not used,
+	since it either needs the full n * n precomputed distance matrix, or
+	recalculates the edge distances from features with a scikit-learn metric
+	name (or a python callable per pair of samples), which does not cover the
+	ClusterMetric metrics; here the edge distances calculated blockwise when
+	building the graph are used as they are
+
+	returns (children, distances) in the scikit-learn tree format
+	"""
+	graph = scipy.sparse.coo_matrix(graph)
+	n = graph.shape[0]
+	# neighbors[i] maps each cluster connected to cluster i to the distance
+	neighbors = [dict() for _ in range(2 * n - 1)]
+	heap = list()
+	for a, b, d in zip(graph.row.tolist(), graph.col.tolist(),
+			graph.data.tolist()):
+		if a != b:
+			neighbors[a][b] = d
+			if a < b:
+				heap.append((d, a, b))
+	heapq.heapify(heap)
+	size = [1] * n + [0] * (n - 1)
+	active = [True] * (2 * n - 1)
+	children = list()
+	distances = list()
+	for node in range(n, 2 * n - 1):
+		# closest pair of connected clusters, skipping stale heap entries
+		while True:
+			if not heap:
+				raise ValueError("graph must be connected")
+			d, a, b = heapq.heappop(heap)
+			if active[a] and active[b]:
+				break
+		active[a] = active[b] = False
+		children.append((a, b))
+		distances.append(d)
+		n_a, n_b = size[a], size[b]
+		size[node] = n_a + n_b
+		merged, other = neighbors[a], neighbors[b]
+		neighbors[a] = neighbors[b] = None
+		del merged[b], other[a]
+		for c, d_b in other.items():
+			d_a = merged.get(c)
+			merged[c] = d_b if d_a is None \
+				else (n_a * d_a + n_b * d_b) / (n_a + n_b)
+		for c, d in merged.items():
+			neighbors[c].pop(a, None)
+			neighbors[c].pop(b, None)
+			neighbors[c][node] = d
+			heapq.heappush(heap, (d, c, node))
+		neighbors[node] = merged
+	return numpy.array(children, dtype=int).reshape(-1, 2), \
+		numpy.array(distances, dtype=float)
+
+
+class KNNConnectivity(object):
+	"""
+	callable building the sparse, symmetric k-nearest-neighbor graph of the
+	samples, with distances by <metric> along its edges; distances are
+	calculated in blocks of <block_size> rows so that memory use is
+	O(block_size * n); if the graph has multiple connected components, each
+	pair of components is linked by its closest pair of samples;
+
+	like TreeCache, the graph of the first input is cached, and graphs of
+	other inputs (e.g. null references of the gap statistic) neither are
+	cached nor evict it; copies of this object (e.g. by sklearn.base.clone)
+	share the cache; the minimum and maximum of all pairwise distances of the
+	first input are recorded as dist_min_ and dist_max_
+	"""
+
+	def __init__(self, n_neighbors: int, metric, *, block_size: int = 1024):
+		self.n_neighbors = n_neighbors
+		self.metric = metric
+		self.block_size = block_size
+		self._cache = (None, None)
+		return
+
+	def __call__(self, X) -> scipy.sparse.csr_matrix:
+		if self._cache[0] is X:
+			return self._cache[1]
+		n = len(X)
+		k = min(self.n_neighbors, n - 1)
+		neighbors = numpy.empty((n, k), dtype=int)
+		neighbor_dist = numpy.empty((n, k), dtype=float)
+		dist_min, dist_max = numpy.inf, -numpy.inf
+		for start, dist in self._iter_dist_blocks(X):
+			dist_min = min(dist_min, dist.min())
+			dist_max = max(dist_max, dist.max())
+			# exclude self from neighbors
+			dist[numpy.arange(len(dist)), numpy.arange(start,
+				start + len(dist))] = numpy.inf
+			idx = numpy.argpartition(dist, k - 1, axis=1)[:, :k]
+			neighbors[start:start + len(dist)] = idx
+			neighbor_dist[start:start + len(dist)] = \
+				numpy.take_along_axis(dist, idx, axis=1)
+		row = numpy.repeat(numpy.arange(n), k)
+		col = neighbors.ravel()
+		edge_dist = neighbor_dist.ravel()
+		n_comps, comps = scipy.sparse.csgraph.connected_components(
+			scipy.sparse.csr_matrix((numpy.ones(len(row)), (row, col)),
+				shape=(n, n)), directed=False)
+		if n_comps > 1:
+			warnings.warn("knn graph has %u connected components, linking "
+				"them by their closest pairs of samples" % n_comps)
+			links = self._link_components(X, comps, n_comps)
+			row, col, edge_dist = [numpy.concatenate(i)
+				for i in zip((row, col, edge_dist), links)]
+		graph = self._symmetric_graph(n, row, col, edge_dist)
+		if self._cache[0] is None:
+			self._cache = (X, graph)
+			self.dist_min_, self.dist_max_ = dist_min, dist_max
+		return graph
+
+	def __deepcopy__(self, memo):
+		return self
+
+	def __getstate__(self):
+		# do not send the cached graph to other processes
+		state = self.__dict__.copy()
+		state["_cache"] = (None, None)
+		return state
+
+	def _iter_dist_blocks(self, X):
+		for start in range(0, len(X), self.block_size):
+			yield start, self.metric(X[start:start + self.block_size], X)
+		return
+
+	def _link_components(self, X, comps, n_comps) -> tuple:
+		# closest pair of samples between each pair of components
+		best_dist = numpy.full((n_comps, n_comps), numpy.inf)
+		best_pair = numpy.zeros((n_comps, n_comps, 2), dtype=int)
+		comp_cols = [numpy.flatnonzero(comps == c) for c in range(n_comps)]
+		for start, dist in self._iter_dist_blocks(X):
+			rows = numpy.arange(start, start + len(dist))
+			for c, cols in enumerate(comp_cols):
+				sub = dist[:, cols]
+				col_min = sub.argmin(axis=1)
+				row_min = sub[numpy.arange(len(sub)), col_min]
+				for a in numpy.unique(comps[rows]):
+					if a == c:
+						continue
+					mask = numpy.flatnonzero(comps[rows] == a)
+					i = mask[row_min[mask].argmin()]
+					if row_min[i] < best_dist[a, c]:
+						best_dist[a, c] = row_min[i]
+						best_pair[a, c] = rows[i], cols[col_min[i]]
+		a, c = numpy.triu_indices(n_comps, k=1)
+		return best_pair[a, c, 0], best_pair[a, c, 1], best_dist[a, c]
+
+	@staticmethod
+	def _symmetric_graph(n, row, col, edge_dist) -> scipy.sparse.csr_matrix:
+		# symmetric graph without duplicated edges, explicit zero distances
+		# (identical samples) are kept as edges
+		row, col = numpy.concatenate([row, col]), numpy.concatenate([col, row])
+		edge_dist = numpy.concatenate([edge_dist, edge_dist])
+		key, idx = numpy.unique(row * n + col, return_index=True)
+		return scipy.sparse.csr_matrix((edge_dist[idx], (key // n, key % n)),
+			shape=(n, n))
+
+
+class KNNAverageAgglomerative(sklearn.base.ClusterMixin,
+		sklearn.base.BaseEstimator):
+	"""
+	average linkage agglomerative clustering on features, where only clusters
+	connected in the graph built by <connectivity> (a KNNConnectivity) can be
+	merged, see connectivity_average_linkage(); only distances along the graph
+	edges are calculated; mimics the attributes of
+	sklearn.cluster.AgglomerativeClustering used with distance_threshold
+	"""
+
+	def __init__(self, *, connectivity=None, distance_threshold=None):
+		self.connectivity = connectivity
+		self.distance_threshold = distance_threshold
+		return
+
+	@property
+	def metric(self):
+		return self.connectivity.metric
+
+	def fit(self, X, y=None):
+		children, distances = connectivity_average_linkage(
+			self.connectivity(X))
+		_set_tree_attributes(self, children, distances, len(X))
+		return self
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import os
+import typing
+
+import matplotlib.colors
+import numpy
+import PIL.Image  # matplotlib dependency
+
+# custom lib
+from . import future
+
+
+class HeatmapTileSource(object):
+	"""
+	full-resolution pixels of the spectra heatmap in dendrogram order, each
+	spectrum is one pixel; color bars (e.g. opu and biosample) are placed on
+	the left of the heatmap for rows and on the top for columns, the first
+	spectrum is at the top-left corner of the heatmap
+
+	data: either the precomputed distance matrix, or the spectra to calculate
+		distances from by <metric>
+	rows: the row of each spectrum in data, in dendrogram order
+	metric: ClusterMetric
+	precomputed: True if data is the distance matrix
+	bar_colors: list of n_spectra * 3 (rgb) or n_spectra * 4 (rgba, alpha is
+		ignored) arrays in dendrogram order, one for each bar
+	bar_width: width of each bar in pixels
+	vmin, vmax: the color scale of the heatmap
+	"""
+	def __init__(self, *, data, rows, metric, precomputed: bool,
+			bar_colors: list, bar_width: int, vmin: float, vmax: float):
+		self.data = data
+		self.rows = numpy.asarray(rows)
+		self.metric = metric
+		self.precomputed = precomputed
+		self.bar_colors = [numpy.asarray(i, dtype=numpy.float32)[:, :3]
+			for i in bar_colors]
+		self.bar_width = bar_width
+		self.cmap = future.get_mpl_cmap(metric.cmap)
+		self.norm = matplotlib.colors.Normalize(vmin=vmin, vmax=vmax)
+		return
+
+	@property
+	def n_spectra(self) -> int:
+		return len(self.rows)
+
+	@property
+	def margin(self) -> int:
+		# the space taken by bars on the left and top
+		return self.bar_width * len(self.bar_colors)
+
+	@property
+	def size(self) -> int:
+		return self.margin + self.n_spectra
+
+	def calc_dist(self, r_start, r_stop, c_start, c_stop) -> numpy.ndarray:
+		rows = self.rows[r_start:r_stop]
+		cols = self.rows[c_start:c_stop]
+		if self.precomputed:
+			return self.data[numpy.ix_(rows, cols)]
+		return self.metric(self.data[rows], self.data[cols])
+
+	def get_pixels(self, y_start, y_stop, x_start, x_stop) -> numpy.ndarray:
+		# rgb of pixels in the region, float32
+		ret = numpy.ones((y_stop - y_start, x_stop - x_start, 3),
+			dtype=numpy.float32)
+		m = self.margin
+		# heatmap
+		ys, xs = max(y_start, m), max(x_start, m)
+		if (ys < y_stop) and (xs < x_stop):
+			data = self.metric.to_plot_data(self.calc_dist(ys - m, y_stop - m,
+				xs - m, x_stop - m))
+			ret[ys - y_start:, xs - x_start:] = \
+				self.cmap(self.norm(data))[:, :, :3]
+		# bars, left for rows and top for columns
+		for i, colors in enumerate(self.bar_colors):
+			b_start, b_stop = i * self.bar_width, (i + 1) * self.bar_width
+			lo, hi = max(x_start, b_start), min(x_stop, b_stop)
+			if (lo < hi) and (ys < y_stop):
+				ret[ys - y_start:, lo - x_start:hi - x_start] = \
+					colors[ys - m:y_stop - m, None]
+			lo, hi = max(y_start, b_start), min(y_stop, b_stop)
+			if (lo < hi) and (xs < x_stop):
+				ret[lo - y_start:hi - y_start, xs - x_start:] = \
+					colors[None, xs - m:x_stop - m]
+		return ret
+
+
+class DeepZoomPyramid(object):
+	"""
+	write a HeatmapTileSource as a deep zoom image (.dzi), i.e. a pyramid of
+	png tiles which can be browsed by static web viewers such as
+	OpenSeadragon; the full-resolution level is calculated tile by tile, and
+	each lower level averages 2 * 2 pixels of the level above, so that no
+	level is created as a whole
+
+	tile_size: width and height of tiles in pixels
+	n_jobs: number of worker processes calculating tiles in parallel; None
+		means using all cpus
+	"""
+	def __init__(self, *, tile_size=256, n_jobs=None):
+		self.tile_size = tile_size
+		self.n_jobs = n_jobs
+		return
+
+	def save(self, f: str, source: HeatmapTileSource) -> None:
+		"""
+		write the pyramid as <f> (xml descriptor) and the tiles in directory
+		<f without .dzi>_files
+		"""
+		size = source.size
+		max_level = int(numpy.ceil(numpy.log2(size))) if size > 1 else 0
+		tile_dir = os.path.splitext(f)[0] + "_files"
+		for level in range(max_level + 1):
+			os.makedirs(os.path.join(tile_dir, str(level)), exist_ok=True)
+		builder = _TileBuilder(source, tile_dir=tile_dir,
+			tile_size=self.tile_size, max_level=max_level)
+		# tiles under each tile of split_level are calculated by a worker
+		n_jobs = self.n_jobs or os.cpu_count() or 1
+		split_level = 0
+		while (split_level < max_level) \
+				and (numpy.prod(builder.n_tiles(split_level)) < 2 * n_jobs):
+			split_level += 1
+		if n_jobs == 1:
+			builder.build(0, 0, 0)
+		else:
+			with concurrent.futures.ProcessPoolExecutor(n_jobs,
+					initializer=_init_tile_worker,
+					initargs=(builder,)) as executor:
+				n_cols, n_rows = builder.n_tiles(split_level)
+				split = {(split_level, c, r): executor.submit(
+						_build_tile_in_worker, split_level, c, r)
+					for c in range(n_cols) for r in range(n_rows)}
+				builder.build(0, 0, 0, split=split)
+		with open(f, "w") as fp:
+			fp.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+				'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+				'Format="png" Overlap="0" TileSize="%u">'
+				'<Size Width="%u" Height="%u"/></Image>\n'
+				% (self.tile_size, size, size))
+		return
+
+
+class _TileBuilder(object):
+	# builds a tile from the 4 tiles below it recursively; tiles are carried
+	# as (sum of rgb, number of full-resolution pixels) of each pixel
+	def __init__(self, source, *, tile_dir, tile_size, max_level):
+		self.source = source
+		self.tile_dir = tile_dir
+		self.tile_size = tile_size
+		self.max_level = max_level
+		return
+
+	def level_size(self, level) -> int:
+		scale = 2 ** (self.max_level - level)
+		return -(-self.source.size // scale)
+
+	def n_tiles(self, level) -> tuple:
+		n = -(-self.level_size(level) // self.tile_size)
+		return n, n
+
+	def build(self, level, col, row, *,
+			split: typing.Optional[dict] = None) -> tuple:
+		# split: futures of tiles calculated by workers
+		if (split is not None) and ((level, col, row) in split):
+			return split.pop((level, col, row)).result()
+		t = self.tile_size
+		size = self.level_size(level)
+		h, w = min(t, size - row * t), min(t, size - col * t)
+		if level == self.max_level:
+			rgb_sum = self.source.get_pixels(row * t, row * t + h, col * t,
+				col * t + w)
+			count = numpy.ones((h, w), dtype=numpy.float32)
+		else:
+			rgb_sum = numpy.zeros((2 * t, 2 * t, 3), dtype=numpy.float32)
+			count = numpy.zeros((2 * t, 2 * t), dtype=numpy.float32)
+			n_cols, n_rows = self.n_tiles(level + 1)
+			for dc in range(2):
+				for dr in range(2):
+					c, r = 2 * col + dc, 2 * row + dr
+					if (c >= n_cols) or (r >= n_rows):
+						continue
+					s, n = self.build(level + 1, c, r, split=split)
+					nh, nw = n.shape
+					rgb_sum[dr * t:dr * t + nh, dc * t:dc * t + nw] = s
+					count[dr * t:dr * t + nh, dc * t:dc * t + nw] = n
+			# 2 * 2 pixels of the level above are summed into one
+			rgb_sum = _sum_2x2(rgb_sum[:2 * h, :2 * w])
+			count = _sum_2x2(count[:2 * h, :2 * w])
+		rgb = numpy.clip(rgb_sum / count[:, :, None] * 255, 0, 255)
+		PIL.Image.fromarray(rgb.round().astype(numpy.uint8)).save(
+			os.path.join(self.tile_dir, str(level), "%u_%u.png" % (col, row)))
+		return rgb_sum, count
+
+
+def _sum_2x2(a) -> numpy.ndarray:
+	return a[0::2, 0::2] + a[1::2, 0::2] + a[0::2, 1::2] + a[1::2, 1::2]
+
+
+_worker_builder = None
+
+
+def _init_tile_worker(builder):
+	global _worker_builder
+	_worker_builder = builder
+	return
+
+
+def _build_tile_in_worker(level, col, row) -> tuple:
+	return _worker_builder.build(level, col, row)
@@ -3,7 +3,7 @@
 import argparse
 import sys
 
-from . import util
+from . import stage_scheduler, util
 
 # i/o libraries
 from . import spectra_dataset
@@ -33,6 +33,11 @@ class OPUAnalysis(AnalysisFeatureScoreRoutine, AnalysisAbundanceRoutine,
 		ap.add_argument("--dpi", type=util.PosInt, default=300,
 			metavar="int",
 			help="dpi in plot outputs [300]")
+		ap.add_argument("--output-jobs", type=util.PosInt, default=None,
+			metavar="int",
+			help="number of worker processes writing outputs concurrently after "
+				"the clustering; outputs not depending on each other are made "
+				"in parallel, 1 makes them one after another [all cpus]")
 
 		ag = ap.add_argument_group("dataset reconcile and normalize")
 		ag.add_argument("--bin-size", "-b", type=util.PosFloat, default=None,
@@ -57,11 +62,69 @@ class OPUAnalysis(AnalysisFeatureScoreRoutine, AnalysisAbundanceRoutine,
 			choices=cls.metric_reg.list_keys(),
 			help="distance metric used in HCA [%s]"
 				% cls.metric_reg.default_key)
+		ag.add_argument("--clustering-engine", type=str, default="hca",
+			choices=["hca"] + cls.clustering_engine_reg.list_keys(),
+			help="clustering engine used to find OPUs; engines other than "
+				"'hca' do not create the all-pairs distance matrix, but ignore "
+				"HCA-only arguments and cannot make --opu-hca-plot [hca]")
+		ag.add_argument("--engine-n-clusters", type=util.PosInt, default=8,
+			metavar="int",
+			help="number of clusters [8]; this argument only works when set "
+				"--clustering-engine=minibatch_kmeans or bisecting_kmeans")
+		ag.add_argument("--engine-min-cluster-size", type=util.PosInt,
+			default=5, metavar="int",
+			help="minimum cluster size [5]; this argument only works when set "
+				"--clustering-engine=hdbscan")
+		ag.add_argument("--engine-random-seed", type=int, default=None,
+			metavar="int",
+			help="random seed used by randomized clustering engines [none]")
+		ag.add_argument("--linkage", type=str, default="average",
+			choices=["average", "complete", "single", "ward"],
+			help="linkage method used in HCA; 'ward' requires --metric "
+				"euclidean, and is calculated from spectra without the all-pairs "
+				"distance matrix [average]")
 		ag.add_argument("--cutoff-threshold", "-t", default=0.7,
 			type=cls.cutoff_opt_reg.argparse_type,
 			metavar=("|").join(["float"]
 				+ cls.cutoff_opt_reg.list_keys()),
 			help="OPU clustering cutoff threshold [0.7]")
+		ag.add_argument("--cutoff-silhouette-sample-size", type=util.NonNegInt,
+			default=2000, metavar="int",
+			help="estimate silhouette on a random sample of this many "
+				"spectra, 0 means use all spectra [2000]; this argument only "
+				"works when set --cutoff-threshold=silhouette")
+		ag.add_argument("--cutoff-gap-n-refs", type=util.PosInt, default=10,
+			metavar="int",
+			help="number of null reference datasets used by gap statistic "
+				"[10]; this argument only works when set --cutoff-threshold=gap")
+		ag.add_argument("--cutoff-gap-reference", type=str, default="pca",
+			choices=["uniform", "pca"],
+			help="draw gap statistic null references uniformly in the data's "
+				"bounding box (uniform) or in the box aligned to its principal "
+				"components (pca) [pca]; this argument only works when set "
+				"--cutoff-threshold=gap")
+		ag.add_argument("--cutoff-random-seed", type=int, default=None,
+			metavar="int",
+			help="random seed used by randomized cutoff optimizers [none]")
+		ag.add_argument("--cutoff-jobs", type=util.PosInt, default=None,
+			metavar="int",
+			help="number of worker processes used by parallel cutoff "
+				"optimizers, e.g. gap [all cpus]")
+		ag.add_argument("--micro-clusters", type=util.NonNegInt, default=0,
+			metavar="int",
+			help="if non-zero, first compress spectra into this many "
+				"micro-clusters by mini-batch k-means, then run HCA on the "
+				"micro-cluster centroids weighted by their sizes; this avoids "
+				"the all-pairs distance matrix of spectra, allowing analysis "
+				"of very large datasets [0]")
+		ag.add_argument("--micro-cluster-seed", type=int, default=None,
+			metavar="int",
+			help="random seed used in micro-clustering [none]")
+		ag.add_argument("--knn-connectivity", type=util.NonNegInt, default=0,
+			metavar="int",
+			help="if non-zero, only merge clusters connected in the k-nearest-"
+				"neighbor graph of spectra with this k; the graph is built "
+				"blockwise, and the all-pairs distance matrix is not kept [0]")
 		ag.add_argument("--max-n-opus", "-M", type=util.NonNegInt, default=0,
 			metavar="int",
 			help="maximum number of top-sized clusters to be reported as OPU, 0 "
@@ -78,10 +141,55 @@ class OPUAnalysis(AnalysisFeatureScoreRoutine, AnalysisAbundanceRoutine,
 			metavar="prefix",
 			help="if set, output spectral data files, each corresponds to a "
 				"recognized OPU; used as prefix of generated files [no]")
+		ag.add_argument("--hca-state-save", type=str,
+			metavar="npz",
+			help="if set, save the clustering results (labels, cutoff, linkage "
+				"matrix, dendrogram) to this file, which can be loaded by "
+				"--hca-state-load in later runs [no]")
+		ag.add_argument("--hca-state-with-dist", action="store_true",
+			help="also save the condensed distance matrix with "
+				"--hca-state-save, so that --opu-hca-plot does not recompute "
+				"it after loading [off]")
+		ag.add_argument("--hca-state-load", type=str,
+			metavar="npz",
+			help="if set, load the clustering results saved by "
+				"--hca-state-save instead of running the clustering; the "
+				"dataset must be the same, and clustering arguments are "
+				"ignored [no]")
+		ag.add_argument("--opu-model", type=str,
+			metavar="json",
+			help="if set, export OPUs as a model file, which can be used by "
+				"opu_assign script to assign new spectra to these OPUs [no]")
+		ag.add_argument("--opu-model-reference", type=str, default="both",
+			choices=["centroid", "representative", "both"],
+			help="reference spectra of each OPU saved in the model: the mean "
+				"spectrum, the spectra nearest to the mean, or both [both]")
+		ag.add_argument("--opu-model-n-representatives", type=util.PosInt,
+			default=5, metavar="int",
+			help="number of representative spectra of each OPU saved in the "
+				"model [5]")
 		ag.add_argument("--opu-hca-plot", type=str,
 			metavar="png",
 			help="if set, output OPU clustering heatmap and dendrogram to this "
 				"image file [no]")
+		ag.add_argument("--opu-hca-tiles", type=str,
+			metavar="dzi",
+			help="if set, export the full-resolution OPU clustering heatmap with "
+				"OPU and biosample bars as a deep zoom (.dzi) tile pyramid, "
+				"which can be browsed by static web viewers such as "
+				"OpenSeadragon; tiles are written to the directory "
+				"<dzi without extension>_files [no]")
+		ag.add_argument("--opu-hca-tile-size", type=util.PosInt, default=256,
+			metavar="int",
+			help="width and height of tiles in --opu-hca-tiles [256]")
+		ag.add_argument("--opu-hca-tile-jobs", type=util.PosInt, default=None,
+			metavar="int",
+			help="number of worker processes calculating tiles in "
+				"--opu-hca-tiles [all cpus]")
+		ag.add_argument("--opu-hca-heatmap-reduce", type=str, default="mean",
+			choices=["mean", "max"],
+			help="with more spectra than pixels, each heatmap pixel shows the "
+				"mean or max of the spectra pairs it covers [mean]")
 
 		ag = ap.add_argument_group("abundance analysis")
 		ag.add_argument("--abund-table", type=str,
@@ -90,6 +198,35 @@ class OPUAnalysis(AnalysisFeatureScoreRoutine, AnalysisAbundanceRoutine,
 		ag.add_argument("--abund-alpha-diversity", type=str,
 			metavar="txt",
 			help="if set, output OPU alpha diversity to this file [no]")
+		ag.add_argument("--abund-rarefy-replicates", type=util.NonNegInt, default=0,
+			metavar="int",
+			help="if positive, add rarefied shannon index and richness of "
+				"OPUs with confidence intervals from this many resampled "
+				"replicates to the alpha diversity file [0]")
+		ag.add_argument("--abund-rarefy-depth", type=util.PosInt,
+			default=None, metavar="int",
+			help="number of spectra resampled from each biosample in "
+				"rarefied alpha diversity [smallest biosample]")
+		ag.add_argument("--abund-rarefy-resampling", type=str,
+			default="hypergeometric", choices=["hypergeometric", "multinomial"],
+			help="resample spectra without (hypergeometric, i.e. "
+				"rarefaction) or with replacement (multinomial, i.e. "
+				"bootstrap) [hypergeometric]")
+		ag.add_argument("--abund-rarefy-confidence", type=util.OpenFraction,
+			default=0.95, metavar="float",
+			help="confidence level of the intervals of rarefied alpha "
+				"diversity and rarefaction curves [0.95]")
+		ag.add_argument("--abund-rarefaction-plot", type=str,
+			metavar="png",
+			help="if set, plot rarefaction curves of OPU richness and "
+				"shannon index to this image file [no]")
+		ag.add_argument("--abund-rarefaction-replicates", type=util.PosInt,
+			default=200, metavar="int",
+			help="number of resampled replicates at each depth of the "
+				"rarefaction curves [200]")
+		ag.add_argument("--abund-random-seed", type=int, default=None,
+			metavar="int",
+			help="random seed used in resampling spectra [none]")
 		ag.add_argument("--abund-stackbar-plot", type=str,
 			metavar="png",
 			help="if set, plot abundance stackbar to this image file [no]")
@@ -118,6 +255,26 @@ class OPUAnalysis(AnalysisFeatureScoreRoutine, AnalysisAbundanceRoutine,
 			choices=cls.score_meth.list_keys(),
 			help="feature ranking (scoring) method [%s]"
 				% cls.score_meth.default_key)
+		ag.add_argument("--feature-rank-jobs", type=util.PosInt,
+			default=None, metavar="int",
+			help="number of worker processes ranking subsamples in parallel "
+				"with --feature-rank-subsamples; all built-in methods score "
+				"all OPUs at once, only third-party methods scoring one OPU "
+				"at a time also score OPUs in parallel [all cpus]")
+		ag.add_argument("--feature-rank-subsamples", type=util.NonNegInt, default=0,
+			metavar="int",
+			help="if positive, rank features on this many stratified "
+				"subsamples instead of on all spectra, and report the "
+				"consensus rank and the rank stability of each wavenumber "
+				"[0]")
+		ag.add_argument("--feature-rank-subsample-size", type=util.PosInt,
+			default=200, metavar="int",
+			help="number of spectra drawn from each OPU per subsample, which "
+				"bounds the cost of each ranking [200]; this argument only "
+				"works when set --feature-rank-subsamples")
+		ag.add_argument("--feature-rank-random-seed", type=int, default=None,
+			metavar="int",
+			help="random seed used in drawing subsamples [none]")
 		ag.add_argument("--feature-rank-table", type=str,
 			metavar="tsv",
 			help="if set, write feature index table into this file [no]")
@@ -147,38 +304,134 @@ class OPUAnalysis(AnalysisFeatureScoreRoutine, AnalysisAbundanceRoutine,
 			),
 		)
 
+		if (args.opu_hca_plot or args.opu_hca_tiles) \
+				and (args.clustering_engine != "hca"):
+			raise ValueError("--opu-hca-plot and --opu-hca-tiles require "
+				"--clustering-engine=hca")
 		# run hca analysis, i.e. opu clustering
 		# opu_min_size can be int(>=0), float(0<=x<=1), a str looks like an int
 		# or float aforementioned, or None
-		opu_anal.run_hca(metric=args.metric, cutoff=args.cutoff_threshold,
-			max_n_opus=args.max_n_opus, opu_min_size=args.opu_min_size)
+		if args.cutoff_threshold == "silhouette":
+			cutoff_opt_params = dict(
+				sample_size=args.cutoff_silhouette_sample_size,
+				random_state=args.cutoff_random_seed,
+			)
+		elif args.cutoff_threshold == "gap":
+			cutoff_opt_params = dict(
+				n_refs=args.cutoff_gap_n_refs,
+				reference=args.cutoff_gap_reference,
+				n_jobs=args.cutoff_jobs,
+				random_state=args.cutoff_random_seed,
+			)
+		else:
+			cutoff_opt_params = None
+		if args.clustering_engine in ["minibatch_kmeans", "bisecting_kmeans"]:
+			engine_params = dict(
+				n_clusters=args.engine_n_clusters,
+				random_state=args.engine_random_seed,
+			)
+		elif args.clustering_engine == "hdbscan":
+			engine_params = dict(min_cluster_size=args.engine_min_cluster_size)
+		else:
+			engine_params = None
+		if args.hca_state_load:
+			opu_anal.load_hca_state(args.hca_state_load)
+		elif args.clustering_engine == "hca":
+			opu_anal.run_hca(metric=args.metric, cutoff=args.cutoff_threshold,
+				linkage=args.linkage,
+				max_n_opus=args.max_n_opus, opu_min_size=args.opu_min_size,
+				cutoff_opt_params=cutoff_opt_params,
+				n_micro_clusters=args.micro_clusters,
+				random_state=args.micro_cluster_seed,
+				n_neighbors=args.knn_connectivity)
+		else:
+			opu_anal.run_clustering(engine=args.clustering_engine,
+				metric=args.metric, max_n_opus=args.max_n_opus,
+				opu_min_size=args.opu_min_size, engine_params=engine_params)
+		# outputs are made by stages run concurrently; the distance matrix is
+		# only sent to workers if a stage reads it
+		stages = stage_scheduler.StageScheduler(opu_anal,
+			n_jobs=args.output_jobs, optional_attrs=["dist_mat"])
+		if args.hca_state_save:
+			stages.add("hca_state", "save_hca_state", params=dict(
+				f=args.hca_state_save, with_dist=args.hca_state_with_dist),
+				uses=["dist_mat"] if args.hca_state_with_dist else [])
 		# save opu clustering data
-		opu_anal.save_opu_labels(args.opu_labels, delimiter=args.delimiter)
-		opu_anal.save_opu_collections(args.opu_collection_prefix)
-		opu_anal.plot_opu_hca(plot_to=args.opu_hca_plot, dpi=args.dpi)
+		if args.opu_labels:
+			stages.add("opu_labels", "save_opu_labels", params=dict(
+				f=args.opu_labels, delimiter=args.delimiter))
+		if args.opu_collection_prefix:
+			stages.add("opu_collections", "save_opu_collections", params=dict(
+				prefix=args.opu_collection_prefix))
+		if args.opu_model:
+			stages.add("opu_model", "save_opu_model", params=dict(
+				f=args.opu_model, reference=args.opu_model_reference,
+				n_representatives=args.opu_model_n_representatives))
+		if args.opu_hca_plot:
+			stages.add("opu_hca_plot", "plot_opu_hca", params=dict(
+				plot_to=args.opu_hca_plot, dpi=args.dpi,
+				heatmap_reduce=args.opu_hca_heatmap_reduce),
+				uses=["dist_mat"])
+		if args.opu_hca_tiles:
+			if not args.opu_hca_tiles.endswith(".dzi"):
+				args.opu_hca_tiles += ".dzi"
+			stages.add("opu_hca_tiles", "plot_opu_hca", params=dict(
+				plot_to=args.opu_hca_tiles, tile_size=args.opu_hca_tile_size,
+				n_jobs=args.opu_hca_tile_jobs), uses=["dist_mat"])
 
 		# run opu abundance analysis and plot
-		opu_anal.save_opu_abundance_table(args.abund_table,
-			delimiter=args.delimiter)
-		opu_anal.save_opu_alpha_diversity(args.abund_alpha_diversity,
-			delimiter=args.delimiter)
-		opu_anal.plot_opu_abundance_stackbar(plot_to=args.abund_stackbar_plot,
-			dpi=args.dpi)
+		if args.abund_table:
+			stages.add("abund_table", "save_opu_abundance_table", params=dict(
+				f=args.abund_table, delimiter=args.delimiter))
+		if args.abund_alpha_diversity:
+			stages.add("abund_alpha_diversity", "save_opu_alpha_diversity",
+				params=dict(f=args.abund_alpha_diversity,
+					delimiter=args.delimiter,
+					n_replicates=args.abund_rarefy_replicates,
+					depth=args.abund_rarefy_depth,
+					resampling=args.abund_rarefy_resampling,
+					confidence=args.abund_rarefy_confidence,
+					random_state=args.abund_random_seed))
+		if args.abund_rarefaction_plot:
+			stages.add("abund_rarefaction_plot", "plot_opu_rarefaction_curves",
+				params=dict(plot_to=args.abund_rarefaction_plot, dpi=args.dpi,
+					n_replicates=args.abund_rarefaction_replicates,
+					resampling=args.abund_rarefy_resampling,
+					confidence=args.abund_rarefy_confidence,
+					random_state=args.abund_random_seed))
+		if args.abund_stackbar_plot:
+			stages.add("abund_stackbar_plot", "plot_opu_abundance_stackbar",
+				params=dict(plot_to=args.abund_stackbar_plot, dpi=args.dpi))
 		if args.abund_biplot_method == "t-sne":
 			method_params = dict(perplexity=args.abund_biplot_tsne_perplexity)
 		else:
 			method_params = None
-		opu_anal.plot_opu_abundance_biplot(plot_to=args.abund_biplot,
-			method=args.abund_biplot_method, method_params=method_params,
-			fig_width=args.abund_biplot_figsize,
-			fig_height=args.abund_biplot_figsize,
-			label_fontsize=args.abund_biplot_label_fontsize,
-			dpi=args.dpi)
-
-		# run feature ranking analysis and save results
-		opu_anal.rank_features(args.feature_rank_method)
-		opu_anal.save_opu_feature_rank_table(args.feature_rank_table,
-			delimiter=args.delimiter)
-		opu_anal.plot_opu_feature_rank(plot_to=args.feature_rank_plot,
-			dpi=args.dpi)
+		if args.abund_biplot:
+			stages.add("abund_biplot", "plot_opu_abundance_biplot", params=dict(
+				plot_to=args.abund_biplot, method=args.abund_biplot_method,
+				method_params=method_params,
+				fig_width=args.abund_biplot_figsize,
+				fig_height=args.abund_biplot_figsize,
+				label_fontsize=args.abund_biplot_label_fontsize,
+				dpi=args.dpi))
+
+		# run feature ranking analysis and save results; the outputs run
+		# after ranking in the same worker
+		if args.feature_rank_table or args.feature_rank_plot:
+			stages.add("feature_rank", "rank_features", params=dict(
+				method=args.feature_rank_method,
+				n_jobs=args.feature_rank_jobs,
+				n_subsamples=args.feature_rank_subsamples,
+				subsample_size=args.feature_rank_subsample_size,
+				random_state=args.feature_rank_random_seed),
+				uses=[] if args.feature_rank_subsamples else ["dist_mat"])
+		if args.feature_rank_table:
+			stages.add("feature_rank_table", "save_opu_feature_rank_table",
+				after="feature_rank", params=dict(f=args.feature_rank_table,
+					delimiter=args.delimiter))
+		if args.feature_rank_plot:
+			stages.add("feature_rank_plot", "plot_opu_feature_rank",
+				after="feature_rank", params=dict(
+					plot_to=args.feature_rank_plot, dpi=args.dpi))
+		stages.run()
 		return
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+import contextlib
+import json
+import sys
+import typing
+
+import numpy
+
+# custom lib
+from . import registry, util
+from . import cli_util
+from .spectra_dataset import SpectraDataset
+
+
+class OPUModel(object):
+	"""
+	a fitted opu model, holding reference spectra of each opu (centroids
+	and/or representative spectra), together with the preprocessing
+	parameters, metric and cutoff used to find the opus; new spectra are
+	assigned to the opu of their nearest reference spectrum, which costs
+	O(n * k) instead of rerunning the O(n^2) clustering
+
+	ARGUMENTS
+	=========
+	wavenum: 1-d vector of float, wavenumbers of the reference spectra
+	ref_intens: 2-d vector of float, the reference spectra
+	ref_labels: 1-d vector of int, the (remapped) opu label of each reference
+	ref_names: list of str or None, the spectrum name of each reference, None
+		for centroids
+	opu_sizes: dict, opu label -> number of spectra in the opu
+	metric: str, key of the cluster metric
+	cutoff: float or None, the hca cutoff used to find the opus
+	linkage: str or None, the hca linkage used to find the opus
+	preprocessing: dict, keyword arguments of SpectraDataset.from_file() to
+		load and preprocess new spectra the same way as the fitted ones; empty
+		if unknown
+	"""
+	metric_reg = registry.get("cluster_metric")
+	format_name = "opu_model"
+	format_version = 1
+	# SpectraDataset.from_file() arguments recorded as preprocessing
+	preprocessing_keys = ("bin_size", "wavenum_low", "wavenum_high",
+		"normalize")
+
+	def __init__(self, *, wavenum, ref_intens, ref_labels, ref_names=None,
+			opu_sizes: typing.Optional[dict] = None,
+			metric=metric_reg.default_key, cutoff=None, linkage=None,
+			preprocessing: typing.Optional[dict] = None):
+		self.wavenum = numpy.asarray(wavenum, dtype=float)
+		self.ref_intens = numpy.asarray(ref_intens, dtype=float)
+		self.ref_labels = numpy.asarray(ref_labels, dtype=int)
+		if ref_names is None:
+			ref_names = [None] * len(self.ref_labels)
+		self.ref_names = list(ref_names)
+		if self.ref_intens.shape != (len(self.ref_labels), len(self.wavenum)):
+			raise ValueError("ref_intens must be of shape "
+				"len(ref_labels) * len(wavenum)")
+		if len(self.ref_names) != len(self.ref_labels):
+			raise ValueError("ref_names and ref_labels have unmatched size")
+		self.opu_sizes = dict() if opu_sizes is None else dict(opu_sizes)
+		self.metric_key = metric
+		self.metric = self.metric_reg.get(metric)
+		self.cutoff = cutoff
+		self.linkage = linkage
+		self.preprocessing = dict() if preprocessing is None \
+			else {k: v for k, v in preprocessing.items()
+				if k in self.preprocessing_keys}
+		# references are grouped by opu label to reduce distances per opu
+		order = numpy.argsort(self.ref_labels, kind="stable")
+		self._sorted_refs = self.ref_intens[order]
+		self.opu_labels, self._group_starts = numpy.unique(
+			self.ref_labels[order], return_index=True)
+		return
+
+	@property
+	def n_opus(self) -> int:
+		return len(self.opu_labels)
+
+	@classmethod
+	def from_analysis(cls, anal, *, reference="both", n_representatives=5):
+		"""
+		create model from an analysis object after its opus are found, e.g.
+		by OPUAnalysis.run_hca(); only opus reported by the analysis (i.e.
+		passed opu_min_size and max_n_opus) are included
+
+		reference: 'centroid', 'representative', or 'both'; use the mean
+			spectrum of each opu, its <n_representatives> spectra nearest to
+			the mean, or both as the reference spectra
+		"""
+		if reference not in ("centroid", "representative", "both"):
+			raise ValueError("reference must be 'centroid', 'representative' "
+				"or 'both', got '%s'" % reference)
+		intens = anal.dataset.intens
+		ref_intens, ref_labels, ref_names = list(), list(), list()
+		opu_sizes = dict()
+		for label, idx in anal.opu_spectra_index.items():
+			if label is None:
+				continue
+			opu_sizes[label] = len(idx)
+			centroid = intens[idx].mean(axis=0, keepdims=True)
+			if reference in ("centroid", "both"):
+				ref_intens.append(centroid)
+				ref_labels.append(label)
+				ref_names.append(None)
+			if reference in ("representative", "both"):
+				dist = anal.metric(intens[idx], centroid).ravel()
+				rep = idx[numpy.argsort(dist, kind="stable")
+					[:n_representatives]]
+				ref_intens.append(intens[rep])
+				ref_labels.extend([label] * len(rep))
+				ref_names.extend(anal.dataset.spectra_names[rep])
+		if not opu_sizes:
+			raise ValueError("no opu found in the analysis")
+		return cls(wavenum=anal.dataset.wavenum,
+			ref_intens=numpy.vstack(ref_intens), ref_labels=ref_labels,
+			ref_names=ref_names, opu_sizes=opu_sizes, metric=anal.metric_key,
+			cutoff=anal.cutoff, linkage=anal.linkage,
+			preprocessing=anal.reconcile_param)
+
+	def save(self, f) -> None:
+		opus = list()
+		for label in self.opu_labels.tolist():
+			mask = self.ref_labels == label
+			opus.append(dict(
+				label=label,
+				n_spectra=self.opu_sizes.get(label),
+				ref_names=[self.ref_names[i] for i in numpy.flatnonzero(mask)],
+				ref_intens=self.ref_intens[mask].tolist(),
+			))
+		cfg = dict(
+			format=self.format_name,
+			format_version=self.format_version,
+			metric=self.metric_key,
+			cutoff=None if self.cutoff is None else float(self.cutoff),
+			linkage=self.linkage,
+			preprocessing=self.preprocessing,
+			wavenum=self.wavenum.tolist(),
+			opus=opus,
+		)
+		with util.get_fp(f, "w") as fp:
+			json.dump(cfg, fp)
+		return
+
+	@classmethod
+	def load(cls, f):
+		cfg = util.load_json(f)
+		if cfg.get("format") != cls.format_name:
+			raise ValueError("not an opu model file")
+		if cfg.get("format_version") != cls.format_version:
+			raise ValueError("unsupported opu model format version: %s"
+				% str(cfg.get("format_version")))
+		ref_intens, ref_labels, ref_names = list(), list(), list()
+		for opu in cfg["opus"]:
+			ref_intens.extend(opu["ref_intens"])
+			ref_labels.extend([opu["label"]] * len(opu["ref_intens"]))
+			ref_names.extend(opu["ref_names"])
+		return cls(wavenum=cfg["wavenum"], ref_intens=ref_intens,
+			ref_labels=ref_labels, ref_names=ref_names,
+			opu_sizes={opu["label"]: opu["n_spectra"] for opu in cfg["opus"]},
+			metric=cfg["metric"], cutoff=cfg["cutoff"], linkage=cfg["linkage"],
+			preprocessing=cfg["preprocessing"])
+
+	def load_dataset(self, f, **kw) -> SpectraDataset:
+		"""
+		load new spectra from file, preprocessed in the same way as the
+		fitted spectra; **kw are forwarded to SpectraDataset.from_file()
+		"""
+		dataset = SpectraDataset.from_file(f, **self.preprocessing, **kw)
+		self._check_wavenum(dataset, f)
+		return dataset
+
+	def iter_load_dataset(self, f, *, chunk_size=4096, **kw
+			) -> typing.Iterator[SpectraDataset]:
+		"""
+		load new spectra from file as in load_dataset(), but yield them as
+		datasets of at most <chunk_size> spectra each, so that the whole file
+		is never loaded at once; **kw are forwarded to
+		SpectraDataset.iter_file_chunks()
+		"""
+		for dataset in SpectraDataset.iter_file_chunks(f,
+				chunk_size=chunk_size, **self.preprocessing, **kw):
+			self._check_wavenum(dataset, f)
+			yield dataset
+		return
+
+	def _check_wavenum(self, dataset: SpectraDataset, f) -> None:
+		if (len(dataset.wavenum) != len(self.wavenum)) \
+				or (not numpy.allclose(dataset.wavenum, self.wavenum)):
+			raise ValueError("wavenumbers of '%s' are incompatible with the "
+				"model after preprocessing" % f)
+		return
+
+	def iter_assign(self, X, *, top_k=1, max_dist=None, chunk_size=4096):
+		"""
+		assign spectra in X to their nearest opus, in chunks of <chunk_size>
+		spectra; the distance to an opu is the distance to its nearest
+		reference spectrum
+
+		top_k: report the nearest <top_k> opus of each spectrum
+		max_dist: None, float, or 'cutoff'; if set, opus farther than this
+			distance are reported as -1; 'cutoff' uses the model cutoff
+
+		yields (labels, dists) for each chunk, both of shape
+		chunk_size * top_k, sorted by distance
+		"""
+		if max_dist == "cutoff":
+			if self.cutoff is None:
+				raise ValueError("max_dist='cutoff' requires a model with "
+					"cutoff")
+			max_dist = self.cutoff
+		top_k = min(top_k, self.n_opus)
+		X = numpy.asarray(X, dtype=float)
+		if X.shape[1:] != self.wavenum.shape:
+			raise ValueError("X must be of shape n_spectra * len(wavenum)")
+		for start in range(0, len(X), chunk_size):
+			# distance to each reference, then the nearest within each opu
+			dist = self.metric(X[start:start + chunk_size], self._sorted_refs)
+			dist = numpy.minimum.reduceat(dist, self._group_starts, axis=1)
+			if top_k < self.n_opus:
+				idx = numpy.argpartition(dist, top_k - 1, axis=1)[:, :top_k]
+			else:
+				idx = numpy.broadcast_to(numpy.arange(self.n_opus), dist.shape)
+			top_dist = numpy.take_along_axis(dist, idx, axis=1)
+			order = numpy.argsort(top_dist, axis=1, kind="stable")
+			idx = numpy.take_along_axis(idx, order, axis=1)
+			top_dist = numpy.take_along_axis(top_dist, order, axis=1)
+			labels = self.opu_labels[idx]
+			if max_dist is not None:
+				labels[top_dist > max_dist] = -1
+			yield labels, top_dist
+		return
+
+	def assign(self, X, **kw) -> tuple:
+		"""
+		assign all spectra in X, see iter_assign() for arguments; returns
+		(labels, dists), both of shape n_spectra * top_k
+		"""
+		labels, dists = list(), list()
+		for l, d in self.iter_assign(X, **kw):
+			labels.append(l)
+			dists.append(d)
+		if not labels:
+			top_k = min(kw.get("top_k", 1), self.n_opus)
+			return numpy.empty((0, top_k), dtype=int), \
+				numpy.empty((0, top_k), dtype=float)
+		return numpy.vstack(labels), numpy.vstack(dists)
+
+	# cli commands
+	@classmethod
+	def cli_get_args(cls, argv_override=None):
+		ap = cli_util.ArgumentParser(description="assign new spectra to the "
+			"OPUs of a model exported by opu_analysis --opu-model")
+		ap.add_argument("model", type=str,
+			help="opu model json file")
+		ap.add_argument("input", type=str, nargs="+",
+			help="input spectra dataset file(s), preprocessed in the same way "
+				"as recorded in the model")
+		ap.add_argument("--output", "-o", type=str, default=None,
+			metavar="txt",
+			help="output file, each line has the spectrum name, then the label "
+				"and distance of each of the nearest OPUs; labels of OPUs "
+				"farther than --max-dist are reported as '-' [<stdout>]")
+		ap.add_argument("--top-k", "-k", type=util.PosInt, default=1,
+			metavar="int",
+			help="report this many nearest OPUs of each spectrum [1]")
+		ap.add_argument("--max-dist", type=str, default=None,
+			metavar="float|cutoff",
+			help="if set, OPUs farther than this distance are not assigned; "
+				"'cutoff' uses the cutoff recorded in the model [off]")
+		ap.add_argument("--chunk-size", type=util.PosInt, default=4096,
+			metavar="int",
+			help="number of spectra assigned in each batch [4096]")
+		ap.add_argument_delimiter()
+		ap.add_argument_with_spectra_names()
+		args = ap.parse_args(argv_override)
+		if (args.max_dist is not None) and (args.max_dist != "cutoff"):
+			args.max_dist = util.NonNegFloat(args.max_dist)
+		if args.output is None:
+			args.output = sys.stdout
+		return args
+
+	@classmethod
+	def cli_main(cls, argv_override=None):
+		args = cls.cli_get_args(argv_override=argv_override)
+		model = cls.load(args.model)
+		# only close the output if opened here, not <stdout>
+		with (open(args.output, "w") if isinstance(args.output, str)
+				else contextlib.nullcontext(args.output)) as fp:
+			for f in args.input:
+				# read and assign the input in chunks
+				for dataset in model.iter_load_dataset(f,
+						chunk_size=args.chunk_size, delimiter=args.delimiter,
+						with_spectra_names=args.with_spectra_names):
+					labels, dists = model.assign(dataset.intens,
+						top_k=args.top_k, max_dist=args.max_dist,
+						chunk_size=args.chunk_size)
+					for name, l, d in zip(dataset.spectra_names,
+							labels.tolist(), dists.tolist()):
+						fields = [name]
+						for i, j in zip(l, d):
+							fields.extend(["-" if i < 0 else str(i), str(j)])
+						print(args.delimiter.join(fields), file=fp)
+		return
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import numpy
+
+
+RESAMPLING = ("multinomial", "hypergeometric")
+
+
+def iter_resampled_counts(counts, depth, n_replicates, *,
+		resampling="hypergeometric", random_state=None):
+	"""
+	draw <n_replicates> samples of <depth> individuals from each row of the
+	count matrix <counts> (n_samples * n_categories) at once, and yield the
+	drawn counts of each category in turn, each n_replicates * n_samples;
+	categories are drawn one after another conditioned on the previous ones,
+	by binomial draws for multinomial resampling (with replacement, i.e.
+	bootstrap) or hypergeometric draws for resampling without replacement
+	(rarefaction), vectorized across samples and replicates
+
+	depth: scalar or one per sample; samples with fewer individuals than
+		depth are drawn at their total instead, see resampled_diversity()
+	"""
+	if resampling not in RESAMPLING:
+		raise ValueError("resampling must be one of %s, got '%s'"
+			% (", ".join(RESAMPLING), resampling))
+	counts = numpy.asarray(counts, dtype=numpy.int64)
+	rng = numpy.random.default_rng(random_state)
+	# individuals in this and all later categories
+	suffix = numpy.cumsum(counts[:, ::-1], axis=1)[:, ::-1]
+	need = numpy.minimum(numpy.broadcast_to(depth, suffix[:, 0].shape),
+		suffix[:, 0])
+	need = numpy.repeat(need[None, :], n_replicates, axis=0)
+	for k in range(counts.shape[1]):
+		c = counts[:, k]
+		rest = suffix[:, k] - c
+		if resampling == "multinomial":
+			p = numpy.divide(c, suffix[:, k], out=numpy.zeros(len(c)),
+				where=suffix[:, k] > 0)
+			x = rng.binomial(need, p)
+		else:
+			x = rng.hypergeometric(c, rest, need)
+		need = need - x
+		yield x
+	return
+
+
+def resampled_diversity(counts, depth, n_replicates, *,
+		resampling="hypergeometric", random_state=None) -> dict:
+	"""
+	shannon index and richness (number of categories present) of each
+	resampled replicate of each sample, see iter_resampled_counts(); returns
+	a dict of 'shannon' and 'richness', each n_replicates * n_samples;
+	samples with fewer individuals than <depth> are nan
+	"""
+	counts = numpy.asarray(counts, dtype=numpy.int64)
+	shape = (n_replicates, len(counts))
+	depth = numpy.broadcast_to(depth, shape[1:])
+	total = numpy.minimum(depth, counts.sum(axis=1))
+	# accumulated per category, without the replicates of all categories
+	x_log_x = numpy.zeros(shape, dtype=float)
+	richness = numpy.zeros(shape, dtype=float)
+	for x in iter_resampled_counts(counts, depth, n_replicates,
+			resampling=resampling, random_state=random_state):
+		x_log_x += x * numpy.log(numpy.maximum(x, 1))
+		richness += x > 0
+	# H = -sum(x / n * ln(x / n)) = ln(n) - sum(x * ln(x)) / n
+	with numpy.errstate(invalid="ignore", divide="ignore"):
+		shannon = numpy.abs(numpy.log(total) - x_log_x / total)
+	short = counts.sum(axis=1) < depth
+	shannon[:, short] = numpy.nan
+	richness[:, short] = numpy.nan
+	return dict(shannon=shannon, richness=richness)
+
+
+def summarize_replicates(values, confidence=0.95) -> tuple:
+	"""
+	mean and the lower and upper bounds of the percentile interval at
+	<confidence> of replicates along the first axis
+	"""
+	if not (0 < confidence < 1):
+		raise ValueError("confidence must be between 0 and 1, got %f"
+			% confidence)
+	alpha = (1 - confidence) / 2
+	with numpy.errstate(invalid="ignore"):
+		low, high = numpy.quantile(values, [alpha, 1 - alpha], axis=0)
+	return values.mean(axis=0), low, high
+
+
+def rarefaction_curves(counts, depths, n_replicates, *,
+		resampling="hypergeometric", confidence=0.95, random_state=None) -> dict:
+	"""
+	resampled shannon index and richness of each sample at each of <depths>;
+	returns a dict of 'shannon' and 'richness', each a tuple of the mean,
+	lower and upper bounds (see summarize_replicates()), n_depths * n_samples;
+	samples with fewer individuals than a depth are nan at that depth
+	"""
+	seeds = numpy.random.SeedSequence(random_state).spawn(len(depths))
+	ret = dict(shannon=list(), richness=list())
+	for d, seed in zip(depths, seeds):
+		div = resampled_diversity(counts, d, n_replicates,
+			resampling=resampling, random_state=seed)
+		for k, v in div.items():
+			ret[k].append(summarize_replicates(v, confidence))
+	return {k: tuple(numpy.stack(i) for i in zip(*v)) for k, v in ret.items()}
@@ -1,7 +1,22 @@
 #!/usr/bin/env python3
 
+import importlib
+
 _REGISTRY_STUB = dict()
 
+# modules creating each registry; a registry not created yet is created by
+# importing its module on the first get(), so that modules using a registry
+# need not import its (possibly heavy) module in advance
+_REGISTRY_MODULES = {
+	"cluster_metric": ".cluster_metric",
+	"clustering_engine": ".clustering_engine",
+	"dim_red_visualize": ".dim_red_visualize",
+	"feature_score": ".feature_score",
+	"hca_cutoff_optimizer": ".hca_cutoff_optimizer",
+	"normalize": ".normalize",
+	"dataset_manip_subcmd": ".spectra_dataset_manip",
+}
+
 
 def new(*ka, reg_type=None, **kw):
 	if reg_type is None:
@@ -17,6 +32,9 @@ def new(*ka, reg_type=None, **kw):
 
 
 def get(registry_name):
+	if (registry_name not in _REGISTRY_STUB) \
+			and (registry_name in _REGISTRY_MODULES):
+		importlib.import_module(_REGISTRY_MODULES[registry_name], __package__)
 	return _REGISTRY_STUB[registry_name]
 
 
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import collections
+import itertools
 import numbers
 import os
 import warnings
@@ -130,6 +131,59 @@ class SpectraDataset(object):
 				must be the same as number of samples;
 		"""
 		raw = numpy.loadtxt(f, delimiter=delimiter, dtype=object)
+		return cls._from_raw(raw, f=f, name=name,
+			with_spectra_names=with_spectra_names, bin_size=bin_size,
+			wavenum_low=wavenum_low, wavenum_high=wavenum_high,
+			normalize=normalize)
+
+	@classmethod
+	def iter_file_chunks(cls, f: str, *, chunk_size=1000, delimiter="\t",
+			name=None, with_spectra_names=None, bin_size=None,
+			wavenum_low=400.0, wavenum_high=1800.0,
+			normalize=norm_meth.default_key):
+		"""
+		read spectra dataset from text file in the same format as from_file(),
+		but yield it as datasets of at most <chunk_size> spectra each, so that
+		the whole table is never loaded at once; all chunks are binned,
+		filtered and normalized in the same way, hence have the same wavenum;
+
+		with_spectra_names: same as in from_file(); auto-detection is done on
+			the first chunk and applied to all chunks; a list of str is split
+			into chunks accordingly; if not parsed from the file or given as a
+			list, spectra names are numbered across chunks, without zero
+			filling since the number of spectra is not known in advance
+		"""
+		with util.get_fp(f, "r") as fp:
+			header = fp.readline()
+			start = 0
+			while True:
+				lines = list(itertools.islice(fp, chunk_size))
+				if not lines:
+					break
+				raw = numpy.loadtxt([header] + lines, delimiter=delimiter,
+					dtype=object, ndmin=2)
+				if with_spectra_names is None:
+					with_spectra_names = cls._1st_col_looks_names(raw)
+				if with_spectra_names is True:
+					chunk_names = True
+				elif isinstance(with_spectra_names, (bool, str)):
+					fmt = "%u" if with_spectra_names is False \
+						else with_spectra_names + "_%u"
+					chunk_names = [fmt % (start + i + 1)
+						for i in range(len(raw) - 1)]
+				else:
+					chunk_names = with_spectra_names[start:start + len(raw) - 1]
+				yield cls._from_raw(raw, f=f, name=name,
+					with_spectra_names=chunk_names, bin_size=bin_size,
+					wavenum_low=wavenum_low, wavenum_high=wavenum_high,
+					normalize=normalize)
+				start += len(raw) - 1
+		return
+
+	@classmethod
+	def _from_raw(cls, raw: numpy.ndarray, *, f, name, with_spectra_names,
+			bin_size, wavenum_low, wavenum_high, normalize):
+		# create dataset from the table read as str, see from_file()
 		if (((with_spectra_names is None) and cls._1st_col_looks_names(raw)) or
 			(with_spectra_names is True)):
 			# we only need to parse names from file under these two conditions
@@ -2,18 +2,21 @@
 
 import abc
 import argparse
+import concurrent.futures
 import os
 import shutil
 import sys
 import tempfile
+import typing
 
+# matplotlib and mpllayout are imported by the plotting functions only, so
+# that subcommands not plotting start fast
 import numpy
-import matplotlib
-import mpllayout
 
 from . import registry
 from . import cli_util
 from .spectra_dataset import SpectraDataset
+from .spectra_histogram import SpectraHistogram
 
 
 class SpecDatasetManip(object):
@@ -400,22 +403,48 @@ class SpecDatasetManipSubCmdPreview(SpecDatasetManip.SubCmd):
 		sp.add_argument("input", type=str, nargs="?", default="-",
 			help="input dataset to visualize")
 		sp.add_argument("--preview-mode", "-m", type=str, default="overview",
-			choices=["overview", "spectra"],
+			choices=["overview", "spectra", "density", "quantile"],
 			help="plot mode; in overview mode, all spectra will be on the same "
 				"figure, while in spectra mode, each spectra will have its own "
-				"figure [overview]")
+				"figure; density and quantile modes are overviews for large "
+				"datasets, showing the 2-d histogram of intensities at each "
+				"wavenumber as an image, or the median, inter-quartile and "
+				"5-95%% quantile bands, respectively; the input is read in "
+				"chunks in these two modes (see --chunk-size) [overview]")
 		sp.add_argument("--dataset-name", "-n", type=str,
 			metavar="str",
 			help="specify a dataset name to show in figure(s)")
 		sp.add_argument("--plot", "--prefix", "-p", type=str,
 			metavar="file/prefix",
-			help="in spectra mode: the output image file, can be omitted to "
+			help="in overview mode: the output image file, can be omitted to "
 				"open matploblib's interactive window instead; "
 				"spectra mode: required, and will be used as the prefix for "
-				"generated files")
+				"generated files, or the output pdf file with "
+				"--spectra-output pdf")
 		sp.add_argument("--dpi", type=cli_util.util.PosInt, default=300,
 			metavar="int",
 			help="dpi in plot outputs [300]")
+		sp.add_argument("--spectra-output", type=str, default="png",
+			choices=["png", "pdf", "grid"],
+			help="output of spectra mode; png: one <prefix>XXXX.png per "
+				"spectrum; pdf: a multi-page pdf file, one page per spectrum; "
+				"grid: contact sheets <prefix>XXXX.png with spectra laid out "
+				"in a grid (see --grid-shape) [png]")
+		sp.add_argument("--grid-shape", type=cli_util.util.GridShape,
+			default=cli_util.util.GridShape("8x4"), metavar="ROWSxCOLS",
+			help="number of rows and columns of spectra in each contact sheet "
+				"with --spectra-output grid [8x4]")
+		sp.add_argument("--chunk-size", type=cli_util.util.PosInt,
+			default=1000, metavar="int",
+			help="number of spectra read at a time in density and quantile "
+				"modes; the memory use scales with it [1000]")
+		sp.add_argument("--density-bins", type=cli_util.util.PosInt,
+			default=200, metavar="int",
+			help="number of intensity bins in density mode [200]")
+		sp.add_argument("--jobs", type=cli_util.util.PosInt, default=None,
+			metavar="int",
+			help="number of worker processes rendering png files in spectra "
+				"mode, 1 renders them one after another [all cpus]")
 		sp.add_argument_delimiter()
 		sp.add_argument_with_spectra_names()
 		sp.add_argument_verbose()
@@ -423,7 +452,10 @@ class SpecDatasetManipSubCmdPreview(SpecDatasetManip.SubCmd):
 		sp.add_argument_group_binning_and_normalization()
 		return
 
-	def create_layout(self) -> dict:
+	@staticmethod
+	def create_layout() -> dict:
+		import mpllayout
+
 		lc = mpllayout.LayoutCreator(
 			left_margin=0.7,
 			right_margin=0.2,
@@ -446,7 +478,46 @@ class SpecDatasetManipSubCmdPreview(SpecDatasetManip.SubCmd):
 
 		return layout
 
+	@staticmethod
+	def create_grid_layout(n_rows: int, n_cols: int) -> dict:
+		# contact sheet of n_rows * n_cols small axes, listed in layout["specs"]
+		# row by row from the top-left
+		import mpllayout
+
+		lc = mpllayout.LayoutCreator(
+			left_margin=0.5,
+			right_margin=0.2,
+			top_margin=0.4,
+			bottom_margin=0.5,
+		)
+
+		ax_width, ax_height = 2.4, 0.6
+		h_gap, v_gap = 0.3, 0.45
+
+		for i in range(n_rows * n_cols):
+			r, c = divmod(i, n_cols)
+			ax = lc.add_frame("spec_%u" % i)
+			ax.set_anchor("bottomleft", offsets=(c * (ax_width + h_gap),
+				(n_rows - 1 - r) * (ax_height + v_gap)))
+			ax.set_size(ax_width, ax_height)
+
+		# create layout
+		layout = lc.create_figure_layout()
+		layout["specs"] = [layout["spec_%u" % i]
+			for i in range(n_rows * n_cols)]
+
+		# apply axes style
+		for ax in layout["specs"]:
+			for sp in ax.spines.values():
+				sp.set_visible(False)
+			ax.set_facecolor("#f0f0f8")
+			ax.tick_params(labelsize=5)
+
+		return layout
+
 	def _plot_preview_overview(self, d: SpectraDataset) -> None:
+		import matplotlib.pyplot
+
 		# create figure layout
 		layout = self.create_layout()
 		figure = layout["figure"]
@@ -479,19 +550,72 @@ class SpecDatasetManipSubCmdPreview(SpecDatasetManip.SubCmd):
 		matplotlib.pyplot.close()
 		return
 
-	def _plot_spectrum(self, png: str, d: SpectraDataset, index: int, *,
-			title=None) -> None:
+	def _plot_preview_spectra(self, d: SpectraDataset) -> None:
+		args = self.args
+		renderer_kw = dict(dpi=args.dpi, xlim=(d.wavenum_low, d.wavenum_high))
+		if args.spectra_output == "pdf":
+			# pages of a single pdf file are written one after another
+			import matplotlib.backends.backend_pdf
+			renderer = SpectraPreviewRenderer(d.wavenum, **renderer_kw)
+			with matplotlib.backends.backend_pdf.PdfPages(args.plot) as pdf:
+				for intens, n in zip(d.intens, d.spectra_names_with_prefix):
+					renderer.render(pdf, [intens], [n], format="pdf")
+			renderer.close()
+			return
+		if args.spectra_output == "grid":
+			renderer_kw["grid_shape"] = args.grid_shape
+		renderer_kw["prefix"] = args.plot
+		render_spectra_preview(d.wavenum, d.intens,
+			d.spectra_names_with_prefix, n_jobs=args.jobs, **renderer_kw)
+		return
+
+	def _plot_preview_histogram(self, chunks) -> None:
+		# density or quantile mode, spectra are accumulated from chunks into
+		# a SpectraHistogram
+		import matplotlib.colors
+		import matplotlib.pyplot
+
+		args = self.args
+		if args.preview_mode == "density":
+			hist = SpectraHistogram(n_bins=args.density_bins,
+				max_bins=2 * args.density_bins)
+		else:
+			hist = SpectraHistogram()
+		d = None
+		for d in chunks:
+			hist.add(d.intens)
+		if d is None:
+			raise ValueError("no spectra found in input")
+
 		# create figure layout
 		layout = self.create_layout()
 		figure = layout["figure"]
-		figure.set_dpi(self.args.dpi)
+		figure.set_dpi(args.dpi)
 
-		# plot each spectra, lumped together
 		ax = layout["spec"]
 		wavenum = d.wavenum
-		intens = d.intens[index]
-		ax.plot(d.wavenum, d.intens[index], linestyle="-", linewidth=1.0,
-			color="#4040ff", zorder=2)
+		if args.preview_mode == "density":
+			# wavenumber bin edges at midpoints between wavenumbers
+			mid = (wavenum[1:] + wavenum[:-1]) / 2
+			wavenum_edges = numpy.concatenate([[2 * wavenum[0] - mid[0]], mid,
+				[2 * wavenum[-1] - mid[-1]]]) if len(mid) else \
+				numpy.array([wavenum[0] - 0.5, wavenum[0] + 0.5])
+			ax.pcolormesh(wavenum_edges, hist.intens_edges,
+				numpy.ma.masked_equal(hist.counts, 0), cmap="Blues",
+				norm=matplotlib.colors.LogNorm(), rasterized=True, zorder=2)
+			# add mean line
+			ax.plot(wavenum, hist.mean, linestyle="-", linewidth=0.5,
+				color="#000000", zorder=3, label="mean")
+		else:
+			q05, q25, q50, q75, q95 = hist.quantile([0.05, 0.25, 0.5, 0.75,
+				0.95])
+			ax.fill_between(wavenum, q05, q95, edgecolor="none",
+				facecolor="#4040ff", alpha=0.2, zorder=2, label="5-95%")
+			ax.fill_between(wavenum, q25, q75, edgecolor="none",
+				facecolor="#4040ff", alpha=0.4, zorder=2, label="IQR")
+			ax.plot(wavenum, q50, linestyle="-", linewidth=0.5,
+				color="#000000", zorder=3, label="median")
+			ax.legend(loc="upper left", ncol=3, fontsize=6, frameon=False)
 		# add x axis line
 		ax.axhline(0, linestyle="-", linewidth=1.0, color="#c0c0c0", zorder=1)
 
@@ -499,28 +623,27 @@ class SpecDatasetManipSubCmdPreview(SpecDatasetManip.SubCmd):
 		ax.set_xlim(d.wavenum_low, d.wavenum_high)
 		ax.set_xlabel("Wavenumber (cm$^{-1}$)")
 		ax.set_ylabel("Intensity (AU)")
-		ax.set_title(title)
+		ax.set_title("%s (n=%u)" % (d.name, hist.n_spectra))
 
 		# save fig and clean up
-		figure.savefig(png, dpi=self.args.dpi)
+		if args.plot:
+			figure.savefig(args.plot, dpi=args.dpi)
+		else:
+			matplotlib.pyplot.show()
 		matplotlib.pyplot.close()
 		return
 
-	def _plot_preview_spectra(self, d: SpectraDataset) -> None:
-		prefix = self.args.plot
-		for i, n in enumerate(d.spectra_names_with_prefix):
-			self._plot_spectrum("%s%04u.png" % (prefix, i), d, i, title=n)
-		return
-
 	def plot_preview(self, d: SpectraDataset) -> None:
 		args = self.args
 		if args.preview_mode == "overview":
 			self._plot_preview_overview(d)
 		elif args.preview_mode == "spectra":
 			self._plot_preview_spectra(d)
+		elif args.preview_mode in ["density", "quantile"]:
+			self._plot_preview_histogram([d])
 		else:
-			raise ValueError("mode can only be 'overview' or 'spectra', "
-				"not '%s'" % mode)
+			raise ValueError("mode can only be 'overview', 'spectra', "
+				"'density' or 'quantile', not '%s'" % args.preview_mode)
 		return
 
 	def run(self):
@@ -531,10 +654,137 @@ class SpecDatasetManipSubCmdPreview(SpecDatasetManip.SubCmd):
 		if (args.preview_mode == "spectra") and (not args.plot):
 			raise ValueError("--prefix/-p is requried in spectra mode")
 
-		dataset = SpectraDataset.from_file(args.input, name=args.dataset_name,
+		load_kw = dict(name=args.dataset_name,
 			with_spectra_names=args.with_spectra_names,
 			delimiter=args.delimiter, bin_size=args.bin_size,
 			wavenum_low=args.wavenum_low, wavenum_high=args.wavenum_high,
 			normalize=args.normalize)
+		if args.preview_mode in ["density", "quantile"]:
+			# stream the input without loading it at once
+			self._plot_preview_histogram(SpectraDataset.iter_file_chunks(
+				args.input, chunk_size=args.chunk_size, **load_kw))
+			return
+		dataset = SpectraDataset.from_file(args.input, **load_kw)
 		self.plot_preview(dataset)
 		return
+
+
+class SpectraPreviewRenderer(object):
+	"""
+	render spectra previews on a single figure created once and reused, only
+	the line data, titles and y-axis limits are updated for each page; a page
+	shows one spectrum, or with grid_shape=(n_rows, n_cols), a contact sheet
+	of up to n_rows * n_cols spectra
+	"""
+	def __init__(self, wavenum, *, dpi: int, xlim: tuple,
+			grid_shape: typing.Optional[tuple] = None):
+		if grid_shape is None:
+			layout = SpecDatasetManipSubCmdPreview.create_layout()
+			self.axes = [layout["spec"]]
+			linewidth = 1.0
+		else:
+			layout = SpecDatasetManipSubCmdPreview.create_grid_layout(
+				*grid_shape)
+			self.axes = layout["specs"]
+			linewidth = 0.5
+		self.figure = layout["figure"]
+		self.figure.set_dpi(dpi)
+		self.dpi = dpi
+
+		self.lines = list()
+		for ax in self.axes:
+			line, = ax.plot(wavenum, numpy.zeros(len(wavenum)), linestyle="-",
+				linewidth=linewidth, color="#4040ff", zorder=2)
+			self.lines.append(line)
+			# add x axis line
+			ax.axhline(0, linestyle="-", linewidth=1.0, color="#c0c0c0",
+				zorder=1)
+			ax.set_xlim(*xlim)
+		if grid_shape is None:
+			ax.set_xlabel("Wavenumber (cm$^{-1}$)")
+			ax.set_ylabel("Intensity (AU)")
+		return
+
+	@property
+	def page_size(self) -> int:
+		return len(self.axes)
+
+	def render(self, f, intens, titles, **kw) -> None:
+		"""
+		save a page of spectra <intens> with <titles> to <f>; extra keyword
+		arguments are passed to figure.savefig()
+		"""
+		for i, (ax, line) in enumerate(zip(self.axes, self.lines)):
+			ax.set_visible(i < len(intens))
+			if i >= len(intens):
+				continue
+			line.set_ydata(intens[i])
+			ax.set_title(titles[i], **({} if self.page_size == 1 else
+				dict(fontsize=6)))
+			ax.relim()
+			ax.autoscale_view()
+		self.figure.savefig(f, dpi=self.dpi, **kw)
+		return
+
+	def close(self) -> None:
+		import matplotlib.pyplot
+		matplotlib.pyplot.close(self.figure)
+		return
+
+
+def render_spectra_preview(wavenum, intens, titles, *, prefix: str,
+		n_jobs: typing.Optional[int] = None, **kw) -> None:
+	"""
+	render spectra previews as png files named <prefix>%04u.png, one per page;
+	pages are split into contiguous chunks rendered by worker processes, each
+	reusing its own SpectraPreviewRenderer; n_jobs=None means using all cpus,
+	and 1 renders in the current process; other keyword arguments are passed
+	to SpectraPreviewRenderer
+	"""
+	grid_shape = kw.get("grid_shape")
+	page_size = 1 if grid_shape is None else grid_shape[0] * grid_shape[1]
+	n_pages = -(-len(intens) // page_size)
+	n_jobs = min(n_jobs or os.cpu_count() or 1, n_pages)
+	if n_jobs <= 1:
+		renderer = SpectraPreviewRenderer(wavenum, **kw)
+		_render_preview_pages(renderer, intens, titles, prefix, 0, n_pages)
+		renderer.close()
+		return
+	chunks = numpy.array_split(numpy.arange(n_pages),
+		min(n_pages, n_jobs * 4))
+	with concurrent.futures.ProcessPoolExecutor(n_jobs,
+			initializer=_init_preview_worker,
+			initargs=(wavenum, intens, titles, prefix, kw)) as executor:
+		futures = [executor.submit(_render_preview_pages_in_worker, i[0],
+			i[-1] + 1) for i in chunks]
+		# re-raise the first exception raised by any worker
+		for future in concurrent.futures.as_completed(futures):
+			future.result()
+	return
+
+
+def _render_preview_pages(renderer, intens, titles, prefix, start,
+		stop) -> None:
+	k = renderer.page_size
+	for i in range(start, stop):
+		renderer.render("%s%04u.png" % (prefix, i),
+			intens[i * k:(i + 1) * k], titles[i * k:(i + 1) * k])
+	return
+
+
+_worker_renderer = None
+_worker_pages = None
+
+
+def _init_preview_worker(wavenum, intens, titles, prefix, kw):
+	global _worker_renderer, _worker_pages
+	import matplotlib
+	matplotlib.use("Agg")
+	_worker_renderer = SpectraPreviewRenderer(wavenum, **kw)
+	_worker_pages = (intens, titles, prefix)
+	return
+
+
+def _render_preview_pages_in_worker(start, stop) -> None:
+	_render_preview_pages(_worker_renderer, *_worker_pages, start, stop)
+	return
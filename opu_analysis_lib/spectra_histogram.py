@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import numpy
+
+
+class SpectraHistogram(object):
+	"""
+	histogram of spectra intensities at each wavenumber, accumulated chunk by
+	chunk with add() so that spectra need not be loaded at once; intensity
+	bins have a fixed width decided by the first chunk, and more bins are
+	added on either side when later chunks fall out of range; before bins
+	are added, adjacent bins are merged in pairs until the range spanned by
+	the bins and the new chunk fits in max_bins, so the memory stays bounded
+	regardless of the intensity range; quantiles
+	are interpolated from the cumulative counts, accurate to one bin width
+
+	n_bins: number of intensity bins spanning the range of the first chunk
+	max_bins: upper limit of the number of intensity bins, at least 2
+	"""
+	def __init__(self, *, n_bins=1024, max_bins=4096):
+		if max_bins < 2:
+			raise ValueError("max_bins must be at least 2, got %d" % max_bins)
+		self.n_bins = n_bins
+		self.max_bins = max_bins
+		self.counts = None
+		self.intens_sum = None
+		# lower edge of bin i is origin + i * bin_width, counts[0] is bin
+		# <offset>
+		self.origin = 0.
+		self.bin_width = 1.
+		self.offset = 0
+		return
+
+	@property
+	def n_spectra(self) -> int:
+		return 0 if self.counts is None else int(self.counts[:, 0].sum())
+
+	@property
+	def intens_edges(self) -> numpy.ndarray:
+		# edges of intensity bins, increasing
+		return self.origin + self.bin_width \
+			* numpy.arange(self.offset, self.offset + len(self.counts) + 1)
+
+	@property
+	def mean(self) -> numpy.ndarray:
+		# mean intensity of finite values at each wavenumber
+		with numpy.errstate(invalid="ignore", divide="ignore"):
+			return self.intens_sum / self.counts.sum(axis=0)
+
+	def add(self, intens) -> None:
+		"""
+		add spectra <intens> (n_spectra * n_wavenum) to the histogram;
+		non-finite values are ignored
+		"""
+		intens = numpy.asarray(intens, dtype=float)
+		valid = numpy.isfinite(intens)
+		if self.counts is None:
+			self._init_bins(intens[valid], intens.shape[1])
+		if not valid.any():
+			return
+		# widen the bins until the range of both the histogram and the chunk
+		# fits in max_bins, before any bins are added
+		values = intens[valid]
+		lo, hi = values.min(), values.max()
+		while self._n_bins_spanning(lo, hi) > self.max_bins:
+			self._merge_bin_pairs()
+		# flat index of (bin, wavenumber) in counts
+		index = numpy.floor((values - self.origin) / self.bin_width)\
+			.astype(numpy.int64)
+		self._extend(index.min(), index.max())
+		index -= self.offset
+		index *= self.counts.shape[1]
+		index += numpy.nonzero(valid)[1]
+		self.counts += numpy.bincount(index, minlength=self.counts.size)\
+			.reshape(self.counts.shape)
+		self.intens_sum += numpy.where(valid, intens, 0).sum(axis=0)
+		return
+
+	def _init_bins(self, values, n_wavenum) -> None:
+		if len(values):
+			lo, hi = values.min(), values.max()
+			self.origin = lo
+			if hi > lo:
+				self.bin_width = (hi - lo) / self.n_bins
+		self.counts = numpy.zeros((0, n_wavenum), dtype=numpy.int64)
+		self.intens_sum = numpy.zeros(n_wavenum, dtype=float)
+		return
+
+	def _n_bins_spanning(self, lo, hi) -> int:
+		# number of bins at the current width spanning the existing bins and
+		# values from <lo> to <hi>
+		first = numpy.floor((lo - self.origin) / self.bin_width)
+		last = numpy.floor((hi - self.origin) / self.bin_width)
+		if len(self.counts):
+			first = min(first, self.offset)
+			last = max(last, self.offset + len(self.counts) - 1)
+		return int(last - first + 1)
+
+	def _extend(self, lo, hi) -> None:
+		# add empty bins so that bins lo to hi (inclusive) exist
+		if not len(self.counts):
+			self.offset = lo
+		n_below = max(self.offset - lo, 0)
+		n_above = max(hi + 1 - self.offset - len(self.counts), 0)
+		if n_below or n_above:
+			self.counts = numpy.pad(self.counts, ((n_below, n_above), (0, 0)))
+			self.offset -= n_below
+		return
+
+	def _merge_bin_pairs(self) -> None:
+		if not len(self.counts):
+			self.bin_width *= 2
+			return
+		# align bins to pairs by an empty bin at either end if necessary
+		self._extend(self.offset - (self.offset % 2),
+			self.offset + len(self.counts) - 1 + (self.offset + len(self.counts))
+			% 2)
+		self.counts = self.counts[0::2] + self.counts[1::2]
+		self.offset //= 2
+		self.bin_width *= 2
+		return
+
+	def quantile(self, q) -> numpy.ndarray:
+		"""
+		quantiles <q> at each wavenumber, interpolated linearly within bins;
+		returns len(q) * n_wavenum array, or 1-d array if q is scalar;
+		wavenumbers without any values have nan
+		"""
+		q = numpy.asarray(q, dtype=float)
+		cum = numpy.cumsum(self.counts, axis=0)
+		total = cum[-1]
+		edges = self.intens_edges
+		ret = numpy.empty((q.size, cum.shape[1]), dtype=float)
+		for i, v in enumerate(q.ravel()):
+			# the first bin reaching the target count; a tiny target for q=0
+			# lands on the first non-empty bin
+			target = numpy.maximum(v * total, 1e-9)
+			b = numpy.minimum((cum < target).sum(axis=0), len(cum) - 1)
+			upper = numpy.take_along_axis(cum, b[None, :], axis=0)[0]
+			count = numpy.take_along_axis(self.counts, b[None, :], axis=0)[0]
+			with numpy.errstate(invalid="ignore", divide="ignore"):
+				frac = numpy.clip((target - upper + count) / count, 0, 1)
+			ret[i] = edges[b] + frac * self.bin_width
+		ret[:, total == 0] = numpy.nan
+		return ret.reshape(q.shape + (cum.shape[1],))
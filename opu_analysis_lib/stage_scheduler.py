@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import copy
+import os
+import typing
+
+import matplotlib
+
+
+class StageScheduler(object):
+	"""
+	run stages, i.e. method calls on an object, concurrently in worker
+	processes using the non-interactive Agg matplotlib backend; a stage can
+	run after another stage, in which case it runs in the same worker after
+	that stage finished, seeing the changes that stage made to the object;
+	stages not depending on each other run in parallel, so the wall time is
+	about that of the slowest chain of dependent stages
+
+	obj: the object whose methods are called; worker processes receive it
+		once when they start
+	n_jobs: number of worker processes; None means using all cpus; with 1,
+		stages run in the current process in the order they are added
+	optional_attrs: names of (large) attributes of obj sent to workers only
+		if a stage lists them in <uses>, otherwise set to None in the copy
+		sent to workers
+	"""
+	def __init__(self, obj, *, n_jobs: typing.Optional[int] = None,
+			optional_attrs: typing.Collection[str] = ()):
+		self.obj = obj
+		self.n_jobs = n_jobs
+		self.optional_attrs = tuple(optional_attrs)
+		self._stages = dict()
+		self._uses = set()
+		return
+
+	def add(self, name: str, method: str, *, after: typing.Optional[str] = None,
+			params: typing.Optional[dict] = None,
+			uses: typing.Collection[str] = ()) -> None:
+		"""
+		add stage <name> calling obj.<method>(**params), optionally after the
+		stage named <after>, which must be added already; <uses> lists the
+		optional attributes of obj the stage reads
+		"""
+		if name in self._stages:
+			raise ValueError("stage '%s' already exists" % name)
+		if (after is not None) and (after not in self._stages):
+			raise ValueError("stage '%s' runs after unknown stage '%s'"
+				% (name, after))
+		root = name if after is None else self._stages[after][0]
+		self._stages[name] = (root, method,
+			dict() if params is None else params)
+		self._uses.update(uses)
+		return
+
+	def iter_chains(self) -> typing.Iterator[list]:
+		"""
+		yield each chain of dependent stages as a list of (method, kw), in the
+		order they run
+		"""
+		chains = dict()
+		for root, method, kw in self._stages.values():
+			chains.setdefault(root, list()).append((method, kw))
+		yield from chains.values()
+
+	def run(self) -> None:
+		chains = list(self.iter_chains())
+		n_jobs = min(self.n_jobs or os.cpu_count() or 1, len(chains))
+		if n_jobs <= 1:
+			for _, method, kw in self._stages.values():
+				getattr(self.obj, method)(**kw)
+			return
+		with concurrent.futures.ProcessPoolExecutor(n_jobs,
+				initializer=_init_stage_worker,
+				initargs=(self._get_worker_obj(),)) as executor:
+			futures = [executor.submit(_run_stage_chain, i) for i in chains]
+			# re-raise the first exception raised by any stage
+			for future in concurrent.futures.as_completed(futures):
+				future.result()
+		return
+
+	def _get_worker_obj(self):
+		# a shallow copy of obj without optional attributes no stage uses
+		drop = [i for i in self.optional_attrs if i not in self._uses]
+		if not drop:
+			return self.obj
+		ret = copy.copy(self.obj)
+		for i in drop:
+			setattr(ret, i, None)
+		return ret
+
+
+_worker_obj = None
+
+
+def _init_stage_worker(obj):
+	global _worker_obj
+	matplotlib.use("Agg")
+	_worker_obj = obj
+	return
+
+
+def _run_stage_chain(chain) -> None:
+	for method, kw in chain:
+		getattr(_worker_obj, method)(**kw)
+	return
@@ -62,6 +62,30 @@ class Fraction(float):
 		return new
 
 
+class OpenFraction(float):
+	def __new__(cls, *ka, **kw):
+		new = super().__new__(cls, *ka, **kw)
+		if (new <= 0) or (new >= 1):
+			raise ValueError("%s must be greater than 0 and less than 1, got "
+				"'%f'" % (cls.__name__, new))
+		return new
+
+
+class GridShape(tuple):
+	"""
+	(n_rows, n_cols) parsed from a string like '8x4'
+	"""
+	def __new__(cls, s: str):
+		try:
+			shape = tuple(PosInt(i) for i in s.lower().split("x"))
+		except ValueError:
+			shape = ()
+		if len(shape) != 2:
+			raise ValueError("%s must be in format ROWSxCOLS of positive "
+				"integers, got '%s'" % (cls.__name__, s))
+		return super().__new__(cls, shape)
+
+
 def get_fp(f, *ka, factory=open, **kw) -> io.IOBase:
 	"""
 	wrapper of file handle open function (default: builtin.open) to make it safe
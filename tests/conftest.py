@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+import matplotlib
+import numpy
+import pytest
+
+matplotlib.use("Agg")
+
+
+def make_blobs(n_per_blob=30, n_blobs=3, n_features=20, *, scale=0.05,
+		random_state=0) -> tuple:
+	"""
+	well separated gaussian blobs of positive 'spectra', each blob raised at
+	its own band of features; returns (X, true labels)
+	"""
+	rng = numpy.random.default_rng(random_state)
+	X, y = list(), list()
+	band = n_features // n_blobs
+	for i in range(n_blobs):
+		center = numpy.full(n_features, 1.0)
+		center[i * band:(i + 1) * band] += 2.0
+		X.append(center + rng.normal(scale=scale, size=(n_per_blob,
+			n_features)))
+		y.extend([i] * n_per_blob)
+	return numpy.vstack(X), numpy.asarray(y)
+
+
+@pytest.fixture
+def blobs():
+	return make_blobs()
+
+
+@pytest.fixture
+def make_analysis():
+	from opu_analysis_lib import OPUAnalysis, SpectraDataset
+
+	def factory(X=None, *, n_biosamples=3):
+		if X is None:
+			X, _ = make_blobs()
+		dataset = SpectraDataset(wavenum=numpy.linspace(400, 1800,
+			X.shape[1]), intens=X, spectra_names="s")
+		biosample = ["b%u" % (i % n_biosamples) for i in range(len(X))]
+		return OPUAnalysis(dataset, biosample=biosample)
+	return factory
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+
+import numpy
+import pytest
+import sklearn.metrics
+
+from opu_analysis_lib import registry
+
+
+def _expected(key, X, Y=None) -> numpy.ndarray:
+	if key == "euclidean":
+		return sklearn.metrics.pairwise.euclidean_distances(X, Y)
+	cos = sklearn.metrics.pairwise.cosine_distances(X, Y)
+	return cos if key == "cosine" else numpy.sqrt(numpy.clip(cos, 0, None))
+
+
+@pytest.mark.parametrize("key", ["euclidean", "cosine", "sqrt_cosine"])
+def test_metric_from_gram_matches_sklearn(key):
+	rng = numpy.random.default_rng(0)
+	X, Y = rng.random((50, 20)), rng.random((7, 20))
+	metric = registry.get("cluster_metric").get(key)
+	dist = metric(X)
+	numpy.testing.assert_allclose(dist, _expected(key, X), atol=1e-12)
+	numpy.testing.assert_allclose(dist, dist.T, atol=1e-12)
+	numpy.testing.assert_array_equal(numpy.diag(dist), 0)
+	numpy.testing.assert_allclose(metric(X, Y), _expected(key, X, Y),
+		atol=1e-12)
+	# the input is not modified
+	numpy.testing.assert_array_equal(X, numpy.random.default_rng(0).random(
+		(50, 20)))
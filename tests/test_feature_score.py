@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import numpy
+
+from opu_analysis_lib import feature_score
+
+
+def _skfeature_lap_score(X, W) -> numpy.ndarray:
+	# dense laplacian score on affinity W, as skfeature's lap_score()
+	D = W.sum(axis=1)
+	tmp = D @ X
+	D_prime = (D[:, None] * X * X).sum(axis=0) - tmp * tmp / D.sum()
+	L_prime = ((W @ X) * X).sum(axis=0) - tmp * tmp / D.sum()
+	D_prime[D_prime < 1e-12] = 10000
+	return 1 - L_prime / D_prime
+
+
+def _fisher_graph(y) -> numpy.ndarray:
+	# skfeature's supervised affinity with fisher_score=True: 1 / n_l between
+	# spectra of class l
+	same = y[:, None] == y[None, :]
+	return same / same.sum(axis=1, keepdims=True)
+
+
+def _skfeature_fisher_rank(X, y) -> numpy.ndarray:
+	score = 1.0 / _skfeature_lap_score(X, _fisher_graph(y)) - 1
+	return numpy.argsort(score)[::-1]
+
+
+def _skfeature_trace_ratio_rank(X, y) -> numpy.ndarray:
+	# skfeature's trace_ratio() with the fisher style, selecting all features
+	n = len(X)
+	W = _fisher_graph(y)
+	s_within = numpy.diag(X.T @ (numpy.eye(n) - W) @ X)
+	s_between = numpy.diag(X.T @ (W - numpy.ones((n, n)) / n) @ X)
+	k = s_between.sum() / s_within.sum()
+	return numpy.argsort(s_between - k * s_within)[::-1]
+
+
+def _noisy_classes(random_state=0) -> tuple:
+	rng = numpy.random.default_rng(random_state)
+	y = rng.integers(0, 4, 120)
+	X = rng.normal(size=(120, 30)) + rng.normal(size=(4, 30))[y] \
+		* numpy.linspace(0, 2, 30)
+	return X, y
+
+
+def test_fisher_score_matches_skfeature():
+	X, y = _noisy_classes()
+	meth = feature_score.FisherScore()
+	numpy.testing.assert_array_equal(meth.feature_score(X, y),
+		_skfeature_fisher_rank(X, y))
+	ovr = _ovr_vs_single(meth, X, y, [0, 1, 2, 3])
+	for c in range(4):
+		numpy.testing.assert_array_equal(ovr[c],
+			_skfeature_fisher_rank(X, (y == c).astype(int)))
+
+
+def test_trace_ratio_matches_skfeature():
+	X, y = _noisy_classes()
+	meth = feature_score.TraceRatio()
+	numpy.testing.assert_array_equal(meth.feature_score(X, y),
+		_skfeature_trace_ratio_rank(X, y))
+	ovr = _ovr_vs_single(meth, X, y, [0, 1, 2, 3])
+	for c in range(4):
+		numpy.testing.assert_array_equal(ovr[c],
+			_skfeature_trace_ratio_rank(X, (y == c).astype(int)))
+
+
+def test_laplacian_score_matches_dense():
+	X, y = _noisy_classes()
+	meth = feature_score.LaplacianScore()
+	graph = meth._graph(X, None, None).toarray()
+	# class-block weights of edges within classes
+	W = numpy.where(y[:, None] == y[None, :], graph, 0) \
+		/ numpy.bincount(y)[y][:, None]
+	numpy.testing.assert_array_equal(meth.feature_score(X, y),
+		numpy.argsort(_skfeature_lap_score(X, W)))
+
+
+def _ovr_vs_single(meth, X, labels, classes):
+	ovr = meth.feature_score_ovr(X, labels, classes, n_jobs=1)
+	codes = feature_score._ovr_class_codes(labels, classes)
+	for i, c in enumerate(classes):
+		single = meth.feature_score(X, (codes == i).astype(int))
+		numpy.testing.assert_array_equal(ovr[c], single)
+	return ovr
+
+
+def test_laplacian_score_ovr_depends_on_class(blobs):
+	X, y = blobs
+	labels = y.astype(object)
+	labels[:3] = None
+	meth = feature_score.LaplacianScore()
+	ovr = _ovr_vs_single(meth, X, labels, [0, 1, 2])
+	# the band of features raised in a blob ranks higher for that blob than
+	# for the others
+	band = X.shape[1] // 3
+	for c in range(3):
+		own = numpy.arange(c * band, (c + 1) * band)
+		pos = {k: numpy.argsort(v)[own].mean() for k, v in ovr.items()}
+		assert pos[c] == min(pos.values())
+	assert len({tuple(v) for v in ovr.values()}) == 3
+
+
+def test_rank_features_ignores_micro_cluster_distances(make_analysis):
+	anal = make_analysis()
+	anal.run_hca(metric="euclidean", cutoff=0.5, n_micro_clusters=20,
+		random_state=0)
+	# a distance matrix between micro-clusters may have as many rows as
+	# spectra, in a different order; it must not be taken as between spectra
+	order = numpy.random.default_rng(0).permutation(anal.dataset.n_spectra)
+	anal.dist_mat = anal.metric(anal.dataset.intens[order])
+	ret = anal.rank_features("lap_score", n_jobs=1)
+	labels = anal.remapped_hca_label_array
+	classes = [i for i in anal.remapped_hca_label_unique if i is not None]
+	expected = feature_score.LaplacianScore().feature_score_ovr(
+		anal.dataset.intens, labels, classes, metric=anal.metric)
+	for c in classes:
+		numpy.testing.assert_array_equal(ret[c], expected[c])
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import numpy
+import pytest
+import sklearn.metrics
+
+from opu_analysis_lib import hca_cutoff_optimizer
+
+
+@pytest.mark.parametrize("cutoff, params", [
+	("silhouette", dict()),
+	("silhouette", dict(sample_size=20, random_state=0)),
+	("calinski_harabasz", dict()),
+	("gap", dict(n_refs=5, n_jobs=1, random_state=0)),
+	("gap", dict(n_refs=5, reference="uniform", n_jobs=2, random_state=0)),
+])
+@pytest.mark.parametrize("linkage", ["average", "ward"])
+def test_cutoff_optimizer_finds_blobs(make_analysis, cutoff, params,
+		linkage):
+	anal = make_analysis()
+	anal.run_hca(metric="euclidean", linkage=linkage, cutoff=cutoff,
+		cutoff_opt_params=params)
+	assert anal.n_clusters == 3
+
+
+@pytest.mark.parametrize("cutoff, params", [
+	("silhouette", dict()),
+	("gap", dict(n_refs=5, n_jobs=1, random_state=0)),
+])
+@pytest.mark.filterwarnings("ignore:knn graph has")
+@pytest.mark.parametrize("mode", [dict(n_micro_clusters=40, random_state=0),
+	dict(n_neighbors=5)])
+def test_cutoff_optimizer_finds_blobs_in_other_modes(make_analysis, cutoff,
+		params, mode):
+	anal = make_analysis()
+	anal.run_hca(metric="euclidean", cutoff=cutoff, cutoff_opt_params=params,
+		**mode)
+	assert anal.n_clusters == 3
+
+
+def test_silhouette_matches_sklearn(blobs):
+	X, y = blobs
+	dist = sklearn.metrics.pairwise_distances(X)
+	rng = numpy.random.default_rng(0)
+	labels_list = [y, rng.integers(0, 5, len(y)),
+		# with singletons
+		numpy.concatenate([numpy.arange(10), numpy.full(len(y) - 10, 10)])]
+	score = hca_cutoff_optimizer.Silhouette(sample_size=0)._calc_silhouette(
+		dist.__getitem__, labels_list, numpy.arange(len(y)))
+	expected = [sklearn.metrics.silhouette_score(dist, i,
+		metric="precomputed") for i in labels_list]
+	numpy.testing.assert_allclose(score, expected)
+
+
+def test_iter_cut_labels_matches_fcluster(blobs):
+	import scipy.cluster.hierarchy
+
+	X, _ = blobs
+	Z = scipy.cluster.hierarchy.linkage(X, method="average")
+	children = Z[:, :2].astype(int)
+	for m, labels in zip([0, 30, 87, 89], hca_cutoff_optimizer.iter_cut_labels(
+			children, [0, 30, 87, 89])):
+		expected = scipy.cluster.hierarchy.fcluster(Z, len(X) - m,
+			criterion="maxclust")
+		assert sklearn.metrics.adjusted_rand_score(labels, expected) == 1
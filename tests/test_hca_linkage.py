@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import numpy
+import pytest
+import scipy.cluster.hierarchy
+import scipy.spatial.distance
+import sklearn.cluster
+import sklearn.metrics
+
+from opu_analysis_lib import hca_linkage, registry
+
+
+def _assert_same_tree(children, distances, expected_children,
+		expected_distances):
+	# merge distances are the same, and so are the flat clusters at each
+	# distance (merges of equal distances may be in a different order)
+	from opu_analysis_lib.hca_cutoff_optimizer import iter_cut_labels
+
+	numpy.testing.assert_allclose(numpy.sort(distances),
+		numpy.sort(expected_distances))
+	cutoffs = numpy.unique(numpy.round(expected_distances, 9))
+	n_merges = numpy.searchsorted(numpy.sort(distances), cutoffs + 1e-9)
+	expected_n_merges = numpy.searchsorted(numpy.sort(expected_distances),
+		cutoffs + 1e-9)
+	for labels, expected in zip(iter_cut_labels(children, n_merges),
+			iter_cut_labels(expected_children, expected_n_merges)):
+		assert sklearn.metrics.adjusted_rand_score(labels, expected) == 1
+
+
+def test_connectivity_average_linkage_matches_sklearn(blobs):
+	X, _ = blobs
+	X = X + numpy.random.default_rng(1).normal(scale=0.5, size=X.shape)
+	metric = registry.get("cluster_metric").get("euclidean")
+	with pytest.warns(UserWarning, match="connected components"):
+		graph = hca_linkage.KNNConnectivity(5, metric)(X)
+	children, distances = hca_linkage.connectivity_average_linkage(graph)
+	connectivity = graph.copy()
+	connectivity.data[:] = 1
+	model = sklearn.cluster.AgglomerativeClustering(linkage="average",
+		metric="euclidean", connectivity=connectivity, distance_threshold=0,
+		n_clusters=None).fit(X)
+	_assert_same_tree(children, distances, model.children_, model.distances_)
+
+
+def _scipy_tree(Z) -> tuple:
+	return Z[:, :2].astype(int), Z[:, 2]
+
+
+def _noisy_blobs(blobs) -> numpy.ndarray:
+	X, _ = blobs
+	return X + numpy.random.default_rng(1).normal(scale=0.5, size=X.shape)
+
+
+def test_nn_chain_weighted_average_matches_scipy(blobs):
+	X = _noisy_blobs(blobs)
+	condensed = scipy.spatial.distance.pdist(X)
+	children, distances = hca_linkage.nn_chain_weighted_average(
+		scipy.spatial.distance.squareform(condensed))
+	_assert_same_tree(children, distances, *_scipy_tree(
+		scipy.cluster.hierarchy.linkage(condensed, method="average")))
+	model = sklearn.cluster.AgglomerativeClustering(linkage="average",
+		metric="precomputed", distance_threshold=0, n_clusters=None).fit(
+		scipy.spatial.distance.squareform(condensed))
+	_assert_same_tree(children, distances, model.children_, model.distances_)
+
+
+def test_nn_chain_weighted_average_weights_as_duplicates(blobs):
+	X = _noisy_blobs(blobs)[:20]
+	weights = numpy.random.default_rng(2).integers(1, 4, len(X))
+	children, distances = hca_linkage.nn_chain_weighted_average(
+		scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(X)),
+		weights=weights)
+	# duplicated points merge at distance 0 first, then the tree is the same
+	# as that of the weighted points
+	dup = numpy.repeat(X, weights, axis=0)
+	Z = scipy.cluster.hierarchy.linkage(dup, method="average")
+	n_dup = len(dup) - len(X)
+	numpy.testing.assert_allclose(Z[:n_dup, 2], 0)
+	numpy.testing.assert_allclose(distances, Z[n_dup:, 2])
+
+
+def test_nn_chain_ward_matches_scipy(blobs):
+	X = _noisy_blobs(blobs)
+	children, distances = hca_linkage.nn_chain_ward(X)
+	_assert_same_tree(children, distances, *_scipy_tree(
+		scipy.cluster.hierarchy.linkage(X, method="ward")))
+	model = sklearn.cluster.AgglomerativeClustering(linkage="ward",
+		distance_threshold=0, n_clusters=None).fit(X)
+	_assert_same_tree(children, distances, model.children_, model.distances_)
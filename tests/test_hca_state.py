@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import numpy
+import pytest
+
+
+@pytest.mark.parametrize("params", [
+	dict(cutoff=0.5),
+	dict(cutoff="silhouette", linkage="ward"),
+	dict(cutoff=0.5, n_micro_clusters=30, random_state=0),
+])
+def test_hca_state_round_trip(make_analysis, tmp_path, params):
+	anal = make_analysis()
+	anal.run_hca(metric="euclidean", **params)
+	anal.dendrogram  # created on demand, saved if created
+	f = tmp_path / "state.npz"
+	anal.save_hca_state(str(f), with_dist=True)
+
+	loaded = make_analysis().load_hca_state(str(f))
+	numpy.testing.assert_array_equal(loaded.hca_labels, anal.hca_labels)
+	numpy.testing.assert_array_equal(loaded.remapped_hca_label_array,
+		anal.remapped_hca_label_array)
+	assert loaded.remapped_hca_label_unique == anal.remapped_hca_label_unique
+	assert loaded.cutoff_opt.cutoff_final == anal.cutoff_opt.cutoff_final
+	assert loaded.metric_key == anal.metric_key
+	numpy.testing.assert_array_equal(loaded.linkage_matrix,
+		anal.linkage_matrix)
+	assert loaded.dendrogram["leaves"] == anal.dendrogram["leaves"]
+	if anal.dist_mat is None:
+		assert loaded.dist_mat is None
+	else:
+		numpy.testing.assert_allclose(loaded.dist_mat, anal.dist_mat)
+	if anal.micro_cluster_labels is not None:
+		numpy.testing.assert_array_equal(loaded.micro_cluster_labels,
+			anal.micro_cluster_labels)
+
+
+def test_hca_state_without_dist(make_analysis, tmp_path):
+	anal = make_analysis()
+	anal.run_hca(metric="euclidean", cutoff=0.5)
+	f = tmp_path / "state.npz"
+	anal.save_hca_state(str(f))
+	loaded = make_analysis().load_hca_state(str(f))
+	assert loaded.dist_mat is None
+	numpy.testing.assert_array_equal(loaded.linkage_matrix,
+		anal.linkage_matrix)
+
+
+def test_hca_state_rejects_other_dataset(make_analysis, tmp_path):
+	from conftest import make_blobs
+
+	anal = make_analysis()
+	anal.run_hca(metric="euclidean", cutoff=0.5)
+	f = tmp_path / "state.npz"
+	anal.save_hca_state(str(f))
+	other = make_analysis(make_blobs(n_per_blob=20)[0])
+	with pytest.raises(ValueError):
+		other.load_hca_state(str(f))
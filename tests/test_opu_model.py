@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import numpy
+import pytest
+
+from opu_analysis_lib import OPUModel
+
+
+@pytest.fixture
+def fitted(make_analysis):
+	anal = make_analysis()
+	anal.run_hca(metric="euclidean", cutoff=0.5)
+	return anal
+
+
+@pytest.mark.parametrize("reference", ["centroid", "representative",
+	"both"])
+def test_opu_model_round_trip(fitted, tmp_path, reference):
+	model = OPUModel.from_analysis(fitted, reference=reference,
+		n_representatives=3)
+	f = str(tmp_path / "model.json")
+	model.save(f)
+	loaded = OPUModel.load(f)
+	numpy.testing.assert_array_equal(loaded.wavenum, model.wavenum)
+	numpy.testing.assert_allclose(loaded.ref_intens, model.ref_intens)
+	numpy.testing.assert_array_equal(loaded.ref_labels, model.ref_labels)
+	assert loaded.ref_names == model.ref_names
+	assert loaded.opu_sizes == model.opu_sizes
+	assert (loaded.metric_key, loaded.cutoff, loaded.linkage) \
+		== (model.metric_key, model.cutoff, model.linkage)
+	# the fitted spectra are assigned to their own opus
+	labels, dists = loaded.assign(fitted.dataset.intens, chunk_size=7)
+	numpy.testing.assert_array_equal(labels[:, 0],
+		fitted.remapped_hca_label_array)
+	assert (dists[:, 0] >= 0).all()
+
+
+def test_opu_model_assign_matches_brute_force(fitted):
+	model = OPUModel.from_analysis(fitted, reference="both")
+	X = fitted.dataset.intens + numpy.random.default_rng(0).normal(
+		scale=0.5, size=fitted.dataset.intens.shape)
+	labels, dists = model.assign(X, top_k=2, chunk_size=16)
+	ref_dist = model.metric(X, model.ref_intens)
+	nearest = numpy.stack([ref_dist[:, model.ref_labels == i].min(axis=1)
+		for i in model.opu_labels], axis=1)
+	order = numpy.argsort(nearest, axis=1, kind="stable")[:, :2]
+	numpy.testing.assert_array_equal(labels, model.opu_labels[order])
+	numpy.testing.assert_allclose(dists,
+		numpy.take_along_axis(nearest, order, axis=1))
+	# opus farther than the cutoff are not assigned
+	labels, dists = model.assign(X, top_k=2, max_dist="cutoff")
+	assert ((labels == -1) == (dists > model.cutoff)).all()
+
+
+def test_opu_assign_cli(fitted, tmp_path):
+	fitted.reconcile_param = dict(bin_size=None, wavenum_low=400,
+		wavenum_high=1800, normalize="none")
+	model = OPUModel.from_analysis(fitted)
+	model_file = str(tmp_path / "model.json")
+	model.save(model_file)
+	data_file = str(tmp_path / "spectra.tsv")
+	fitted.dataset.save_file(data_file, with_spectra_names=True)
+	out_file = str(tmp_path / "out.tsv")
+	OPUModel.cli_main([model_file, data_file, "-o", out_file,
+		"--chunk-size", "7"])
+	with open(out_file) as fp:
+		lines = [i.rstrip("\n").split("\t") for i in fp]
+	assert [i[0] for i in lines] == list(fitted.dataset.spectra_names)
+	assert [int(i[1]) for i in lines] \
+		== fitted.remapped_hca_label_array.tolist()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import numpy
+import pytest
+import scipy.special
+
+from opu_analysis_lib import rarefaction
+
+
+COUNTS = numpy.array([[10, 0, 5, 5], [1, 1, 1, 1], [40, 0, 0, 0],
+	[3, 2, 0, 1], [0, 0, 0, 0]])
+
+
+def _direct_diversity(row, depth, resampling, n_replicates, rng) -> tuple:
+	# shannon index and richness of replicates drawn one spectrum at a time
+	pool = numpy.repeat(numpy.arange(len(row)), row)
+	shannon, richness = list(), list()
+	for _ in range(n_replicates):
+		x = numpy.bincount(rng.choice(pool, depth,
+			replace=(resampling == "multinomial")), minlength=len(row))
+		p = x[x > 0] / depth
+		shannon.append(-(p * numpy.log(p)).sum())
+		richness.append((x > 0).sum())
+	return numpy.asarray(shannon), numpy.asarray(richness)
+
+
+@pytest.mark.parametrize("resampling", rarefaction.RESAMPLING)
+def test_resampled_diversity_matches_direct_sampling(resampling):
+	depth, n_replicates = 4, 4000
+	div = rarefaction.resampled_diversity(COUNTS, depth, n_replicates,
+		resampling=resampling, random_state=0)
+	assert div["shannon"].shape == (n_replicates, len(COUNTS))
+	rng = numpy.random.default_rng(1)
+	for i, row in enumerate(COUNTS):
+		if row.sum() < depth:
+			assert numpy.isnan(div["shannon"][:, i]).all()
+			assert numpy.isnan(div["richness"][:, i]).all()
+			continue
+		for k, direct in zip(["shannon", "richness"], _direct_diversity(row,
+				depth, resampling, n_replicates, rng)):
+			# the means agree within 5 standard errors
+			se = numpy.sqrt((div[k][:, i].var() + direct.var())
+				/ n_replicates)
+			assert abs(div[k][:, i].mean() - direct.mean()) <= 5 * se + 1e-12
+
+
+def test_rarefied_richness_matches_hurlbert():
+	depth = 4
+	div = rarefaction.resampled_diversity(COUNTS[:4], depth, 20000,
+		resampling="hypergeometric", random_state=0)
+	for i, row in enumerate(COUNTS[:4]):
+		# expected number of categories in a subsample without replacement
+		expected = sum(1 - scipy.special.comb(row.sum() - c, depth)
+			/ scipy.special.comb(row.sum(), depth) for c in row)
+		assert abs(div["richness"][:, i].mean() - expected) < 0.02
+
+
+def test_resampled_counts_sum_to_depth():
+	for resampling in rarefaction.RESAMPLING:
+		drawn = numpy.stack(list(rarefaction.iter_resampled_counts(COUNTS, 4,
+			10, resampling=resampling, random_state=0)), axis=-1)
+		numpy.testing.assert_array_equal(drawn.sum(axis=-1),
+			numpy.broadcast_to(numpy.minimum(COUNTS.sum(axis=1), 4), (10, 5)))
+		if resampling == "hypergeometric":
+			assert (drawn <= COUNTS[None]).all()
+
+
+def test_summarize_replicates():
+	values = numpy.arange(101, dtype=float)[:, None]
+	mean, low, high = rarefaction.summarize_replicates(values, 0.9)
+	numpy.testing.assert_allclose([mean[0], low[0], high[0]], [50, 5, 95])
+	with pytest.raises(ValueError):
+		rarefaction.summarize_replicates(values, 1)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+import numpy
+
+from opu_analysis_lib.spectra_histogram import SpectraHistogram
+
+
+def test_quantile_within_one_bin_width():
+	rng = numpy.random.default_rng(0)
+	intens = rng.normal(size=(5000, 3)) * [1, 10, 100]
+	hist = SpectraHistogram(n_bins=256, max_bins=512)
+	for chunk in numpy.array_split(intens, 7):
+		hist.add(chunk)
+	assert hist.n_spectra == len(intens)
+	q = [0, 0.05, 0.25, 0.5, 0.75, 0.95, 1]
+	expected = numpy.quantile(intens, q, axis=0)
+	numpy.testing.assert_array_less(numpy.abs(hist.quantile(q) - expected),
+		hist.bin_width + 1e-12)
+	numpy.testing.assert_allclose(hist.mean, intens.mean(axis=0))
+
+
+class _CheckedHistogram(SpectraHistogram):
+	# checks the number of bins whenever bins are added
+	def _extend(self, lo, hi) -> None:
+		super()._extend(lo, hi)
+		assert len(self.counts) <= self.max_bins + 2
+		return
+
+
+def test_outlier_chunk_keeps_bins_bounded():
+	hist = _CheckedHistogram(n_bins=64, max_bins=128)
+	chunks = [numpy.zeros((10, 4)), numpy.linspace(0, 1e6, 40).reshape(10, 4),
+		numpy.full((10, 4), -1e9), numpy.random.default_rng(1).normal(
+			size=(10, 4))]
+	for chunk in chunks:
+		hist.add(chunk)
+		assert len(hist.counts) <= hist.max_bins
+	assert hist.n_spectra == 40
+	edges = hist.intens_edges
+	assert edges[0] <= -1e9
+	assert edges[-1] >= 1e6
+
+
+def test_non_finite_values_are_ignored():
+	hist = SpectraHistogram()
+	hist.add([[numpy.nan, 1.0], [numpy.inf, 2.0]])
+	assert hist.counts[:, 0].sum() == 0
+	assert hist.counts[:, 1].sum() == 2
+	assert numpy.isnan(hist.quantile(0.5)[0])